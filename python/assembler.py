@@ -0,0 +1,633 @@
+''' Assembler for the AT&T syntax the emitters generate, writing ELF objects.
+
+assemble(text,word) returns a relocatable object for i386 (word 4) or
+x86-64 (word 8), so the compiler needs gcc only to link against libc.
+It knows the instructions and directives Emitter, Emitter64, regalloc and
+peephole produce, not the whole instruction set:
+
+    mov lea add sub and or xor cmp test push pop imul idiv neg not
+    shl shr sar (with b/l/q suffixes)  movzbl movslq set<cc> j<cc>
+    jmp call cdq cqto leave ret
+    .text .data .section .globl .align .byte .long .quad .ascii .asciz .space
+
+Operands are registers, $immediates, disp(base,index,scale) and
+label(%rip); an immediate or displacement may be a symbol. Jumps to labels
+in the same section are short when the target is in reach; the layout is
+repeated until no short jump grows. A reference to a local label of
+another section is relocated against that section's symbol, as gas does.
+
+Run this module to assemble a file: assembler.py [--64] file.s [file.o]
+'''
+import struct
+from elf import ElfObject, STB_GLOBAL
+
+class AssemblerError(Exception):
+    pass
+
+REGS = {}
+for num,name in enumerate(['ax','cx','dx','bx','sp','bp','si','di']):
+    REGS['%e'+name] = (num,4)
+    REGS['%r'+name] = (num,8)
+for num,name in enumerate(['al','cl','dl','bl']):
+    REGS['%'+name] = (num,1)
+for num in range(8,16):
+    REGS['%%r%d' % num] = (num,8)
+    REGS['%%r%dd' % num] = (num,4)
+
+SUFFIXES = {'b':1,'l':4,'q':8}
+
+CONDITIONS = dict((cc,n) for n,names in enumerate(['o','no','b c nae','ae nb nc',
+    'e z','ne nz','be na','a nbe','s','ns','p pe','np po','l nge','ge nl',
+    'le ng','g nle']) for cc in names.split())
+
+ALU = {'add':0,'or':1,'and':4,'sub':5,'xor':6,'cmp':7}
+UNARY = {'not':2,'neg':3,'imul1':5,'idiv':7}
+SHIFTS = {'shl':4,'shr':5,'sar':7}
+
+# Operations without a size suffix
+PLAIN = {'cdq':'\x99','cqto':'\x48\x99','leave':'\xc9','ret':'\xc3','nop':'\x90'}
+ZERO_EXTEND = {'movzbl':('\x0f\xb6',4),'movzxb':('\x0f\xb6',4),'movslq':('\x63',8)}
+
+
+# Encoded instructions by (word,op,args); code and data items are never
+# changed after encoding, so equal lines share them
+ENCODED = {}
+CACHE_SIZE = 20000
+
+
+class Reg:
+
+    def __init__(self,name):
+        self.num,self.size = REGS[name]
+
+class Imm:
+
+    def __init__(self,value,symbol):
+        self.value = value
+        self.symbol = symbol
+
+class Mem:
+
+    def __init__(self,disp,symbol,base=None,index=None,scale=1):
+        self.disp = disp
+        self.symbol = symbol
+        self.base = base
+        self.index = index
+        self.scale = scale
+
+
+def value_or_symbol(text):
+    ''' (value,None) for a number, (offset,name) for name, name+n or name-n '''
+    text = text.strip()
+    try:
+        return int(text,0),None
+    except ValueError:
+        pass
+    for sign in '+-':
+        if sign in text:
+            name,offset = text.split(sign,1)
+            return int(sign + offset.strip(),0),name.strip()
+    return 0,text
+
+def parse_operand(text):
+    text = text.strip()
+    if text.startswith('$'):
+        return Imm(*value_or_symbol(text[1:]))
+    if text.startswith('%'):
+        if text not in REGS:
+            raise AssemblerError('unknown register %s' % text)
+        return Reg(text)
+    if '(' not in text:
+        return Mem(*value_or_symbol(text))
+    disp,rest = text.split('(',1)
+    value,symbol = value_or_symbol(disp) if disp.strip() else (0,None)
+    parts = [p.strip() for p in rest.rstrip(')').split(',')]
+    base = parts[0] or None
+    index = parts[1] if len(parts) > 1 else None
+    scale = int(parts[2]) if len(parts) > 2 else 1
+    return Mem(value,symbol,base,index,scale)
+
+def split_operands(text):
+    ''' Operands separated by commas outside parentheses '''
+    if '(' not in text:
+        return [parse_operand(o) for o in text.split(',') if o.strip()]
+    operands,depth,current = [],0,''
+    for ch in text:
+        if ch == ',' and depth == 0:
+            operands.append(current)
+            current = ''
+            continue
+        depth += {'(':1,')':-1}.get(ch,0)
+        current += ch
+    if current.strip():
+        operands.append(current)
+    return [parse_operand(o) for o in operands]
+
+def strip_comment(line):
+    if '#' not in line:
+        return line
+    if '"' not in line:
+        return line[:line.index('#')]
+    quoted = False
+    for i,ch in enumerate(line):
+        if ch == '"' and (i == 0 or line[i-1] != '\\'):
+            quoted = not quoted
+        elif ch == '#' and not quoted:
+            return line[:i]
+    return line
+
+def unquote(text):
+    ''' Bytes of a C-style string literal '''
+    text = text.strip()
+    if len(text) < 2 or text[0] != '"' or text[-1] != '"':
+        raise AssemblerError('string expected: %s' % text)
+    text = text[1:-1]
+    out = ''
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        i += 1
+        if ch != '\\':
+            out += ch
+            continue
+        ch = text[i]
+        i += 1
+        if ch in '01234567':
+            digits = ch
+            while i < len(text) and len(digits) < 3 and text[i] in '01234567':
+                digits += text[i]
+                i += 1
+            out += chr(int(digits,8) & 0xff)
+        elif ch == 'x':
+            digits = ''
+            while i < len(text) and text[i] in '0123456789abcdefABCDEF':
+                digits += text[i]
+                i += 1
+            out += chr(int(digits,16) & 0xff)
+        else:
+            out += {'n':'\n','t':'\t','r':'\r','b':'\b','f':'\f'}.get(ch,ch)
+    return out
+
+def fits8(value):
+    return -128 <= value < 128
+
+
+class Code:
+    ''' Encoded instruction or data with fixups (pos,symbol,size,kind,addend);
+        'pc' fixups are relative to the end of the instruction
+    '''
+    def __init__(self,data,fixups=()):
+        self.data = data
+        self.fixups = list(fixups)
+
+    def size(self,offset):
+        return len(self.data)
+
+class Label:
+
+    def __init__(self,name):
+        self.name = name
+
+    def size(self,offset):
+        return 0
+
+class Align:
+
+    def __init__(self,n,fill):
+        self.n = n
+        self.fill = fill
+
+    def size(self,offset):
+        return -offset % self.n
+
+class Jump:
+    ''' jmp, j<cc> or call to a label, short until proven out of reach '''
+
+    def __init__(self,cond,target,call=False):
+        self.cond = cond
+        self.target = target
+        self.call = call
+        self.long = call
+
+    def size(self,offset):
+        if not self.long:
+            return 2
+        return 5 if self.cond is None else 6
+
+    def code(self):
+        if self.call:
+            return '\xe8'
+        if self.cond is None:
+            return '\xe9' if self.long else '\xeb'
+        if self.long:
+            return '\x0f' + chr(0x80 + self.cond)
+        return chr(0x70 + self.cond)
+
+
+class Assembler:
+
+    def __init__(self,word=4):
+        self.word = word
+        self.sections = {}
+        self.order = []
+        self.globals = set()
+        self.switch('.text')
+
+    def switch(self,name):
+        if name not in self.sections:
+            self.sections[name] = []
+            self.order.append(name)
+        self.items = self.sections[name]
+
+    def assemble(self,text):
+        for number,line in enumerate(text.split('\n')):
+            try:
+                self.line(line)
+            except (AssemblerError,KeyError,ValueError,IndexError),e:
+                raise AssemblerError('line %d: %s: %s' % (number+1,line.strip(),e))
+        return self
+
+    def line(self,line):
+        line = strip_comment(line).strip()
+        while line:
+            head = line.split(None,1)[0]
+            if not head.endswith(':'):
+                break
+            self.items.append(Label(head[:-1]))
+            line = line[len(head):].strip()
+        if not line:
+            return
+        parts = line.split(None,1)
+        op,args = parts[0],parts[1] if len(parts) > 1 else ''
+        if op.startswith('.'):
+            self.directive(op,args)
+        else:
+            self.instruction(op,args)
+
+    def directive(self,op,args):
+        if op in ('.text','.data','.bss'):
+            self.switch(op)
+        elif op == '.section':
+            self.switch(args.split(',')[0].strip())
+        elif op in ('.globl','.global'):
+            self.globals.update(a.strip() for a in args.split(','))
+        elif op in ('.align','.p2align','.balign'):
+            n = int(args.split(',')[0],0)
+            if op == '.p2align':
+                n = 1 << n
+            fill = '\x90' if self.items is self.sections.get('.text') else '\0'
+            self.items.append(Align(n,fill))
+        elif op in ('.ascii','.asciz','.string'):
+            data = unquote(args)
+            if op != '.ascii':
+                data += '\0'
+            self.items.append(Code(data))
+        elif op in ('.byte','.word','.short','.long','.int','.quad'):
+            size = {'.byte':1,'.word':2,'.short':2,'.long':4,'.int':4,'.quad':8}[op]
+            for a in args.split(','):
+                value,symbol = value_or_symbol(a)
+                fixups = [(0,symbol,size,'abs',0)] if symbol else []
+                self.items.append(Code(self.pack(value if not symbol else 0,size),fixups))
+        elif op in ('.space','.skip','.zero'):
+            args = args.split(',')
+            fill = chr(int(args[1],0) & 0xff) if len(args) > 1 else '\0'
+            self.items.append(Code(fill * int(args[0],0)))
+        elif op in ('.file','.type','.size','.ident'):
+            pass
+        else:
+            raise AssemblerError('unknown directive %s' % op)
+
+    def pack(self,value,size):
+        value &= (1 << size*8) - 1
+        return struct.pack({1:'<B',2:'<H',4:'<I',8:'<Q'}[size],value)
+
+    # Encoding
+
+    def rex(self,w,reg,index,base):
+        rex = (w and 8) | (reg >> 3) << 2 | (index >> 3) << 1 | base >> 3
+        if rex and self.word != 8:
+            raise AssemblerError('register needs x86-64')
+        return chr(0x40 | rex) if rex else ''
+
+    def modrm(self,reg,rm):
+        ''' Prefixes, ModRM/SIB/displacement bytes and fixups for rm '''
+        if isinstance(rm,Reg):
+            return '',(reg,0,rm.num),chr(0xc0 | (reg & 7) << 3 | rm.num & 7),[]
+        prefix = ''
+        fixups = []
+        if rm.base == '%rip':
+            if self.word != 8:
+                raise AssemblerError('%rip addressing needs x86-64')
+            if rm.symbol:
+                fixups.append((1,rm.symbol,4,'pc',rm.disp))
+            return '',(reg,0,0),chr((reg & 7) << 3 | 5) + self.pack(0 if rm.symbol else rm.disp,4),fixups
+        base = Reg(rm.base) if rm.base else None
+        index = Reg(rm.index) if rm.index else None
+        size = (base or index).size if (base or index) else self.word
+        if self.word == 8 and size == 4:
+            prefix = '\x67'
+        if rm.symbol:
+            fixups.append((None,rm.symbol,4,'abs',rm.disp))
+        disp = 0 if rm.symbol else rm.disp
+        if base is None:
+            if index is None and self.word == 4:
+                data = chr((reg & 7) << 3 | 5) + self.pack(disp,4)
+                return prefix,(reg,0,0),data,self.place(fixups,1)
+            sib = {1:0,2:1,4:2,8:3}[rm.scale] << 6 | ((index.num if index else 4) & 7) << 3 | 5
+            data = chr((reg & 7) << 3 | 4) + chr(sib) + self.pack(disp,4)
+            return prefix,(reg,index.num if index else 0,0),data,self.place(fixups,2)
+        if rm.symbol:
+            mod,tail = 2,self.pack(0,4)
+        elif disp == 0 and base.num & 7 != 5:
+            mod,tail = 0,''
+        elif fits8(disp):
+            mod,tail = 1,self.pack(disp,1)
+        else:
+            mod,tail = 2,self.pack(disp,4)
+        if index is None and base.num & 7 != 4:
+            data = chr(mod << 6 | (reg & 7) << 3 | base.num & 7)
+            return prefix,(reg,0,base.num),data + tail,self.place(fixups,1)
+        idx = index.num if index else 4
+        if index and idx == 4:
+            raise AssemblerError('%esp cannot be an index')
+        sib = {1:0,2:1,4:2,8:3}[rm.scale] << 6 | (idx & 7) << 3 | base.num & 7
+        data = chr(mod << 6 | (reg & 7) << 3 | 4) + chr(sib)
+        return prefix,(reg,idx if index else 0,base.num),data + tail,self.place(fixups,2)
+
+    def place(self,fixups,pos):
+        return [(pos,) + f[1:] for f in fixups]
+
+    def encode(self,opcode,reg,rm,size=4,imm=None,immsize=0,prefix=''):
+        ''' Instruction with a ModRM operand rm and optional immediate '''
+        pre,regs,data,fixups = self.modrm(reg,rm)
+        rex = self.rex(size == 8,*regs)
+        head = prefix + pre + rex + opcode
+        fixups = [(len(head) + f[0],) + f[1:] for f in fixups]
+        code = head + data
+        if imm is not None:
+            if imm.symbol:
+                fixups.append((len(code),imm.symbol,immsize,'abs',imm.value))
+                code += self.pack(0,immsize)
+            else:
+                code += self.pack(imm.value,immsize)
+        return Code(code,fixups)
+
+    def short(self,opcode,num,size=4,imm=None,immsize=0):
+        ''' Instruction with the register in the opcode, like push or mov $,%r '''
+        rex = self.rex(size == 8,0,0,num)
+        code = rex + chr(ord(opcode) + (num & 7))
+        return self.with_imm(code,imm,immsize)
+
+    def with_imm(self,code,imm,immsize):
+        fixups = []
+        if imm is not None:
+            if imm.symbol:
+                fixups.append((len(code),imm.symbol,immsize,'abs',imm.value))
+                code += self.pack(0,immsize)
+            else:
+                code += self.pack(imm.value,immsize)
+        return Code(code,fixups)
+
+    def absolute(self,x):
+        return isinstance(x,Mem) and x.base is None and x.index is None
+
+    def split_suffix(self,op):
+        if op[-1] in SUFFIXES:
+            return op[:-1],SUFFIXES[op[-1]]
+        return op,None
+
+    def instruction(self,op,args):
+        ''' Append the encoded instruction, reusing the encoding of an equal line '''
+        key = (self.word,op,args)
+        item = ENCODED.get(key)
+        if item is None:
+            item = self.encode_instruction(op,args)
+            if len(ENCODED) >= CACHE_SIZE:
+                ENCODED.clear()
+            ENCODED[key] = item
+        if isinstance(item,Jump):
+            # Relaxation changes jumps
+            item = Jump(item.cond,item.target,item.call)
+        self.items.append(item)
+
+    def encode_instruction(self,op,args):
+        operands = split_operands(args)
+        if op in PLAIN:
+            return Code(PLAIN[op])
+        if op in ('jmp','call') or op[0] == 'j' and op[1:] in CONDITIONS:
+            target = operands[0]
+            if not isinstance(target,Mem) or target.base or not target.symbol:
+                raise AssemblerError('only direct jumps and calls to labels')
+            cond = None if op in ('jmp','call') else CONDITIONS[op[1:]]
+            return Jump(cond,target.symbol,op == 'call')
+        if op.startswith('set') and op[3:] in CONDITIONS:
+            return self.encode('\x0f' + chr(0x90 + CONDITIONS[op[3:]]),0,operands[0],1)
+        if op in ZERO_EXTEND:
+            opcode,size = ZERO_EXTEND[op]
+            src,dst = operands
+            return self.encode(opcode,dst.num,src,size)
+        name,size = self.split_suffix(op)
+        if size is None:
+            raise AssemblerError('unknown instruction %s' % op)
+        return self.operation(name,size,operands)
+
+    def operation(self,name,size,operands):
+        byte = size == 1
+        immsize = 1 if byte else 4
+        if name in ALU:
+            n = ALU[name]
+            src,dst = operands
+            if isinstance(src,Imm):
+                if byte:
+                    if isinstance(dst,Reg) and dst.num == 0:
+                        return self.with_imm(chr(8*n + 4),src,1)
+                    return self.encode('\x80',n,dst,size,src,1)
+                if src.symbol is None and fits8(src.value):
+                    return self.encode('\x83',n,dst,size,src,1)
+                if isinstance(dst,Reg) and dst.num == 0:
+                    rex = self.rex(size == 8,0,0,0)
+                    return self.with_imm(rex + chr(8*n + 5),src,4)
+                return self.encode('\x81',n,dst,size,src,4)
+            if isinstance(src,Reg):
+                return self.encode(chr(8*n + (0 if byte else 1)),src.num,dst,size)
+            return self.encode(chr(8*n + (2 if byte else 3)),dst.num,src,size)
+        if name == 'mov':
+            src,dst = operands
+            moffs = self.word == 4 and not byte
+            if moffs and isinstance(dst,Reg) and dst.num == 0 and self.absolute(src):
+                return self.with_imm('\xa1',Imm(src.disp,src.symbol),4)
+            if moffs and isinstance(src,Reg) and src.num == 0 and self.absolute(dst):
+                return self.with_imm('\xa3',Imm(dst.disp,dst.symbol),4)
+            if isinstance(src,Imm):
+                if isinstance(dst,Reg) and size != 8:
+                    return self.short('\xb0' if byte else '\xb8',dst.num,size,src,immsize)
+                return self.encode('\xc6' if byte else '\xc7',0,dst,size,src,immsize)
+            if isinstance(src,Reg):
+                return self.encode('\x88' if byte else '\x89',src.num,dst,size)
+            return self.encode('\x8a' if byte else '\x8b',dst.num,src,size)
+        if name == 'lea':
+            src,dst = operands
+            return self.encode('\x8d',dst.num,src,size)
+        if name == 'test':
+            src,dst = operands
+            if isinstance(src,Imm):
+                return self.encode('\xf6' if byte else '\xf7',0,dst,size,src,immsize)
+            return self.encode('\x84' if byte else '\x85',src.num,dst,size)
+        if name in ('push','pop'):
+            if size != self.word:
+                raise AssemblerError('%s%s: operand size' % (name,{4:'l',8:'q'}.get(size,'')))
+            x, = operands
+            if isinstance(x,Reg):
+                return self.short('\x50' if name == 'push' else '\x58',x.num)
+            if isinstance(x,Imm):
+                if name == 'pop':
+                    raise AssemblerError('pop of an immediate')
+                if x.symbol is None and fits8(x.value):
+                    return self.with_imm('\x6a',x,1)
+                return self.with_imm('\x68',x,4)
+            if name == 'push':
+                return self.encode('\xff',6,x)
+            return self.encode('\x8f',0,x)
+        if name == 'imul' and len(operands) > 1:
+            if isinstance(operands[0],Imm):
+                imm = operands[0]
+                dst = operands[-1]
+                src = operands[1] if len(operands) == 3 else dst
+                small = imm.symbol is None and fits8(imm.value)
+                return self.encode('\x6b' if small else '\x69',dst.num,src,size,imm,1 if small else 4)
+            src,dst = operands
+            return self.encode('\x0f\xaf',dst.num,src,size)
+        if name == 'imul':
+            name = 'imul1'
+        if name in UNARY:
+            x, = operands
+            return self.encode('\xf6' if byte else '\xf7',UNARY[name],x,size)
+        if name in SHIFTS:
+            n = SHIFTS[name]
+            if len(operands) == 1:
+                return self.encode('\xd0' if byte else '\xd1',n,operands[0],size)
+            count,dst = operands
+            if isinstance(count,Reg):
+                return self.encode('\xd2' if byte else '\xd3',n,dst,size)
+            if count.value == 1:
+                return self.encode('\xd0' if byte else '\xd1',n,dst,size)
+            return self.encode('\xc0' if byte else '\xc1',n,dst,size,count,1)
+        raise AssemblerError('unknown instruction %s' % name)
+
+    # Layout
+
+    def layout(self,items):
+        ''' Offsets of the items and labels, growing short jumps as needed '''
+        while True:
+            offsets,labels = [],{}
+            offset = 0
+            for item in items:
+                offsets.append(offset)
+                if isinstance(item,Label):
+                    labels[item.name] = offset
+                offset += item.size(offset)
+            grown = False
+            for item,offset in zip(items,offsets):
+                if isinstance(item,Jump) and not item.long:
+                    target = labels.get(item.target)
+                    if target is None or not fits8(target - offset - 2):
+                        item.long = grown = True
+            if not grown:
+                return offsets,labels
+
+    def link(self):
+        ''' Lay out the sections, resolving the references the assembler can.
+            Returns the sections as (name,data,align,relocs) and the labels
+            as {name:(section number,offset)}. The relocs left are
+            (offset,symbol,size,kind,addend), addends relative to the field.
+        '''
+        laid = []
+        defined = {}
+        for number,name in enumerate(self.order):
+            items = self.sections[name]
+            offsets,labels = self.layout(items)
+            laid.append((name,items,offsets,labels))
+            for label,offset in labels.items():
+                if label in defined:
+                    raise AssemblerError('%s defined twice' % label)
+                defined[label] = (number,offset)
+        sections = []
+        for name,items,offsets,labels in laid:
+            data = bytearray()
+            fixups = []
+            for item,offset in zip(items,offsets):
+                if isinstance(item,Code):
+                    data += item.data
+                    for pos,symbol,size,kind,addend in item.fixups:
+                        # pc addends are relative to the instruction end
+                        end = offset + len(item.data)
+                        fixups.append((offset + pos,symbol,size,kind,addend,end))
+                elif isinstance(item,Align):
+                    data += item.fill * item.size(offset)
+                elif isinstance(item,Jump):
+                    code = item.code()
+                    size = item.size(offset) - len(code)
+                    data += code + '\0' * size
+                    fixups.append((offset + len(code),item.target,size,
+                        'plt' if item.call else 'pc',0,offset + item.size(offset)))
+            relocs = []
+            for at,symbol,size,kind,addend,end in fixups:
+                # A call to a global may be preempted, as gas assumes
+                local = kind == 'pc' or symbol not in self.globals
+                if kind != 'abs' and symbol in labels and local:
+                    data[at:at+size] = self.pack(labels[symbol] + addend - end,size)
+                    continue
+                if kind != 'abs':
+                    addend -= end - at
+                if kind == 'plt' and symbol in defined and local:
+                    kind = 'pc'
+                relocs.append((at,symbol,size,kind,addend))
+            align = max([1] + [i.n for i in items if isinstance(i,Align)])
+            sections.append((name,data,align,relocs))
+        return sections,defined
+
+    def object(self):
+        sections,defined = self.link()
+        obj = ElfObject(self.word)
+        elf_sections = [obj.add_section(name,data,align) for name,data,align,relocs in sections]
+        symbols = {}
+        for label,(number,offset) in sorted(defined.items(),key=lambda d: d[1][1]):
+            bind = STB_GLOBAL if label in self.globals else 0
+            symbols[label] = obj.add_symbol(label,elf_sections[number],offset,bind)
+        def symbol(name):
+            if name not in symbols:
+                symbols[name] = obj.add_symbol(name,None,0,STB_GLOBAL)
+            return symbols[name]
+        for (name,data,align,relocs),section in zip(sections,elf_sections):
+            for at,name,size,kind,addend in relocs:
+                if name in defined and name not in self.globals:
+                    number,value = defined[name]
+                    obj.add_reloc(section,at,elf_sections[number].symbol,size,kind,value + addend)
+                else:
+                    obj.add_reloc(section,at,symbol(name),size,kind,addend)
+        for name in self.globals:
+            symbol(name)
+        return obj
+
+def assemble(text,word=4):
+    ''' Relocatable ELF object, as a string, of the assembly text '''
+    from cStringIO import StringIO
+    out = StringIO()
+    Assembler(word).assemble(text).object().write(out)
+    return out.getvalue()
+
+if __name__ == '__main__':
+    import sys
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [--64] file.s [file.o]')
+    op.add_option('--64',dest='word',action='store_const',const=8,default=4,
+        help='assemble x86-64 code [default: i386]')
+    options,args = op.parse_args()
+    if len(args) not in (1,2):
+        op.error('expected file.s [file.o]')
+    target = args[1] if len(args) == 2 else args[0].rsplit('.',1)[0] + '.o'
+    try:
+        code = assemble(open(args[0]).read(),options.word)
+    except AssemblerError,e:
+        sys.exit('%s: %s' % (args[0],e))
+    open(target,'wb').write(code)
@@ -0,0 +1,239 @@
+''' Array-backed AST.
+
+Instead of nested tuples, nodes live in parallel typed arrays of an Arena and
+are referenced by integer ids:
+
+  kinds[id]     node kind code (KIND_CODES)
+  ops[id]       operator code of ARITH/RELOP (OP_CODES)
+  values[id]    int literal, wrapped to the language's int, or index into
+                strings for names and literals
+  lines[id]     first source line of statements, 0 otherwise
+  firsts[id]    index of the node's first child in children
+  counts[id]    number of children
+
+Children are always built before their parent, so ids are in post-order and
+a pass that does not care about nesting can simply loop over range(len(arena)).
+
+NodeView wraps an id with the tuple interface the rest of the compiler
+expects (node[0] is the kind, unpacking, slicing, .text of statements), so
+ir.ASTParser works on either representation.
+'''
+from array import array
+
+from sofortTypes import wrap
+
+KINDS = ['FUNC','TYPE','BLOCK','DECLARE','ASSIGN','PRINT','IF','IFELSE','WHILE',
+    'ID','INDEX','INT','CHAR','STRING','ARITH','RELOP','NEG','ARRAY_CONS','ARRAY_INIT',
+    'APPEND']
+
+KIND_CODES = dict((kind,code) for code,kind in enumerate(KINDS))
+
+OPS = ['','add','sub','mul','div','lt','gt','le','ge']
+
+OP_CODES = dict((op,code) for code,op in enumerate(OPS))
+
+# Fields following the kind in the tuple AST:
+#   n - name or string (values), i - int (values), o - operator (ops),
+#   c - child node, l - list of child nodes, t - type descriptor (values),
+#   0 - empty list (function parameters, not supported yet)
+LAYOUTS = {
+    'FUNC' : 'nc0c',
+    'TYPE' : 't',
+    'BLOCK' : 'l',
+    'DECLARE' : 'cc',
+    'ASSIGN' : 'cc',
+    'PRINT' : 'c',
+    'IF' : 'cc',
+    'IFELSE' : 'ccc',
+    'WHILE' : 'cc',
+    'ID' : 'n',
+    'INDEX' : 'nc',
+    'INT' : 'i',
+    'CHAR' : 'n',
+    'STRING' : 'n',
+    'ARITH' : 'occ',
+    'RELOP' : 'occ',
+    'NEG' : 'c',
+    'ARRAY_CONS' : 'l',
+    'ARRAY_INIT' : 'c',
+    'APPEND' : 'cc',
+}
+
+LAYOUT_BY_CODE = [LAYOUTS[kind] for kind in KINDS]
+
+def field_layout(layout):
+    ''' (kind of field,index of its first child) of the kind and each field '''
+    fields = [('k',0)]
+    child = 0
+    for f in layout:
+        fields.append((f,child))
+        if f == 'c':
+            child += 1
+    return fields
+
+# NodeView indexes these, so node[i] reads only what field i needs
+FIELDS_BY_CODE = [field_layout(layout) for layout in LAYOUT_BY_CODE]
+
+CHILDREN_ONLY = set(['c','cc','ccc'])
+
+
+class Arena:
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.ops = array('B')
+        self.values = array('l')
+        self.lines = array('l')
+        self.firsts = array('l')
+        self.counts = array('l')
+        self.children = array('l')
+        self.strings = []
+        self.string_ids = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def intern(self,s):
+        id = self.string_ids.get(s)
+        if id is None:
+            id = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return id
+
+    def add(self,kind,op,value,children):
+        id = len(self.kinds)
+        self.kinds.append(kind)
+        self.ops.append(op)
+        self.values.append(value)
+        self.lines.append(0)
+        self.firsts.append(len(self.children))
+        self.counts.append(len(children))
+        self.children.extend(children)
+        return id
+
+    def child(self,id,i):
+        return self.children[self.firsts[id] + i]
+
+    def child_ids(self,id):
+        first = self.firsts[id]
+        return self.children[first:first + self.counts[id]]
+
+    def kind(self,id):
+        return KINDS[self.kinds[id]]
+
+    def nbytes(self):
+        ''' Memory held by the arrays (the string table is shared with the source) '''
+        return sum(a.itemsize * len(a) for a in
+            [self.kinds,self.ops,self.values,self.lines,self.firsts,self.counts,self.children])
+
+
+class ArenaBuilder:
+    ''' SofortParser builder producing an Arena; Top() returns NodeViews '''
+
+    def __init__(self,arena=None):
+        self.arena = arena or Arena()
+
+    def node(self,kind,*fields):
+        arena = self.arena
+        code = KIND_CODES[kind]
+        layout = LAYOUTS[kind]
+        # Fast paths for the common layouts
+        if layout in CHILDREN_ONLY:
+            return arena.add(code,0,0,fields)
+        elif layout == 'occ':
+            return arena.add(code,OP_CODES[fields[0]],0,fields[1:])
+        elif layout == 'i':
+            # Every pass wraps int literals, a C long may not hold one as written
+            return arena.add(code,0,wrap(fields[0]),())
+        elif layout == 'n':
+            return arena.add(code,0,arena.intern(fields[0]),())
+        elif layout == 'nc':
+            return arena.add(code,0,arena.intern(fields[0]),fields[1:])
+        elif layout == 'l':
+            return arena.add(code,0,0,fields[0])
+        value = 0
+        children = []
+        for f,field in zip(layout,fields):
+            if f == 'c':
+                children.append(field)
+            elif f == 'n':
+                value = arena.intern(field)
+            elif f == 't':
+                value = arena.intern(''.join(field))
+        return arena.add(code,0,value,children)
+
+    def stat(self,node,first_line):
+        self.arena.lines[node] = first_line
+        return node
+
+    def top(self,funcs):
+        return [NodeView(self.arena,id) for id in funcs]
+
+
+class NodeView(object):
+    ''' Read-only tuple-like view of an arena node '''
+
+    __slots__ = ('arena','id')
+
+    def __init__(self,arena,id):
+        self.arena = arena
+        self.id = id
+
+    def fields(self):
+        return [self[i] for i in range(len(self))]
+
+    def __getitem__(self,i):
+        arena,id = self.arena,self.id
+        kind = arena.kinds[id]
+        f,child = FIELDS_BY_CODE[kind][i]
+        if f == 'c':
+            return NodeView(arena,arena.children[arena.firsts[id] + child])
+        elif f == 'k':
+            return KINDS[kind]
+        elif f == 'n':
+            return arena.strings[arena.values[id]]
+        elif f == 'i':
+            return arena.values[id]
+        elif f == 'o':
+            return OPS[arena.ops[id]]
+        elif f == 'l':
+            first = arena.firsts[id]
+            return [NodeView(arena,c) for c in
+                arena.children[first + child:first + arena.counts[id]]]
+        elif f == 't':
+            desc = arena.strings[arena.values[id]]
+            name = desc.lstrip('[')
+            return ['['] * (len(desc) - len(name)) + [name]
+        return [] # '0'
+
+    def __getslice__(self,i,j):
+        fields = len(FIELDS_BY_CODE[self.arena.kinds[self.id]])
+        return tuple([self[k] for k in xrange(*slice(i,j).indices(fields))])
+
+    def __len__(self):
+        return len(LAYOUT_BY_CODE[self.arena.kinds[self.id]]) + 1
+
+    def __iter__(self):
+        return iter(self.fields())
+
+    def __eq__(self,other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self,other):
+        return not self == other
+
+    @property
+    def text(self):
+        return self.arena.lines[self.id] or None
+
+    def __repr__(self):
+        return repr(to_tuples(self))
+
+
+def to_tuples(node):
+    ''' Convert a NodeView (or list of them) back to the tuple AST '''
+    if isinstance(node,list):
+        return [to_tuples(n) for n in node]
+    if isinstance(node,NodeView):
+        return tuple(to_tuples(f) for f in node)
+    return node
@@ -0,0 +1,83 @@
+''' Compiling many files at once, for compiler.py with several files or a
+directory.
+
+The files are compiled by a multiprocessing pool, one worker per core by
+default. The interpreter and the compiler's modules are loaded once, and a
+worker's gcc link runs while the other workers generate code. A file that
+fails is reported with its error and the batch goes on; run() ends with a
+throughput summary and returns the number of failures.
+'''
+import os
+import signal
+import sys
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
+
+from scanner import AppException
+
+SUFFIX = '.sofort'
+
+def sources(args):
+    ''' The files named, with directories searched for SUFFIX files '''
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for root,dirs,files in os.walk(arg):
+                dirs.sort()
+                paths.extend(os.path.join(root,name) for name in sorted(files)
+                    if name.endswith(SUFFIX))
+        else:
+            paths.append(arg)
+    return paths
+
+def ignore_interrupts():
+    # Ctrl-C is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+
+class Job:
+    ''' compile(path,options,store) in a worker, returning (path,error,seconds) '''
+
+    def __init__(self,compile,options,store):
+        self.compile = compile
+        self.options = options
+        self.store = store
+
+    def __call__(self,path):
+        start = time.time()
+        error = None
+        try:
+            self.compile(path,self.options,self.store)
+        except (AppException,EnvironmentError) as e:
+            error = str(e)
+        except Exception:
+            error = traceback.format_exc().rstrip()
+        return path,error,time.time() - start
+
+
+def run(compile,paths,options,store=None,processes=None,out=sys.stderr):
+    ''' Compile paths in parallel, return the number of files that failed '''
+    processes = processes or cpu_count()
+    pool = Pool(processes,ignore_interrupts)
+    start = time.time()
+    failed,busy = 0,0.0
+    try:
+        for path,error,seconds in pool.imap_unordered(Job(compile,options,store),paths):
+            busy += seconds
+            if error:
+                failed += 1
+                if not error.startswith(path):
+                    error = '%s: %s' % (path,error)
+                print >> out, error
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    elapsed = max(time.time() - start,1e-6)
+    size = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+    print >> out, ('batch: %d files, %d failed, %.2f s with %d processes: %.1f files/s, '
+        '%.1f KB/s, %.1f compiling at a time on average' % (len(paths),failed,elapsed,
+        processes,len(paths) / elapsed,size / 1024.0 / elapsed,busy / elapsed))
+    return failed
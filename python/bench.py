@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+''' Throughput benchmarks for the compiler.
+
+    python bench.py scanner [repeat]
+    python bench.py incremental [repeat]
+    python bench.py ast [repeat]
+    python bench.py run [size]
+    python bench.py jit [count]
+    python bench.py append [count]
+    python bench.py print [count]
+    python bench.py alloc [count]
+    python bench.py suite [size] [results.json]
+    python bench.py compare old.json new.json [percent]
+'''
+import json
+import os
+import sys
+import tempfile
+import time
+
+from scanner import *
+from parser import SofortParser
+from astArena import ArenaBuilder, KINDS
+from sofortTypes import wrap
+from compiler import Parser
+from emitter import Emitter
+import evaluator
+
+SAMPLES = ['regression.sofort','array.sofort','string.sofort']
+
+def sample_source(repeat):
+    ''' Concatenate the sample programs repeat times '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    text = ''.join(open(os.path.join(here,name),'rb').read() + '\n' for name in SAMPLES)
+    return text * repeat
+
+def write_temp(text):
+    fd,path = tempfile.mkstemp(suffix='.sofort')
+    os.write(fd,text)
+    os.close(fd)
+    return path
+
+def best_of(n,func,*args):
+    best = None
+    for i in range(n):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best,result
+
+def count_tokens(path,engine):
+    f = open(path,'rb')
+    scanner = make_scanner(f,engine)
+    n = 0
+    while scanner.scan().kind != T_EOF:
+        n += 1
+    f.close()
+    return n
+
+def bench_scanner(repeat=2000):
+    text = sample_source(repeat)
+    path = write_temp(text)
+    try:
+        print '%d bytes, %d lines' % (len(text),text.count('\n'))
+        base = None
+        for engine in ['char','table','regex']:
+            elapsed,tokens = best_of(3,count_tokens,path,engine)
+            if base is None:
+                base = elapsed
+            print '%-6s %8d tokens %8.3fs %10.0f tokens/s  x%.1f' % (
+                engine,tokens,elapsed,tokens/elapsed,base/elapsed)
+    finally:
+        os.unlink(path)
+
+def bench_incremental(repeat=200):
+    from incremental import IncrementalParser
+    def edit_time(inc,edits,rounds=25):
+        start = time.time()
+        for i in range(rounds):
+            for edit in edits:
+                inc.edit(*edit)
+        return (time.time() - start) / (rounds*len(edits))
+    for n in [repeat,repeat*4,repeat*16]:
+        text = sample_source(n).replace('\r','')
+        inc = IncrementalParser(text,'bench')
+        full,ast = best_of(1,inc.parse)
+        middle = text.index('factorial = 5',len(text)/2) + len('factorial = ')
+        in_line = edit_time(inc,[(middle,middle+1,'7'),(middle,middle+1,'5')])
+        # Changing the number of lines moves the following statements' lines
+        new_line = edit_time(inc,[(middle,middle,'\n'),(middle,middle+1,'')])
+        print '%7d statements  full parse %8.3fs  edit %8.6fs  edit adding a line %8.6fs' % (
+            len(ast[0][4][1]),full,in_line,new_line)
+
+def tuple_ast_size(node,seen):
+    if id(node) in seen or not isinstance(node,(tuple,list)):
+        return 0
+    seen.add(id(node))
+    size = sys.getsizeof(node)
+    if hasattr(node,'__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    return size + sum(tuple_ast_size(n,seen) for n in node)
+
+def count_tuple_kinds(node,counts):
+    if isinstance(node,list):
+        for n in node:
+            count_tuple_kinds(n,counts)
+        return
+    counts[node[0]] = counts.get(node[0],0) + 1
+    for n in node[1:]:
+        if isinstance(n,(tuple,list)):
+            count_tuple_kinds(n,counts)
+
+def bench_ast(repeat=1000):
+    text = sample_source(repeat).replace('\r','')
+    path = write_temp(text)
+    try:
+        parse = lambda builder: SofortParser(make_scanner(open(path,'rb'),'table'),builder).Top()
+        t_tuple,ast = best_of(3,parse,None)
+        builder = ArenaBuilder()
+        t_arena,views = best_of(1,parse,builder)
+        arena = builder.arena
+        print '%d nodes' % len(arena)
+        print 'parse:  tuples %8.3fs  arena %8.3fs' % (t_tuple,t_arena)
+        print 'memory: tuples %8d KB  arena %8d KB' % (
+            tuple_ast_size(ast,set())/1024,arena.nbytes()/1024)
+        # A real pass over each, through NodeView for the arena
+        from ir import ASTParser
+        lower = lambda tree: ASTParser(tree).parse()
+        t_lower_tuple,ir_tuple = best_of(3,lower,ast)
+        t_lower_arena,ir_arena = best_of(3,lower,views)
+        print 'lower:  tuples %8.3fs  arena %8.3fs' % (t_lower_tuple,t_lower_arena)
+        if ir_tuple != ir_arena:
+            print 'the arena lowers to different IR'
+    finally:
+        os.unlink(path)
+
+# Bubble sort of size pseudo-random ints
+RUN_PROGRAM = '''
+a = [%(zeros)s]
+seed = 12345
+i = 0
+while i < %(size)d {
+    seed = seed * 1103515245 + 12345
+    a[i] = seed / 65536
+    i = i + 1
+}
+n = %(size)d
+while n > 1 {
+    j = 0
+    while j < n - 1 {
+        if a[j] > a[j + 1] {
+            t = a[j]
+            a[j] = a[j + 1]
+            a[j + 1] = t
+        }
+        j = j + 1
+    }
+    n = n - 1
+}
+print a[0]
+print a[%(last)d]
+s = "sorted"
+s[0] = 'S'
+print s
+print s[1]
+'''
+
+class CharValue(int):
+    pass
+
+class ByteArray(list):
+    pass
+
+class StringValue(ByteArray):
+    pass
+
+class TreeWalker:
+    ''' Naive interpreter, the baseline for evaluator.py: a visit_* call
+        for every node each time it runs, variables in a dict by name
+    '''
+    def __init__(self,out):
+        self.out = out
+        self.vars = {}
+
+    def run(self,ast):
+        for func in ast:
+            self.visit(func[4])
+
+    def visit(self,node):
+        return getattr(self,'visit_%s' % node[0])(node)
+
+    def visit_BLOCK(self,node):
+        for s in node[1]:
+            self.visit(s)
+
+    def visit_ASSIGN(self,node):
+        value = self.visit(node[2])
+        lval = node[1]
+        if lval[0] == 'ID':
+            self.vars[lval[1]] = value
+            return
+        array = self.vars[lval[1]]
+        i = self.visit(lval[2])
+        if not 0 <= i < len(array):
+            raise evaluator.IndexException()
+        array[i] = value & 0xff if isinstance(array,ByteArray) else value
+
+    visit_DECLARE = visit_ASSIGN
+
+    def visit_PRINT(self,node):
+        value = self.visit(node[1])
+        if isinstance(value,StringValue):
+            end = value.index(0) if 0 in value else len(value)
+            self.out.write(''.join(map(chr,value[:end])) + '\n')
+        elif isinstance(value,CharValue):
+            self.out.write(chr(value & 0xff) + '\n')
+        else:
+            self.out.write('%d\n' % value)
+
+    def visit_IF(self,node):
+        if self.visit(node[1]):
+            self.visit(node[2])
+
+    def visit_IFELSE(self,node):
+        if self.visit(node[1]):
+            self.visit(node[2])
+        else:
+            self.visit(node[3])
+
+    def visit_WHILE(self,node):
+        while self.visit(node[1]):
+            self.visit(node[2])
+
+    def visit_ID(self,node):
+        return self.vars[node[1]]
+
+    def visit_INDEX(self,node):
+        array = self.vars[node[1]]
+        i = self.visit(node[2])
+        if not 0 <= i < len(array):
+            raise evaluator.IndexException()
+        if isinstance(array,ByteArray):
+            return CharValue(array[i])
+        return array[i]
+
+    def visit_INT(self,node):
+        return wrap(node[1])
+
+    def visit_CHAR(self,node):
+        return CharValue(ord(node[1]))
+
+    def visit_STRING(self,node):
+        return StringValue(map(ord,node[1]))
+
+    def visit_ARRAY_CONS(self,node):
+        values = [self.visit(e) for e in node[1]]
+        if isinstance(values[0],CharValue):
+            return ByteArray(v & 0xff for v in values)
+        return values
+
+    def visit_ARRAY_INIT(self,node):
+        return ByteArray() if node[1][1] == ['char'] else []
+
+    def visit_NEG(self,node):
+        value = self.visit(node[1])
+        return value.__class__(wrap(-value))
+
+    def visit_ARITH(self,node):
+        a,b = self.visit(node[2]),self.visit(node[3])
+        op = node[1]
+        if op == 'add':
+            value = a + b
+        elif op == 'sub':
+            value = a - b
+        elif op == 'mul':
+            value = a * b
+        else:
+            value = evaluator.div(a,b)
+        return a.__class__(wrap(value))
+
+    def visit_RELOP(self,node):
+        a,b = self.visit(node[2]),self.visit(node[3])
+        return int({'lt':a < b,'gt':a > b,'le':a <= b,'ge':a >= b}[node[1]])
+
+def bench_run(size=200):
+    from cStringIO import StringIO
+    text = RUN_PROGRAM % {'zeros':','.join(['0']*size),'size':size,'last':size-1}
+    path = write_temp(text)
+    try:
+        ast = SofortParser(make_scanner(open(path,'rb'),'table')).Top()
+    finally:
+        os.unlink(path)
+    def walk():
+        out = StringIO()
+        TreeWalker(out).run(ast)
+        return out.getvalue()
+    def closures(program,out):
+        out.reset()
+        out.truncate()
+        program()
+        return out.getvalue()
+    out = StringIO()
+    t_compile,program = best_of(3,evaluator.compile_program,ast,out)
+    t_run,result = best_of(3,closures,program,out)
+    t_walk,expected = best_of(3,walk)
+    if result != expected:
+        print 'outputs differ'
+        sys.exit(1)
+    print 'bubble sort of %d ints, %d comparisons' % (size,size*(size-1)/2)
+    print 'tree walker %8.3fs' % t_walk
+    print 'closures    %8.3fs  (compile %.4fs)  x%.1f' % (t_run,t_compile,t_walk/t_run)
+
+def bench_jit(count=200):
+    import subprocess
+    from emitter64 import Emitter64
+    import jit
+    emitter_class = {4:Emitter,8:Emitter64}.get(jit.host_word())
+    if emitter_class is None:
+        print 'jit needs an x86 host'
+        return
+    snippets = [open(name,'rb').read() for name in SAMPLES]
+    def generate(text):
+        path = write_temp(text)
+        try:
+            parser = Parser(make_scanner(open(path,'rb'),'char'),emitter_class)
+            parser.Top()
+        finally:
+            os.unlink(path)
+        return parser.emitter
+    # The programs print to the C stdout
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull,os.O_WRONLY)
+    os.dup2(devnull,1)
+    try:
+        emitters = [generate(snippets[i % len(snippets)]) for i in range(count)]
+        start = time.time()
+        for e in emitters:
+            jit.run(e)
+        t_jit = time.time() - start
+        tmp = tempfile.mkdtemp()
+        runs = max(count/20,1)
+        start = time.time()
+        for e in emitters[:runs]:
+            asm,binary = os.path.join(tmp,'p.s'),os.path.join(tmp,'p')
+            e.flush(open(asm,'wb'))
+            subprocess.check_call(['gcc','-o',binary,asm] + e.link_flags)
+            subprocess.call([binary],stdout=devnull)
+        t_gcc = (time.time() - start) / runs
+        for name in os.listdir(tmp):
+            os.unlink(os.path.join(tmp,name))
+        os.rmdir(tmp)
+    finally:
+        os.dup2(saved,1)
+        os.close(saved)
+        os.close(devnull)
+    print '%d programs' % count
+    print 'jit      %8.1f programs/s' % (count/t_jit)
+    print 'gcc+exec %8.1f programs/s  x%.0f' % (1/t_gcc,count/t_jit*t_gcc)
+
+APPEND_PROGRAM = '''
+a = %(init)s
+i = 0
+while i < %(count)d {
+    %(body)s
+    i = i + 1
+}
+print a[%(last)d]
+'''
+
+def jit_seconds(source,emitter_class):
+    ''' Seconds source takes to run with the jit, its output discarded '''
+    import jit
+    path = write_temp(source)
+    try:
+        parser = Parser(make_scanner(open(path,'rb'),'char'),emitter_class)
+        parser.Top()
+    finally:
+        os.unlink(path)
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull,os.O_WRONLY)
+    os.dup2(devnull,1)
+    try:
+        start = time.time()
+        jit.run(parser.emitter)
+        return time.time() - start
+    finally:
+        os.dup2(saved,1)
+        os.close(saved)
+        os.close(devnull)
+
+def jit_emitter():
+    ''' The emitter class of the host, None if the jit cannot run here '''
+    from emitter64 import Emitter64
+    import jit
+    return {4:Emitter,8:Emitter64}.get(jit.host_word())
+
+def bench_append(count=4000000):
+    ''' Appending count ints to an empty array, run with the jit, against
+        the same loop storing to a fixed element
+    '''
+    emitter_class = jit_emitter()
+    if emitter_class is None:
+        print 'append needs an x86 host'
+        return
+    def run(n,init,body,last):
+        return jit_seconds(APPEND_PROGRAM % {'count':n,'init':init,'body':body,
+            'last':last},emitter_class)
+    print '%10s %10s %10s %12s' % ('appends','append s','store s','ns/append')
+    for n in (count/4,count/2,count):
+        t_append = min(run(n,'[]int','append a, i',n-1) for i in range(3))
+        t_store = min(run(n,'[0]','a[0] = i',0) for i in range(3))
+        print '%10d %10.3f %10.3f %12.1f' % (n,t_append,t_store,(t_append-t_store)*1e9/n)
+
+PRINT_PROGRAM = '''
+s = "print me, a string of some forty letters"
+c = 'c'
+i = 0
+while i < %(count)d {
+    %(body)s
+    i = i + 1
+}
+'''
+
+def bench_print(count=2000000):
+    ''' Printing count ints, chars and strings, run with the jit and written
+        to /dev/null, against the loop without the print
+    '''
+    emitter_class = jit_emitter()
+    if emitter_class is None:
+        print 'print needs an x86 host'
+        return
+    def run(body):
+        return min(jit_seconds(PRINT_PROGRAM % {'count':count,'body':body},emitter_class)
+            for i in range(3))
+    t_loop = run('s[0] = c')
+    print '%-8s %10s %10s' % ('print','s','ns/print')
+    for kind,body in (('int','print i - 1000000'),('char','print c'),('string','print s')):
+        t = run(body)
+        print '%-8s %10.3f %10.1f' % (kind,t,(t-t_loop)*1e9/count)
+
+ALLOC_PROGRAM = '''
+t = 0
+keep = [0]
+i = 0
+while i < %(count)d {
+    %(body)s
+    i = i + 1
+}
+print t
+print keep[0]
+'''
+
+def bench_alloc(count=4000000):
+    ''' Allocating count arrays of three ints in a loop, run with the jit,
+        against the loop without them: arrays local to the loop body go to
+        the scope arena, the ones kept past an iteration to the program arena
+    '''
+    emitter_class = jit_emitter()
+    if emitter_class is None:
+        print 'alloc needs an x86 host'
+        return
+    def run(*body):
+        return min(jit_seconds(ALLOC_PROGRAM % {'count':count,'body':'\n    '.join(body)},
+            emitter_class) for i in range(3))
+    t_loop = run('t = t + i')
+    print '%-8s %10s %10s' % ('arrays','s','ns/array')
+    for kind,body in (('local',('a = [i,i,i]','t = t + a[1]')),
+            ('kept',('a = [i,i,i]','t = t + a[1]','keep = a'))):
+        t = run(*body)
+        print '%-8s %10.3f %10.1f' % (kind,t,(t-t_loop)*1e9/count)
+
+# Statement nodes of the AST, for statements/s
+STATEMENTS = ('DECLARE','ASSIGN','PRINT','IF','IFELSE','WHILE','APPEND')
+
+def max_rss():
+    ''' Peak resident size of this process in KB (on Linux) '''
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(func,*args):
+    ''' best_of(3) and the KB the peak resident size grew by '''
+    base = max_rss()
+    elapsed,result = best_of(3,func,*args)
+    return elapsed,result,max_rss() - base
+
+def in_child(func,*args):
+    ''' func(*args) in a forked process, so that each phase starts from the
+        same heap and its peak memory is its own
+    '''
+    import cPickle
+    read,write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        status = 1
+        try:
+            data = cPickle.dumps(func(*args),2)
+            while data:
+                data = data[os.write(write,data):]
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read,65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid,0)
+    if not chunks:
+        raise RuntimeError('benchmark of %s failed' % func.__name__)
+    return cPickle.loads(''.join(chunks))
+
+def phase_scan(path):
+    elapsed,tokens,peak = measure(count_tokens,path,'char')
+    return elapsed,peak,{'tokens':tokens}
+
+def phase_parse(path):
+    parse = lambda: SofortParser(make_scanner(open(path,'rb'),'char')).Top()
+    elapsed,ast,peak = measure(parse)
+    counts = {}
+    count_tuple_kinds(ast,counts)
+    return elapsed,peak,{'stmts':sum(counts.get(kind,0) for kind in STATEMENTS),
+        'nodes':sum(counts.values())}
+
+def generate_i386(path):
+    parser = Parser(make_scanner(open(path,'rb'),'char'),Emitter)
+    parser.Top()
+    return parser.emitter
+
+def phase_codegen(path):
+    elapsed,emitter,peak = measure(generate_i386,path)
+    return elapsed,peak,{'asm_lines':len(emitter.buffer)}
+
+def phase_flush(path):
+    emitter = generate_i386(path)
+    out = open(os.devnull,'wb')
+    elapsed,_,peak = measure(emitter.flush,out)
+    out.close()
+    return elapsed,peak,{}
+
+# Code generation scans and parses too, it is a single pass
+PHASES = [
+    ('scan',phase_scan,'tokens'),
+    ('parse',phase_parse,'stmts'),
+    ('codegen',phase_codegen,'stmts'),
+    ('flush',phase_flush,'asm_lines'),
+]
+
+def scaling(rows,phase,count):
+    ''' Exponent k of time ~ n**k between the smallest and largest program '''
+    import math
+    first,last = rows[0],rows[-1]
+    if not first[phase]['seconds'] or first[count] == last[count]:
+        return None
+    return math.log(last[phase]['seconds'] / first[phase]['seconds']) / \
+        math.log(float(last[count]) / first[count])
+
+def bench_suite(size=100,output=None):
+    import platform
+    import progen
+    sizes = [size,size*2,size*4,size*8]
+    results,exponents = [],{}
+    print '%-8s %6s %7s %12s %12s %8s %12s %8s %12s' % ('shape','stmts','tokens',
+        'scan tok/s','parse stm/s','KB','codegen st/s','KB','flush ln/s')
+    for shape in progen.SHAPES:
+        rows = []
+        for n in sizes:
+            text = progen.generate(shape,n)
+            path = write_temp(text)
+            try:
+                row = {'shape':shape,'size':n,'bytes':len(text)}
+                for phase,func,count in PHASES:
+                    elapsed,peak,counts = in_child(func,path)
+                    row[phase] = {'seconds':elapsed,'peak_kb':peak}
+                    row.update(counts)
+            finally:
+                os.unlink(path)
+            rate = lambda phase,count: row[count] / max(row[phase]['seconds'],1e-9)
+            print '%-8s %6d %7d %12.0f %12.0f %8d %12.0f %8d %12.0f' % (shape,row['stmts'],
+                row['tokens'],rate('scan','tokens'),rate('parse','stmts'),row['parse']['peak_kb'],
+                rate('codegen','stmts'),row['codegen']['peak_kb'],rate('flush','asm_lines'))
+            rows.append(row)
+        exponents[shape] = dict((phase,scaling(rows,phase,count)) for phase,func,count in PHASES)
+        print '%-8s scaling %s' % ('',' '.join('%s n^%s' % (phase,
+            '-' if exponents[shape][phase] is None else '%.2f' % exponents[shape][phase])
+            for phase,func,count in PHASES))
+        results.extend(rows)
+    if output:
+        json.dump({'python':platform.python_version(),'machine':platform.machine(),
+            'date':time.strftime('%Y-%m-%d %H:%M:%S'),'size':size,
+            'results':results,'scaling':exponents},open(output,'w'),indent=1,sort_keys=True)
+        print 'results in %s' % output
+
+def bench_compare(old,new,percent=10):
+    ''' Phase times of two suite results, exit status 1 if one got slower by
+        more than percent
+    '''
+    old,new = json.load(open(old)),json.load(open(new))
+    before = dict(((r['shape'],r['size']),r) for r in old['results'])
+    slower = 0
+    for row in new['results']:
+        base = before.get((row['shape'],row['size']))
+        if base is None:
+            continue
+        cells = []
+        for phase,func,count in PHASES:
+            ratio = row[phase]['seconds'] / max(base[phase]['seconds'],1e-9)
+            mark = ' '
+            if ratio > 1 + percent / 100.0:
+                mark = '!'
+                slower += 1
+            cells.append('%s %5.2fx%s' % (phase,ratio,mark))
+        print '%-8s %6d  %s' % (row['shape'],row['size'],'  '.join(cells))
+    print '%d phase times slower by more than %d%%' % (slower,percent)
+    if slower:
+        sys.exit(1)
+
+BENCHMARKS = {
+    'scanner' : bench_scanner,
+    'incremental' : bench_incremental,
+    'ast' : bench_ast,
+    'run' : bench_run,
+    'jit' : bench_jit,
+    'append' : bench_append,
+    'print' : bench_print,
+    'alloc' : bench_alloc,
+    'suite' : bench_suite,
+    'compare' : bench_compare,
+}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print 'usage: bench.py %s [args]' % '|'.join(sorted(BENCHMARKS))
+        sys.exit(1)
+    args = [int(a) if a.isdigit() else a for a in sys.argv[2:]]
+    BENCHMARKS[sys.argv[1]](*args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+''' Content-addressed cache of compiler outputs, for compiler.py --cache DIR.
+
+An entry is keyed by a hash of the source bytes, the compiler version and
+the options that change the generated code; the compiler version is a hash
+of the compiler's own modules, so any change to them starts over. Each
+kind of output (assembly, object, executable) is a file of its own:
+
+    DIR/objects/ab/abcdef....s
+    DIR/objects/ab/abcdef....o
+    DIR/objects/ab/abcdef....bin
+
+Files are written to a temporary name in the same directory and renamed
+into place, so several build processes can share a cache and a reader
+never sees a partial file. A hit touches the file, and when the cache
+grows past its limit the files used least recently are removed.
+
+Keys are hashes, so the files spread evenly over the 256 directories. A put
+only sizes up the directory it wrote to and scales that to the whole cache;
+the whole cache is listed only when that estimate is past the limit.
+
+Hits, misses and evictions are appended to DIR/stats, one byte each, which
+O_APPEND keeps consistent between processes. Once the log reaches
+STATS_LOG_LIMIT bytes it is folded into the counts in DIR/totals.
+'''
+import hashlib
+import os
+import tempfile
+import time
+
+DEFAULT_LIMIT = 256 << 20
+
+# Temporary files older than this were left by a process that died
+STALE_TEMP = 3600
+
+# Directories of objects/, one for each first two hex digits of a key
+DIRECTORIES = 256
+
+STATS_LOG_LIMIT = 64 << 10
+
+HIT,MISS,EVICTION = 'h','m','e'
+
+def compiler_version():
+    ''' Hash of the compiler's sources '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(here)):
+        if name.endswith('.py'):
+            h.update(name)
+            h.update(open(os.path.join(here,name),'rb').read())
+    return h.hexdigest()
+
+VERSION = compiler_version()
+
+
+class Cache:
+
+    def __init__(self,root,limit=DEFAULT_LIMIT):
+        self.root = root
+        self.limit = limit
+        self.objects = os.path.join(root,'objects')
+        if not os.path.isdir(self.objects):
+            try:
+                os.makedirs(self.objects)
+            except OSError:
+                if not os.path.isdir(self.objects):
+                    raise
+
+    def key(self,source,options):
+        ''' Key of source compiled with options, a dict of plain values '''
+        h = hashlib.sha256()
+        h.update(VERSION)
+        h.update(repr(sorted(options.items())))
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self,key,kind):
+        return os.path.join(self.objects,key[:2],'%s.%s' % (key,kind))
+
+    def get(self,key,kind):
+        ''' (data,mode) of the cached output, None if there is none '''
+        path = self.path(key,kind)
+        try:
+            f = open(path,'rb')
+        except IOError:
+            return None
+        try:
+            os.utime(path,None) # most recently used
+        except OSError:
+            pass # evicted meanwhile, the open file is still good
+        mode = os.fstat(f.fileno()).st_mode & 0777
+        data = f.read()
+        f.close()
+        return data,mode
+
+    def put(self,key,kind,data,mode=0644):
+        directory = os.path.dirname(self.path(key,kind))
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                pass
+        fd,temp = tempfile.mkstemp(prefix='.tmp',dir=directory)
+        try:
+            os.write(fd,data)
+            os.fchmod(fd,mode)
+        finally:
+            os.close(fd)
+        os.rename(temp,self.path(key,kind))
+        if self.estimate(directory) > self.limit:
+            self.evict()
+
+    def put_file(self,key,kind,path):
+        ''' Store a copy of a file, keeping its permissions '''
+        self.put(key,kind,open(path,'rb').read(),os.stat(path).st_mode & 0777)
+
+    def entries(self):
+        ''' (mtime,size,path) of every cached file '''
+        entries = []
+        for directory in os.listdir(self.objects):
+            entries.extend(self.directory_entries(os.path.join(self.objects,directory)))
+        return entries
+
+    def directory_entries(self,directory):
+        entries = []
+        now = time.time()
+        for name in os.listdir(directory):
+            path = os.path.join(directory,name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # evicted meanwhile
+            if name.startswith('.tmp'):
+                if now - st.st_mtime > STALE_TEMP:
+                    self.remove(path)
+                continue
+            entries.append((st.st_mtime,st.st_size,path))
+        return entries
+
+    def estimate(self,directory):
+        ''' Size of the cache guessed from the size of one of its directories '''
+        return DIRECTORIES * sum(size for mtime,size,path in self.directory_entries(directory))
+
+    def evict(self):
+        ''' Remove least recently used files until the cache fits its limit '''
+        entries = self.entries()
+        total = sum(size for mtime,size,path in entries)
+        if total <= self.limit:
+            return
+        entries.sort()
+        for mtime,size,path in entries:
+            if total <= self.limit:
+                break
+            if self.remove(path):
+                self.record(EVICTION)
+            total -= size
+
+    def remove(self,path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False # another process was first
+
+    def record(self,event):
+        fd = os.open(os.path.join(self.root,'stats'),os.O_WRONLY | os.O_APPEND | os.O_CREAT,0644)
+        try:
+            os.write(fd,event)
+            full = os.fstat(fd).st_size >= STATS_LOG_LIMIT
+        finally:
+            os.close(fd)
+        if full:
+            self.compact()
+
+    def compact(self):
+        ''' Fold the stats log into the totals. The log is renamed first,
+            so only one process folds it; events another process appends to
+            it meanwhile may be lost, they are statistics.
+        '''
+        log = os.path.join(self.root,'.stats%d' % os.getpid())
+        try:
+            os.rename(os.path.join(self.root,'stats'),log)
+        except OSError:
+            return # another process was first
+        counts = self.totals()
+        events = open(log,'rb').read()
+        for event in counts:
+            counts[event] += events.count(event)
+        fd,temp = tempfile.mkstemp(prefix='.tmp',dir=self.root)
+        try:
+            os.write(fd,' '.join('%s%d' % item for item in sorted(counts.items())))
+        finally:
+            os.close(fd)
+        os.rename(temp,os.path.join(self.root,'totals'))
+        os.unlink(log)
+
+    def totals(self):
+        ''' Events counted by compact(), as {event:count} '''
+        counts = dict.fromkeys((HIT,MISS,EVICTION),0)
+        try:
+            fields = open(os.path.join(self.root,'totals'),'rb').read().split()
+        except IOError:
+            fields = []
+        for field in fields:
+            counts[field[0]] = int(field[1:])
+        return counts
+
+    def stats(self):
+        try:
+            log = open(os.path.join(self.root,'stats'),'rb').read()
+        except IOError:
+            log = ''
+        counts = self.totals()
+        entries = self.entries()
+        return {
+            'hits' : counts[HIT] + log.count(HIT),
+            'misses' : counts[MISS] + log.count(MISS),
+            'evictions' : counts[EVICTION] + log.count(EVICTION),
+            'entries' : len(entries),
+            'bytes' : sum(size for mtime,size,path in entries),
+            'limit' : self.limit,
+        }
+
+    def report(self,file):
+        s = self.stats()
+        lookups = s['hits'] + s['misses']
+        s['rate'] = 100.0 * s['hits'] / lookups if lookups else 0.0
+        s['kb'],s['limit_kb'] = s['bytes'] >> 10,s['limit'] >> 10
+        print >> file, ('cache: %(hits)d hits, %(misses)d misses (%(rate).1f%% hit rate), '
+            '%(evictions)d evictions, %(entries)d files, %(kb)d KB of %(limit_kb)d KB' % s)
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import sys
+import os
 from StringIO import StringIO
 from os.path import basename
 import re
-from subprocess import check_call
+from subprocess import call
 
 from emitter import *
 from scanner import *
 from sofortTypes import *
+from instrument import Profile, NOT_PROFILED, asm_counts, count_nodes, ir_variables
+from escape import Escapes
 
 
 class LocalVar:
@@ -37,6 +40,12 @@ class Locals:
         self.vars[var.name] = var
         var.stack_index = self.stack_size
         self.stack_size += var.type.stack_size
+
+    def reserve(self,size):
+        ''' Stack slots of no variable, returns the index of the first '''
+        index = self.stack_size
+        self.stack_size += size
+        return index
         
     def __getitem__(self,name):
         return self.vars[name]
@@ -49,16 +58,33 @@ OPS = {
     '*' : 'mul',
 }
 
-RELOPS = {
-    '<' : 'lt',
-    '>' : 'gt',
-    '<=' : 'le',
-    '>=' : 'ge',
-    '==' : 'eq',
-    '!=' : 'ne',
+def div_int(a,b):
+    ''' Quotient as computed by idivl, None where idivl would trap '''
+    if b == 0 or b == -1 and a == INT_MIN:
+        return None
+    return trunc_div(a,b)
+
+# Compile-time evaluation of operations on constants
+FOLD = {
+    'add' : lambda a,b: wrap(a+b),
+    'sub' : lambda a,b: wrap(a-b),
+    'mul' : lambda a,b: wrap(a*b),
+    'div' : div_int,
+    'lt' : lambda a,b: int(a < b),
+    'gt' : lambda a,b: int(a > b),
+    'le' : lambda a,b: int(a <= b),
+    'ge' : lambda a,b: int(a >= b),
 }
 
-PRIMITIVE_TYPES = set(['int','char','string'])
+# Operation with the operands swapped, for a constant on the left
+SWAPPED = {
+    'add' : 'add',
+    'mul' : 'mul',
+    'lt' : 'gt',
+    'gt' : 'lt',
+    'le' : 'ge',
+    'ge' : 'le',
+}
 
 class Location:
 
@@ -68,11 +94,26 @@ class Location:
 
 class Parser:
 
-    def __init__(self,scanner):
+    def __init__(self,scanner,emitter=Emitter,alloc_stats=False):
         self.scanner = scanner
+        self.Emitter = emitter # the target's code generator
+        set_word(emitter.word)
         self.next()
         self.stack = []
         self.emitter_stack = []
+        self.consts = {} # locals known to hold a constant
+        self.lengths = {} # array locals of a known length
+        self.source = None # literal or variable a string expression comes from
+        self.literals = [] # (variable,load,block) for string literals assigned
+        self.aliases = {} # string variables that may share a string
+        self.modified = set() # string variables written to
+        self.appends = Appends()
+        self.fresh = False # the last array expression is a new array
+        self.append_sizes = set() # element sizes of the arrays appended to
+        self.escapes = Escapes()
+        self.site = None # allocation of the last array constructor
+        self.printing = False
+        self.alloc_stats = alloc_stats # the program reports its arenas
         
     def next(self):
         self.token = self.scanner.scan()
@@ -87,65 +128,98 @@ class Parser:
 
     def _Top(self):
         self.push_emitter()
-        self.constants = Constants()
-        program = Emitter()
+        self.constants = self.Emitter.Constants()
+        program = self.Emitter()
         program.begin_prog()
-        self.func = Func('main')
+        self.func = self.Emitter.Func('main')
         self.stack.append(Locals())
-        while self.token is not EOF:
+        while self.token.kind != T_EOF:
+            self.escapes.top_level()
             self.Statement()
-        if self.token is not EOF:
+        if self.token.kind != T_EOF:
             raise ParserException('EOF')
-        del self.stack[-1]
+        self.locals = self.stack.pop()
+        modified = set(self.find(name) for name in self.modified)
+        for name,load,block in self.literals:
+            # Copy the literal before anything may write to it
+            load.writable = self.find(name) in modified
+            if load.writable:
+                load.site = self.escapes.site(block)
+                load.site.name = name
+        for block in self.escapes.resolve(self.appends.appended):
+            block.index = self.locals.reserve(ARENA_MARK)
+        self.func.set_stack(self.Emitter.word*self.locals.stack_size)
+        if self.alloc_stats:
+            self.emitter.call('arena_report',0)
+        self.emitter.resolve()
         program.emit_block(self.constants.block())
         program.emit_block(self.func.block(self.emitter.buffer)) 
+        for size in sorted(self.append_sizes):
+            program.emit_append_runtime(size)
+        if self.alloc_stats or any(site.arena for site in self.escapes.sites):
+            program.emit_arena_runtime(self.alloc_stats)
         self.emitter = program
         
-    def match(self,tok):
-        if self.token == tok:
+    def match(self,kind):
+        if self.token.kind == kind:
             self.next()
             return True
         return False
         
-    def expect(self,tok):
-        if self.token != tok:
-            raise ParserException('Expected "%s"'%tok,*self.scanner.pos())
+    def expect(self,kind):
+        if self.token.kind != kind:
+            raise ParserException('Expected "%s"'%KIND_NAME[kind],*self.scanner.pos())
         return self.next()
         
     def Statement(self):
-        if isinstance(self.token,Ident):
+        kind = self.token.kind
+        if kind == T_IDENT:
             self.Assignment()
-        elif self.token == 'print':
+        elif kind == T_PRINT:
             self.Print()
-        elif self.token == 'if':
+        elif kind == T_APPEND:
+            self.Append()
+        elif kind == T_IF:
             self.If()
-        elif self.token == 'while':
+        elif kind == T_WHILE:
             self.While()
-        elif self.token == '{':
+        elif kind == T_LBRACE:
             self.Block()
         else:
             raise ParserException('Expected statement',*self.scanner.pos())
 
     def While(self):
         self.next()
+        # The body may assign any variable before the condition is evaluated again
+        self.forget()
         label_loop = self.emitter.new_label()
         self.emitter.label(label_loop)
         label_exit = self.emitter.new_label()
-        self.Expression()
+        self.materialize(self.Expression())
         self.emitter.jump_if_false(label_exit)
+        self.escapes.nested()
         self.Statement()
         self.emitter.jump(label_loop)
         self.emitter.label(label_exit)
+        self.forget()
         
     def Block(self):
         self.next()
-        while not self.match('}'):
+        block = self.escapes.enter()
+        self.emitter.begin_scope(block)
+        while not self.match(T_RBRACE):
+            self.escapes.top_level()
             self.Statement()
+        self.emitter.end_scope(block)
+        self.escapes.leave()
 
     def Print(self):
         #assert self.token.name == 'print'
         self.next()
-        type = self.Expression()
+        # A string loaded to be printed does not escape
+        self.printing = True
+        type = self.materialize(self.Expression())
+        self.printing = False
         if isinstance(type,Int):
             self.emitter.print_int()
         elif isinstance(type,Char):
@@ -155,20 +229,58 @@ class Parser:
             self.emitter.print_string()
         else:
             raise ParserException('Unsupported type',*self.scanner.pos())
+
+    def Append(self):
+        ''' append a, <Expr> adds an element at the end of array a '''
+        self.next()
+        id = self.token.value
+        self.expect(T_IDENT)
+        var = self.get_var(id)
+        type = var.type
+        if not isinstance(type,DynamicArray) or isinstance(type,String):
+            raise ParserException('Cannot append to %s' % type,*self.scanner.pos())
+        self.appends.append(id,*self.scanner.pos())
+        self.expect(T_COMMA)
+        rtype = self.materialize(self.Expression())
+        if not type.subtype.typeof(rtype):
+            raise ParserException('Illegal append of %s to %s' % (rtype,type),*self.scanner.pos())
+        rtype.push(self.emitter)
+        var.load(self.emitter)
+        type.append(self.emitter)
+        var.store(self.emitter)
+        self.append_sizes.add(type.subtype.sizeof)
+        if id in self.lengths:
+            self.lengths[id] += 1
             
     def If(self):
         self.next()
-        self.Expression()
+        self.materialize(self.Expression())
         label1 = self.emitter.new_label()
         self.emitter.jump_if_false(label1)
+        known = dict(self.consts),dict(self.lengths)
+        self.escapes.nested()
         self.Statement()       
-        if self.match('else'):
+        if self.match(T_ELSE):
             label2 = self.emitter.new_label()
             self.emitter.jump(label2)
             self.emitter.label(label1)
+            known,(self.consts,self.lengths) = (self.consts,self.lengths),known
+            self.escapes.nested()
             self.Statement()
             label1 = label2 # emit label2 below instead of label1
         self.emitter.label(label1)
+        self.merge_known(known)
+
+    def merge_known(self,other):
+        ''' Keep the facts both paths into a label agree on '''
+        for mine,theirs in zip((self.consts,self.lengths),other):
+            for name,value in mine.items():
+                if theirs.get(name) != value:
+                    del mine[name]
+
+    def forget(self):
+        self.consts.clear()
+        self.lengths.clear()
         
     def Assignment(self):
         ''' Assignment acts as both declaration and ordinary assignment.
@@ -178,36 +290,65 @@ class Parser:
         '''
         id,location = self.Lvalue()
         locals = self.stack[-1]
-        self.expect('=')
-        rtype = self.Expression()
+        self.expect(T_ASSIGN)
+        if isinstance(location,Location):
+            # The element's address is in the pointer register already
+            self.push_emitter()
+            rtype = self.element(self.Expression())
+            self.emit_keeping_pointer(self.pop_emitter())
+        else:
+            self.source = None
+            self.fresh = False
+            rtype = self.Expression()
+            if isinstance(rtype,Array) and not self.fresh:
+                self.appends.share(id,*self.scanner.pos())
+            elif isinstance(rtype,Array):
+                self.site.name = id
         if not location:
-            var = LocalVar(id,rtype)
+            self.escapes.declare(id)
+            var = LocalVar(id,rtype.runtime())
             locals.add(var)
-            self.func.set_stack(WORD*locals.stack_size)
+            self.func.set_stack(self.Emitter.word*locals.stack_size)
             location = var
         else:
             if not location.type.typeof(rtype):
                 raise ParserException('Illegal assignment of %s to variable %s' % (str(rtype),str(ltype)))
                 # The type of a variable may change in the future
         # when a constant is promoted to non constant value.
+        if isinstance(location,LocalVar):
+            if rtype.const is not None:
+                # Known until the next assignment
+                self.consts[id] = rtype.const
+                self.emitter.store_imm_var_int(location.stack_index,rtype.const)
+                return
+            self.consts.pop(id,None)
+            if isinstance(rtype,String):
+                if isinstance(self.source,ConstLoad):
+                    self.literals.append((id,self.source,self.escapes.block))
+                elif self.source:
+                    self.alias(id,self.source)
+            # Only a new array or a literal is known to be that long
+            length = getattr(rtype,'length',None)
+            if length is not None and (self.fresh or isinstance(self.source,ConstLoad)):
+                self.lengths[id] = length
+            else:
+                self.lengths.pop(id,None)
+        self.materialize(rtype)
         location.store(self.emitter) #self.emitter.store_var_int(locals[id])
 
     def Lvalue(self):
         id = self.token.value
         self.next()
-        if self.match('['):
+        if self.match(T_LBRACKET):
             var = self.get_var(id)
-            self.assert_typeof(var.type,Array)
-            var.load(self.emitter)
-            index_type = self.Expression()
-            self.assert_typeof(index_type,Int,'Array index must be int')
-            self.expect(']')
-            var.type.add_offset(self.emitter)
-            location = Location(var.type.subtype,var.type.store_at)
-            return id,location
+            self.modified.add(id)
+            index = self.Element(var)
+            store = lambda emitter: var.type.store_at(emitter,index)
+            return id,Location(var.type.subtype,store)
         locals = self.stack[-1]
         var = locals.get(id)
         if var:
+            self.escapes.use(id)
             return id,var
         return id,None
             
@@ -223,155 +364,236 @@ class Parser:
     def RelationalExpression(self):
         left = self.ArithmeticExpression()
         while True:
-            op = RELOPS.get(self.token,None)
+            op = RELOPS.get(self.token.kind,None)
             if not op:
                 break
-            left.push(self.emitter)
             self.next()
-            right = self.ArithmeticExpression()
-            self.check_op(left,right,op)
-            self.do_operation(right,op)
-            left = left.union(right)
+            left = self.BinaryOperation(left,op,self.ArithmeticExpression)
         return left
         
         
     def ArithmeticExpression(self):
         left_type = self.Product()
         while True:
-            if self.token == '+':
+            kind = self.token.kind
+            if kind == T_PLUS:
                 op = 'add'
-            elif self.token == '-':
+            elif kind == T_MINUS:
                 op = 'sub'
             else:
                 break
-            left_type.push(self.emitter)
             self.next()
-            right_type = self.Product()
-            self.check_op(left_type,right_type,op)
-            self.do_operation(right_type,op)
-            left_type = left_type.union(right_type)
+            left_type = self.BinaryOperation(left_type,op,self.Product)
         return left_type
             
     def Product(self):
         left_type = self.Factor()
         while True:
-            if self.token == '*':
+            kind = self.token.kind
+            if kind == T_STAR:
                 op = 'mul'
-            elif self.token == '/':
+            elif kind == T_SLASH:
                 op = 'div'
             else:
                 break
-            left_type.push(self.emitter)
             self.next()
-            right_type = self.Factor()
-            self.check_op(left_type,right_type,op)
-            self.do_operation(right_type,op)
-            left_type = left_type.union(right_type)
+            left_type = self.BinaryOperation(left_type,op,self.Factor)
         return left_type
 
+    def BinaryOperation(self,left,op,operand):
+        ''' Compile left <op> operand(). Constant operands are folded or
+            become immediates, only values computed at run time are pushed.
+        '''
+        self.push_emitter()
+        right = operand()
+        right_code = self.pop_emitter()
+        self.check_op(left,right,op)
+        type = left.union(right)
+        if left.const is not None and right.const is not None:
+            value = FOLD[op](left.const,right.const)
+            if value is not None:
+                return type.constant(value)
+        if right.const is not None:
+            self.materialize(left)
+            self.do_operation(type,op+'_imm',right.const)
+        elif left.const is not None and op in SWAPPED:
+            self.emitter.emit_block(right_code.buffer)
+            self.do_operation(type,SWAPPED[op]+'_imm',left.const)
+        else:
+            if left.const is not None:
+                self.emitter.push_imm_int(left.const)
+            else:
+                left.push(self.emitter)
+            self.emitter.emit_block(right_code.buffer)
+            self.do_operation(right,op)
+        return type.runtime()
+
     def Factor(self):
-        if self.match('-'):  # unary minus
+        if self.match(T_MINUS):  # unary minus
             type = self.UnaryExpression()
+            if type.const is not None and type.get_operation('neg'):
+                return type.constant(wrap(-type.const))
             self.do_operation(type,'neg')
         else:
             type = self.UnaryExpression()
         return type
             
     def UnaryExpression(self):
-        if isinstance(self.token,Ident):
+        kind = self.token.kind
+        if kind == T_IDENT:
             return self.VarOrFunc()
-        elif isinstance(self.token,int):
-            type = Int()
-            type.load_literal(self.emitter,self.token) #self.emitter.load_imm_int(self.token)
+        elif kind == T_INT:
+            # Loaded only when needed, see materialize()
+            type = Int().constant(wrap(self.token.value))
             self.next()
             return type
-        elif isinstance(self.token,CharLiteral):
-            type = Char()
-            type.load_literal(self.emitter,self.token.value)
+        elif kind == T_CHAR:
+            type = Char().constant(ord(self.token.value))
             self.next()
             return type
-        elif isinstance(self.token,StringLiteral):
+        elif kind == T_STRING:
             type = String()
-            type.load_literal(self.emitter,self.token.value)
+            self.source = type.load_literal(self.emitter,self.token.value,self.constants)
             self.next()
             return type
-        elif self.match('('):
+        elif self.match(T_LPAREN):
             type = self.Expression()
-            self.expect(')')
+            self.expect(T_RPAREN)
             return type
-        elif self.match('['):
+        elif self.match(T_LBRACKET):
             return self.ArrayConstructor()
         else:
             raise ParserException('Unexpected token %s' % str(self.token))
 
     def VarOrFunc(self):
             var = self.get_var(self.token.value)
-            var.load(self.emitter)
             self.next()
-            if self.match('['): # array element
-                type = self.Expression()
-                array = var.type
-                if not type.typeof(Int()):
-                    raise ParserExpression('Array index must be int',*self.scanner.pos())
-                array.add_offset(self.emitter)
-                array.load_at(self.emitter)
-                self.expect(']')
-                return array.subtype
+            if var.name in self.consts:
+                return var.type.constant(self.consts[var.name])
+            if self.match(T_LBRACKET): # array element
+                index = self.Element(var)
+                var.type.load_at(self.emitter,index)
+                return var.type.subtype
+            var.load(self.emitter)
+            self.source = var.name
+            if isinstance(var.type,Array):
+                self.appends.share(var.name,*self.scanner.pos())
+                if not self.printing:
+                    self.escapes.escape(var.name)
             return var.type
+
+    def Element(self,var):
+        ''' Compile the index of var[<Expr>] and leave the array in the pointer
+            register. Returns the element's index relative to the pointer:
+            a constant index into an array of known length needs no check.
+        '''
+        self.assert_typeof(var.type,Array)
+        type = self.Expression()
+        self.assert_typeof(type,Int,'Array index must be int')
+        self.expect(T_RBRACKET)
+        if type.const is not None and 0 <= type.const < self.lengths.get(var.name,0):
+            var.load(self.emitter)
+            return type.const
+        # The index is computed first, it may use the pointer register itself
+        self.materialize(type)
+        var.load(self.emitter)
+        var.type.add_offset(self.emitter)
+        return 0
         
             
     def ArrayConstructor(self):
-        if self.match(']'):
+        if self.match(T_RBRACKET):
             # Zero-length array
             # Still a small space is allocated in case of further expansion.
             arr_subtype = self.Type()
             array_type = DynamicArray(arr_subtype)
-            array_type.alloc(self.emitter,8) # make space for 8 elements
+            self.site = self.escapes.site()
+            array_type.alloc(self.emitter,8,self.site) # make space for 8 elements
             array_type.set_length(self.emitter,0)
+            self.fresh = True
             return array_type
         self.push_emitter()
-        arr_subtype = self.Expression()
-        # Now we know the array's subtype
-        array_type = DynamicArray(arr_subtype)
+        arr_subtype = self.element(self.Expression())
+        elements = [self.pop_emitter()]
+        # Now we know the array's subtype, not the lengths of its elements
+        array_type = DynamicArray(arr_subtype.runtime())
         type = arr_subtype
-        length = 1
-        array_type.store_at(self.emitter,0)
-        while not self.match(']'):
-            self.expect(',')
+        while not self.match(T_RBRACKET):
+            self.expect(T_COMMA)
             # allow for extra ',' at the end
-            if self.match(']'):
+            if self.match(T_RBRACKET):
                 break;
-            type = self.Expression()
+            self.push_emitter()
+            type = self.element(self.Expression())
+            elements.append(self.pop_emitter())
             if not arr_subtype.typeof(type):
                 raise ParserException('Type mismatch in array constructor:  %s and %s.' % 
                     (arr_type,type))
-            array_type.store_at(self.emitter,length)
-            length += 1
-        array_init = self.pop_emitter()
         # Now we need to load an array
-        array_type.alloc(self.emitter,length)
-        array_type.set_length(self.emitter,length)
-        self.emitter.emit_block(array_init.buffer)
+        self.site = self.escapes.site()
+        array_type.alloc(self.emitter,len(elements),self.site)
+        array_type.set_length(self.emitter,len(elements))
+        for index,element in enumerate(elements):
+            self.emit_keeping_pointer(element)
+            array_type.store_at(self.emitter,index)
+        self.fresh = True
         return array_type
         
     def Type(self):
-        if self.match('int'):
+        if self.token.kind == T_IDENT and self.token.value == 'int':
+            self.next()
             return Int()
         else:
             raise ParserException('Expected type, found %s' % str(self.token),*self.scanner.pos())
         
-    def do_operation(self,type,operation):
+    def materialize(self,type):
+        ''' Load a constant into the accumulator, where run-time code expects it '''
+        if type.const is None:
+            return type
+        type.load_const(self.emitter)
+        return type.runtime()
+
+    def element(self,type):
+        ''' Leave a value to store in an array in the accumulator '''
+        type = self.materialize(type)
+        if isinstance(type,ComplexType):
+            self.emitter.move_acc()
+        return type
+
+    def alias(self,a,b):
+        ''' Strings a and b may be the same object '''
+        a,b = self.find(a),self.find(b)
+        if a != b:
+            self.aliases[a] = b
+
+    def find(self,name):
+        while name in self.aliases:
+            name = self.aliases[name]
+        return name
+
+    def emit_keeping_pointer(self,code):
+        ''' Emit nested code, saving the pointer register if the code loads it '''
+        if code.uses_pointer():
+            self.emitter.push_pointer()
+            self.emitter.emit_block(code.buffer)
+            self.emitter.pop_pointer()
+        else:
+            self.emitter.emit_block(code.buffer)
+
+    def do_operation(self,type,operation,*args):
             op = type.get_operation(operation)
             if op:
-                op(self.emitter)
+                op(self.emitter,*args)
             else:
                 raise ParserException('Operation "%s" not supported by type "%s"' % (operation,type))
             
     def get_var(self,name):
         try:
-            return self.stack[-1][name]
+            var = self.stack[-1][name]
         except KeyError:
             raise ParserException('Unknown variable %s' % name)
+        self.escapes.use(name)
+        return var
     
     def check_op(self,left,right,op):
         if not left.typeof(right):
@@ -379,7 +601,10 @@ class Parser:
             raise ParserException(msg,*self.scanner.pos())
 
     def push_emitter(self):
-        e = Emitter()
+        e = self.Emitter()
+        if self.emitter_stack:
+            # Labels have to stay unique across the nested buffers
+            e.lbl_num = self.emitter.lbl_num
         self.emitter_stack.append(e)
         self.emitter = e
 
@@ -387,42 +612,268 @@ class Parser:
         e = self.emitter
         del self.emitter_stack[-1]
         self.emitter = self.emitter_stack[-1]
+        self.emitter.lbl_num = e.lbl_num
         return e
         
 def outputfiles(fname):
     fname = basename(fname)
     base = re.sub('.sofort$','',fname)
-    return base + '.s',base
+    return base + '.s',base + '.o',base
 
-def do_gcc(asm_file,output):
-    cmd = "gcc -o %s %s" % (output,asm_file)
-    process = check_call(cmd, shell=True)
+def do_gcc(obj_file,output,flags=()):
+    ''' Link an object file with the C library, return gcc's exit status '''
+    return call(['gcc','-o',output,obj_file] + list(flags))
 
-from parser import SofortParser
-from ir import ASTParser
-    
-def main():
-    if len(sys.argv) == 2:
-        src = open(sys.argv[1],'rb')
-        asmfile,binfile = outputfiles(src.name)
-        asm = open(asmfile,'wb')
+# Options that change the generated code, part of the cache key
+CACHED_OPTIONS = ('target','backend','keep_checks','peephole','window','alloc_stats')
+
+def cache_key(store,source,options):
+    return store.key(source,dict((name,getattr(options,name)) for name in CACHED_OPTIONS))
+
+def write_output(name,data,mode=None):
+    ''' Write to the file name, or stdout if None '''
+    if name is None:
+        sys.stdout.write(data)
+        return
+    out = open(name,'wb')
+    out.write(data)
+    out.close()
+    if mode is not None:
+        os.chmod(name,mode)
+
+def restore(store,key,kinds,outputs):
+    ''' Write the cached outputs of each kind, False if one is missing '''
+    cached = [store.get(key,kind) for kind in kinds]
+    if None in cached:
+        store.record(MISS)
+        return False
+    for kind,(data,mode) in zip(kinds,cached):
+        write_output(outputs[kind],data,mode if kind == 'bin' else None)
+    store.record(HIT)
+    return True
+
+class LinkError(AppException):
+    pass
+
+def generate(src,options,profile=NOT_PROFILED):
+    ''' Compile the source file into an emitter holding the assembly '''
+    scanner = profile.scanner(make_scanner(src,options.engine))
+    if options.backend == 'regalloc':
+        profile.phase('parse')
+        builder = ArenaBuilder() if options.arena else None
+        ast = SofortParser(scanner,builder).Top()
+        profile.phase('lower')
+        funcs = ASTParser(ast).parse()
+        profile.phase('codegen')
+        emitter = regalloc.generate(funcs,checks=options.keep_checks,
+            alloc_stats=options.alloc_stats)
+        if profile.enabled:
+            profile.count('ast_nodes',len(builder.arena) if builder else count_nodes(ast))
+            profile.count('ir_instructions',sum(len(body) for header,body in funcs))
+            profile.count('locals',len(ir_variables(funcs)))
+    else:
+        profile.phase('parse+gen') # a single pass
+        parser = Parser(scanner,TARGETS[options.target],options.alloc_stats)
+        parser.Top()
+        emitter = parser.emitter
+        profile.count('locals',len(parser.locals.vars))
+    #print (parser.scanner.lines)
+    if options.peephole:
+        profile.phase('peephole')
+        peephole = Peephole(options.window)
+        emitter.optimize(peephole)
+        if options.peephole_stats:
+            peephole.report(sys.stderr)
+    if profile.enabled:
+        instructions,labels,stack = asm_counts(emitter.buffer)
+        profile.count('asm_instructions',instructions)
+        profile.count('labels',labels)
+        profile.count('stack_bytes',stack)
+    return emitter
+
+def compile_file(name,options,store=None,profile=NOT_PROFILED):
+    ''' Compile the file name (stdin if None) to the outputs the options ask for '''
+    if name:
+        src = open(name,'rb')
+        asmfile,objfile,binfile = outputfiles(name)
     else:
         src = sys.stdin
-        asm = sys.stdout
-    scanner = Scanner(src)
-    parser = SofortParser(scanner)
-    #import echo
-    #echo.echo_class(SofortParser)
-    ast = parser.Top()
-    #parser.emitter.flush(asm)
-    import pprint
-    pprint.pprint(ast)
-    asm.close()
+        asmfile = objfile = binfile = None
+    outputs = {'s':asmfile,'o':objfile,'bin':binfile}
+    kinds = ['o','bin'] if options.link else ['o'] if options.object else ['s']
+    if store:
+        profile.phase('cache')
+        name,source = src.name,src.read()
+        src.close()
+        key = cache_key(store,source,options)
+        if restore(store,key,kinds,outputs):
+            profile.count('cache_hits',1)
+            return
+        src = StringIO(source)
+        src.name = name
+    emitter = generate(src,options,profile)
     src.close()
-    #print (parser.scanner.content)
-    #do_gcc(asmfile,binfile)
-    ir = ASTParser(ast)
-    ir.parse()
+    out = StringIO()
+    if options.object or options.link:
+        profile.phase('assemble')
+        emitter.flush_object(out)
+    else:
+        profile.phase('flush')
+        emitter.flush(out)
+    profile.phase('write')
+    write_output(outputs[kinds[0]],out.getvalue())
+    if store:
+        store.put(key,kinds[0],out.getvalue())
+    if options.link:
+        profile.phase('gcc')
+        if do_gcc(objfile,binfile,emitter.link_flags):
+            raise LinkError('gcc failed to link %s' % objfile)
+        if store:
+            store.put_file(key,'bin',binfile)
+
+from parser import SofortParser, ParserException, Appends
+from astArena import ArenaBuilder
+from ir import ASTParser
+import regalloc
+from peephole import Peephole, DEFAULT_WINDOW
+from emitter64 import Emitter64
+import evaluator
+import jit
+from cache import Cache, HIT, MISS, DEFAULT_LIMIT
+import batch
+
+TARGETS = {
+    'i386' : Emitter,
+    'x86-64' : Emitter64,
+}
+    
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [options] [file.sofort ... | directory ...]')
+    op.add_option('--scanner',dest='engine',default='char',choices=sorted(ENGINES),
+        help='tokenizer engine: %s [default: %%default]' % ', '.join(sorted(ENGINES)))
+    op.add_option('--arena',action='store_true',default=False,
+        help='build the AST in an array-backed arena')
+    op.add_option('--ast',action='store_true',default=False,
+        help='print the AST instead of compiling')
+    op.add_option('--ir',action='store_true',default=False,
+        help='print Simple-IR instead of compiling')
+    op.add_option('--run',action='store_true',default=False,
+        help='run the program in-process instead of compiling')
+    op.add_option('--jit',action='store_true',default=False,
+        help='assemble into memory and run the machine code in-process')
+    op.add_option('--target',choices=sorted(TARGETS),
+        help='machine to generate code for: %s [default: i386, the host with --jit]'
+            % ', '.join(sorted(TARGETS)))
+    op.add_option('--backend',default='stack',choices=['stack','regalloc'],
+        help='code generator: stack (single pass) or regalloc (Simple-IR with '
+            'linear-scan register allocation) [default: %default]')
+    op.add_option('--keep-checks',action='store_true',default=False,
+        help='keep array bounds checks the range analysis proves redundant '
+            '(regalloc backend)')
+    op.add_option('-O','--peephole',action='store_true',default=False,
+        help='run the peephole optimizer over the generated assembly')
+    op.add_option('--window',type='int',default=DEFAULT_WINDOW,
+        help='peephole window in instructions [default: %default]')
+    op.add_option('--peephole-stats',action='store_true',default=False,
+        help='print per-rule peephole hit counts to stderr')
+    op.add_option('--alloc-stats',action='store_true',default=False,
+        help='make the program print to stderr when it ends the bytes it '
+            'allocated in arenas and the bytes reclaimed')
+    op.add_option('-c','--object',action='store_true',default=False,
+        help='write an ELF object (file.o) with the built-in assembler')
+    op.add_option('--link',action='store_true',default=False,
+        help='write the object and link it with gcc into an executable')
+    op.add_option('--cache',metavar='DIR',default=os.environ.get('SOFORT_CACHE'),
+        help='reuse outputs from a compile cache in DIR [default: $SOFORT_CACHE]')
+    op.add_option('--cache-size',type='int',metavar='MB',default=DEFAULT_LIMIT >> 20,
+        help='evict the least recently used outputs beyond this size [default: %default]')
+    op.add_option('--cache-stats',action='store_true',default=False,
+        help='print cache hits, misses and size to stderr; without a file, only that')
+    op.add_option('-j','--jobs',type='int',
+        help='processes compiling several files or a directory [default: one per core]')
+    op.add_option('--profile',metavar='FORMAT',choices=['table','json'],
+        help='print the time and peak memory of each phase and counts to stderr, '
+            'as a table or json')
+    options,args = op.parse_args()
+    if options.jit:
+        host = {4:'i386',8:'x86-64'}.get(jit.host_word())
+        if host is None:
+            op.error('--jit needs an x86 host')
+        if options.target not in (None,host):
+            op.error('--jit runs %s code on this host' % host)
+        options.target = host
+    options.target = options.target or 'i386'
+    if options.target != 'i386' and (options.backend != 'stack' or options.peephole):
+        op.error('the regalloc backend and -O generate i386 code only')
+    if options.alloc_stats and (options.ast or options.ir or options.run):
+        op.error('--alloc-stats needs generated code')
+    if options.cache_stats and not options.cache:
+        op.error('--cache-stats needs a cache directory')
+    store = None
+    if options.cache and not (options.ast or options.ir or options.run or options.jit):
+        store = Cache(options.cache,options.cache_size << 20)
+        if options.cache_stats and not args:
+            store.report(sys.stderr)
+            return
+    profile = Profile() if options.profile else NOT_PROFILED
+    if len(args) > 1 or [arg for arg in args if os.path.isdir(arg)]:
+        if options.ast or options.ir or options.run or options.jit or options.profile:
+            op.error('--ast, --ir, --run, --jit and --profile take a single file')
+        paths = batch.sources(args)
+        if not paths:
+            op.error('no %s files found' % batch.SUFFIX)
+        bases = {}
+        for path in paths:
+            base = outputfiles(path)[2]
+            if base in bases:
+                op.error('%s and %s would both write %s.*' % (bases[base],path,base))
+            bases[base] = path
+        failed = batch.run(compile_file,paths,options,store,options.jobs)
+        if options.cache_stats:
+            store.report(sys.stderr)
+        sys.exit(1 if failed else 0)
+    if options.link and len(args) != 1:
+        op.error('--link needs a source file')
+    if not (options.ast or options.ir or options.run or options.jit):
+        try:
+            compile_file(args[0] if args else None,options,store,profile)
+        except LinkError:
+            sys.exit(1)
+        if options.profile:
+            profile.report(sys.stderr,options.profile)
+        if options.cache_stats:
+            store.report(sys.stderr)
+        return
+    src = open(args[0],'rb') if args else sys.stdin
+    if options.jit:
+        emitter = generate(src,options,profile)
+        src.close()
+        profile.phase('jit')
+        status = jit.run(emitter)
+        if options.profile:
+            profile.report(sys.stderr,options.profile)
+        sys.exit(status)
+    scanner = make_scanner(src,options.engine)
+    if options.ast or options.ir:
+        parser = SofortParser(scanner,ArenaBuilder() if options.arena else None)
+        #import echo
+        #echo.echo_class(SofortParser)
+        ast = parser.Top()
+        if options.ast:
+            import pprint
+            pprint.pprint(ast)
+        if options.ir:
+            ir = ASTParser(ast)
+            ir.parse()
+            ir.dump()
+        src.close()
+        return
+    if options.run:
+        parser = SofortParser(scanner,ArenaBuilder() if options.arena else None)
+        ast = parser.Top()
+        src.close()
+        sys.exit(evaluator.run(ast))
     
 if __name__ == '__main__':
     main()
@@ -23,9 +23,24 @@ Example:
   @echo.echo
   def my_function(args):
       pass
+
+Echoing every call is too slow for real inputs. A Recorder instead keeps
+the last calls in a ring buffer, or only every Nth call, and formats them
+when asked:
+
+  recorder = echo.Recorder(size=10000, every=10)
+  echo.echo_class(my_module.my_class, recorder=recorder)
+  ...
+  recorder.dump()
+  recorder.collapsed(open("calls.folded", "w").write)
+
+The collapsed output is the input of flamegraph.pl.
 """
+import collections
+import functools
 import inspect
 import sys
+import time
 
 def name(item):
     " Return an item's name. "
@@ -60,14 +75,12 @@ def format_arg_value(arg_val):
     arg, val = arg_val
     return "%s=%r" % (arg, val)
 
-def echo(fn, write=sys.stdout.write):
-    """ Echo calls to a function.
+def arg_formatter(fn):
+    """ Return a function formatting the arguments of a call to fn.
 
-    Returns a decorated version of the input function which "echoes" calls
-    made to it by writing out the function's name and the arguments it was
-    called with.
+    >>> arg_formatter(arg_formatter)((1,), {})
+    'fn=1'
     """
-    import functools
     # Unpack function's arg count, arg names, arg defaults
     code = fn.func_code
     argcount = code.co_argcount
@@ -75,8 +88,7 @@ def echo(fn, write=sys.stdout.write):
     fn_defaults = fn.func_defaults or list()
     argdefs = dict(zip(argnames[-len(fn_defaults):], fn_defaults))
 
-    @functools.wraps(fn)
-    def wrapped(*v, **k):
+    def format_args(v, k):
         # Collect function arguments by chaining together positional,
         # defaulted, extra positional and keyword arguments.
         positional = map(format_arg_value, zip(argnames, v))
@@ -84,12 +96,147 @@ def echo(fn, write=sys.stdout.write):
                      for a in argnames[len(v):] if a not in k]
         nameless = map(repr, v[argcount:])
         keyword = map(format_arg_value, k.items())
-        args = positional + defaulted + nameless + keyword
-        write("%s(%s)\n" % (name(fn), ", ".join(args)))
+        return ", ".join(positional + defaulted + nameless + keyword)
+    return format_args
+
+def echo(fn, write=sys.stdout.write):
+    """ Echo calls to a function.
+
+    Returns a decorated version of the input function which "echoes" calls
+    made to it by writing out the function's name and the arguments it was
+    called with.
+    """
+    format_args = arg_formatter(fn)
+
+    @functools.wraps(fn)
+    def wrapped(*v, **k):
+        write("%s(%s)\n" % (name(fn), format_args(v, k)))
         return fn(*v, **k)
     return wrapped
 
-def echo_instancemethod(klass, method, write=sys.stdout.write):
+class Recorder:
+    """ Record calls in a ring buffer instead of echoing them.
+
+    A call costs a frame, linked to its caller's, and two clock readings.
+    Every Nth call ("every") is kept, with only the last "size" kept calls
+    in the buffer. Arguments are kept as they are and formatted by dump(),
+    so they show the objects as they are then, not at the time of the
+    call. Times of a sampled recording are multiplied by "every" to
+    estimate the totals.
+
+    >>> recorder = Recorder(clock=iter(range(100)).next)
+    >>> @recorder.wrap
+    ... def fib(n):
+    ...     return n if n < 2 else fib(n - 1) + fib(n - 2)
+    >>> fib(3)
+    2
+    >>> recorder.dump()
+    fib(n=3) 9000000us
+      fib(n=2) 5000000us
+        fib(n=1) 1000000us
+        fib(n=0) 1000000us
+      fib(n=1) 1000000us
+    >>> recorder.collapsed()
+    fib 3000000
+    fib;fib 4000000
+    fib;fib;fib 2000000
+    >>> recorder.summary()
+    method                    calls    inclusive us    exclusive us
+    fib                           5         9000000         9000000
+    """
+
+    def __init__(self, size=100000, every=1, clock=time.time):
+        self.records = collections.deque(maxlen=size)
+        self.every = every
+        self.clock = clock
+        self.countdown = every
+        # The running call: [name, formatter, start, time in callees,
+        # caller's frame, depth]
+        self.frame = None
+
+    def wrap(self, fn):
+        """ Return a version of fn whose calls are recorded. """
+        fname, format_args = name(fn), arg_formatter(fn)
+        records, clock = self.records, self.clock
+
+        @functools.wraps(fn)
+        def recorded(*v, **k):
+            caller = self.frame
+            frame = self.frame = [fname, format_args, clock(), 0.0, caller,
+                                  caller[5] + 1 if caller else 0]
+            try:
+                return fn(*v, **k)
+            finally:
+                inclusive = clock() - frame[2]
+                self.frame = caller
+                if caller:
+                    caller[3] += inclusive
+                self.countdown -= 1
+                if not self.countdown:
+                    self.countdown = self.every
+                    records.append((frame, inclusive, inclusive - frame[3], v, k))
+        return recorded
+
+    def calls(self):
+        " Return the recorded calls in the order they were made. "
+        return sorted(self.records, key=lambda record: record[0][2])
+
+    def dump(self, write=None):
+        " Write the recorded calls with their arguments and times. "
+        write = write or sys.stdout.write
+        for frame, inclusive, exclusive, v, k in self.calls():
+            write("%s%s(%s) %.0fus\n" % ("  " * frame[5], frame[0],
+                                         frame[1](v, k), inclusive * 1e6))
+
+    def stack(self, frame):
+        " Return the names of the calls on the stack of a frame, outermost first. "
+        names = []
+        while frame:
+            names.append(frame[0])
+            frame = frame[4]
+        names.reverse()
+        return names
+
+    def collapsed(self, write=None):
+        """ Write exclusive microseconds per call stack, in the collapsed
+        format of flamegraph.pl: "outer;inner;innermost time".
+        """
+        write = write or sys.stdout.write
+        times = collections.defaultdict(float)
+        for frame, inclusive, exclusive, v, k in self.records:
+            times[";".join(self.stack(frame))] += exclusive
+        for stack in sorted(times):
+            write("%s %d\n" % (stack, round(times[stack] * 1e6 * self.every)))
+
+    def summary(self, write=None):
+        """ Write calls, inclusive and exclusive microseconds per method.
+        The inclusive time of a recursive call is counted at its outermost
+        call only.
+        """
+        write = write or sys.stdout.write
+        methods = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        for frame, inclusive, exclusive, v, k in self.records:
+            totals = methods[frame[0]]
+            totals[0] += 1
+            totals[2] += exclusive
+            if frame[0] not in self.stack(frame[4]):
+                totals[1] += inclusive
+        write("%-20s %10s %15s %15s\n" % ("method", "calls", "inclusive us",
+                                          "exclusive us"))
+        scale = 1e6 * self.every
+        for method, (calls, inclusive, exclusive) in sorted(
+                methods.items(), key=lambda item: -item[1][1]):
+            write("%-20s %10d %15d %15d\n" % (method, calls * self.every,
+                                              round(inclusive * scale),
+                                              round(exclusive * scale)))
+
+def decorate(fn, write, recorder):
+    " Echo fn, or record its calls if there is a recorder. "
+    if recorder is not None:
+        return recorder.wrap(fn)
+    return echo(fn, write)
+
+def echo_instancemethod(klass, method, write=sys.stdout.write, recorder=None):
     """ Change an instancemethod so that calls to it are echoed.
 
     Replacing a classmethod is a little more tricky.
@@ -100,25 +247,26 @@ def echo_instancemethod(klass, method, write=sys.stdout.write):
     if mname in never_echo:
         pass
     elif is_classmethod(method):
-        setattr(klass, mname, classmethod(echo(method.im_func, write)))
+        setattr(klass, mname, classmethod(decorate(method.im_func, write,
+                                                   recorder)))
     else:
-        setattr(klass, mname, echo(method, write))
+        setattr(klass, mname, decorate(method, write, recorder))
 
-def echo_class(klass, write=sys.stdout.write):
+def echo_class(klass, write=sys.stdout.write, recorder=None):
     """ Echo calls to class methods and static functions
     """
     for _, method in inspect.getmembers(klass, inspect.ismethod):
-        echo_instancemethod(klass, method, write)
+        echo_instancemethod(klass, method, write, recorder)
     for _, fn in inspect.getmembers(klass, inspect.isfunction):
-        setattr(klass, name(fn), staticmethod(echo(fn, write)))
+        setattr(klass, name(fn), staticmethod(decorate(fn, write, recorder)))
 
-def echo_module(mod, write=sys.stdout.write):
+def echo_module(mod, write=sys.stdout.write, recorder=None):
     """ Echo calls to functions and methods in a module.
     """
     for fname, fn in inspect.getmembers(mod, inspect.isfunction):
-        setattr(mod, fname, echo(fn, write))
+        setattr(mod, fname, decorate(fn, write, recorder))
     for _, klass in inspect.getmembers(mod, inspect.isclass):
-        echo_class(klass, write)
+        echo_class(klass, write, recorder)
 
 if __name__ == "__main__":
     import doctest
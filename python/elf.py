@@ -0,0 +1,195 @@
+''' Relocatable ELF objects (ET_REL) for i386 and x86-64.
+
+A word size of 4 writes ELF32 for EM_386 with .rel sections, addends kept
+in the section data as the i386 ABI wants; a word size of 8 writes ELF64
+for EM_X86_64 with .rela sections. Only what an assembler needs is here:
+sections, symbols and relocations, no program headers.
+'''
+import struct
+
+ET_REL = 1
+EM_386 = 3
+EM_X86_64 = 62
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+SHF_INFO_LINK = 0x40
+
+STB_LOCAL = 0
+STB_GLOBAL = 1
+
+STT_NOTYPE = 0
+STT_SECTION = 3
+
+R_386_32 = 1
+R_386_PC32 = 2
+
+R_X86_64_64 = 1
+R_X86_64_PC32 = 2
+R_X86_64_PLT32 = 4
+R_X86_64_32S = 11
+
+# Relocation type by word size, field size and kind of reference
+RELOCATIONS = {
+    4 : {(4,'abs'):R_386_32, (4,'pc'):R_386_PC32, (4,'plt'):R_386_PC32},
+    8 : {(4,'abs'):R_X86_64_32S, (8,'abs'):R_X86_64_64,
+        (4,'pc'):R_X86_64_PC32, (4,'plt'):R_X86_64_PLT32},
+}
+
+# Type, flags and alignment of the sections compilers usually name
+SECTIONS = {
+    '.text' : (SHT_PROGBITS,SHF_ALLOC|SHF_EXECINSTR),
+    '.data' : (SHT_PROGBITS,SHF_ALLOC|SHF_WRITE),
+    '.rodata' : (SHT_PROGBITS,SHF_ALLOC),
+    '.bss' : (SHT_NOBITS,SHF_ALLOC|SHF_WRITE),
+}
+
+class ElfFormat:
+    ''' Record layouts of one ELF class '''
+
+    def __init__(self,word):
+        self.word = word
+        if word == 4:
+            self.elfclass,self.machine = 1,EM_386
+            self.header = struct.Struct('<16sHHIIIIIHHHHHH')
+            self.shdr = struct.Struct('<IIIIIIIIII')
+            self.sym = struct.Struct('<IIIBBH')
+            self.rel = struct.Struct('<II')
+            self.rel_type,self.rel_prefix = SHT_REL,'.rel'
+        else:
+            self.elfclass,self.machine = 2,EM_X86_64
+            self.header = struct.Struct('<16sHHIQQQIHHHHHH')
+            self.shdr = struct.Struct('<IIQQQQIIQQ')
+            self.sym = struct.Struct('<IBBHQQ')
+            self.rel = struct.Struct('<QQq')
+            self.rel_type,self.rel_prefix = SHT_RELA,'.rela'
+
+    def pack_sym(self,name,value,info,shndx):
+        if self.word == 4:
+            return self.sym.pack(name,value,0,info,0,shndx)
+        return self.sym.pack(name,info,0,shndx,value,0)
+
+    def pack_rel(self,offset,sym,type,addend):
+        if self.word == 4:
+            return self.rel.pack(offset,sym << 8 | type)
+        return self.rel.pack(offset,sym << 32 | type,addend)
+
+
+class StringTable:
+
+    def __init__(self):
+        self.data = bytearray('\0')
+        self.offsets = {'':0}
+
+    def add(self,s):
+        if s not in self.offsets:
+            self.offsets[s] = len(self.data)
+            self.data += s + '\0'
+        return self.offsets[s]
+
+
+class Section:
+
+    def __init__(self,name,data,align=1):
+        self.name = name
+        self.data = data
+        self.align = align
+        self.type,self.flags = SECTIONS.get(name,(SHT_PROGBITS,0))
+        self.relocs = []
+        self.symbol = Symbol(None,self,0,STB_LOCAL,STT_SECTION)
+
+class Symbol:
+    ''' A symbol of section (None if undefined) at value '''
+
+    def __init__(self,name,section,value,bind=STB_LOCAL,type=STT_NOTYPE):
+        self.name = name
+        self.section = section
+        self.value = value
+        self.bind = bind
+        self.type = type
+
+
+class ElfObject:
+    ''' Sections, symbols and relocations written out by write() '''
+
+    def __init__(self,word):
+        self.format = ElfFormat(word)
+        self.sections = []
+        self.symbols = []
+
+    def add_section(self,name,data,align=1):
+        section = Section(name,data,align)
+        self.sections.append(section)
+        self.symbols.append(section.symbol)
+        return section
+
+    def add_symbol(self,name,section,value,bind=STB_LOCAL):
+        symbol = Symbol(name,section,value,bind)
+        self.symbols.append(symbol)
+        return symbol
+
+    def add_reloc(self,section,offset,symbol,size,kind,addend):
+        ''' Reference to symbol+addend from a field of size bytes at offset;
+            kind is 'abs', 'pc' (relative to the field) or 'plt' (a call)
+        '''
+        type = RELOCATIONS[self.format.word][size,kind]
+        if self.format.rel_type == SHT_REL:
+            struct.pack_into('<i' if size == 4 else '<q',section.data,offset,addend)
+        section.relocs.append((offset,symbol,type,addend))
+
+    def write(self,file):
+        fmt = self.format
+        word = fmt.word
+        strtab,shstrtab = StringTable(),StringTable()
+        # Locals come first, .symtab sh_info is the first global
+        symbols = [None] + [s for s in self.symbols if s.bind == STB_LOCAL] + \
+            [s for s in self.symbols if s.bind != STB_LOCAL]
+        index = dict((id(s),i) for i,s in enumerate(symbols))
+        first_global = len([s for s in symbols if s is None or s.bind == STB_LOCAL])
+        shndx = dict((id(s),i+1) for i,s in enumerate(self.sections))
+        symtab = bytearray(fmt.pack_sym(0,0,0,0))
+        for s in symbols[1:]:
+            name = strtab.add(s.name) if s.name else 0
+            ndx = shndx[id(s.section)] if s.section else 0
+            symtab += fmt.pack_sym(name,s.value,s.bind << 4 | s.type,ndx)
+        # name, type, flags, data, link, info, align, entsize
+        headers = [(0,0,0,bytearray(),0,0,0,0)]
+        for s in self.sections:
+            headers.append((shstrtab.add(s.name),s.type,s.flags,s.data,0,0,s.align,0))
+        symtab_index = len(headers) + len([s for s in self.sections if s.relocs])
+        for s in self.sections:
+            if s.relocs:
+                data = bytearray()
+                for offset,symbol,type,addend in s.relocs:
+                    data += fmt.pack_rel(offset,index[id(symbol)],type,addend)
+                headers.append((shstrtab.add(fmt.rel_prefix + s.name),fmt.rel_type,
+                    SHF_INFO_LINK,data,symtab_index,shndx[id(s)],word,fmt.rel.size))
+        headers.append((shstrtab.add('.symtab'),SHT_SYMTAB,0,symtab,
+            symtab_index+1,first_global,word,fmt.sym.size))
+        headers.append((shstrtab.add('.strtab'),SHT_STRTAB,0,strtab.data,0,0,1,0))
+        headers.append((shstrtab.add('.shstrtab'),SHT_STRTAB,0,shstrtab.data,0,0,1,0))
+        out = bytearray(fmt.header.size)
+        table = bytearray()
+        for name,type,flags,data,link,info,align,entsize in headers:
+            if align > 1:
+                out += '\0' * (-len(out) % align)
+            offset = len(out)
+            if type != SHT_NOBITS:
+                out += data
+            table += fmt.shdr.pack(name,type,flags,0,offset,len(data),link,info,
+                align,entsize)
+        out += '\0' * (-len(out) % word)
+        shoff = len(out)
+        out += table
+        ident = '\x7fELF' + chr(fmt.elfclass) + '\x01\x01' + '\0' * 9
+        out[:fmt.header.size] = fmt.header.pack(ident,ET_REL,fmt.machine,1,0,0,shoff,
+            0,fmt.header.size,0,0,fmt.shdr.size,len(headers),len(headers)-1)
+        file.write(out)
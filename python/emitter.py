@@ -1,6 +1,9 @@
 from sys import platform as PLAT
+from strength import mul_imm, div_imm
+from assembler import assemble
+from sofortTypes import append_routine
 
-if PLAT!='linux':
+if not PLAT.startswith('linux'):
     mangle=lambda(s): '_'+s
 else:
     mangle=lambda(s): s
@@ -8,22 +11,348 @@ else:
 
 PROG_PROLOGUE=r"""
 .data
-int_format:
-	.asciz "%d\n"  # format string for printf
-char_format:
-	.asciz "%c\n"  
-string_format:
-	.asciz "%s\n" 
 exception_msg:
 	.asciz "Exception.\n"
 """ + """
 .text
 %s:
+    call %s
     pushl $exception_msg
     call %s
     pushl $1
     call %s
-""" % (mangle('exception'),mangle('puts'),mangle('exit'))
+""" % (mangle('exception'),mangle('out_flush'),mangle('puts'),mangle('exit'))
+
+# Bytes print buffers before a write
+OUTPUT_SIZE = 8192
+
+# print writes what printf "%d\n", "%c\n" and "%s\n" would, to a buffer
+# flushed when full, when main returns and by exception. The first print
+# asks isatty(1), and a terminal gets each line at once, as from stdio.
+# Digits are made from -|v|, which INT_MIN has, by the division by 10
+# of strength.py.
+OUTPUT_RUNTIME=r"""
+.data
+out_tty:
+	.long -1
+out_len:
+	.long 0
+out_buf:
+	.space %(size)d
+.text
+%(flush)s:
+	pushl	%%ebx
+	movl	$0,%%ebx
+out_flush_write:
+	movl	out_len,%%eax
+	subl	%%ebx,%%eax
+	jle	out_flush_done
+	pushl	%%eax
+	leal	out_buf(%%ebx),%%eax
+	pushl	%%eax
+	pushl	$1
+	call	%(write)s
+	addl	$12,%%esp
+	testl	%%eax,%%eax
+	jle	out_flush_done
+	addl	%%eax,%%ebx
+	jmp	out_flush_write
+out_flush_done:
+	movl	$0,out_len
+	popl	%%ebx
+	ret
+out_newline:
+	movb	$10,out_buf(%%ecx)
+	addl	$1,%%ecx
+	movl	%%ecx,out_len
+	movl	out_tty,%%eax
+	testl	%%eax,%%eax
+	jne	out_newline_tty
+	ret
+out_newline_tty:
+	jg	%(flush)s
+	pushl	$1
+	call	%(isatty)s
+	addl	$4,%%esp
+	movl	%%eax,out_tty
+	testl	%%eax,%%eax
+	jne	%(flush)s
+	ret
+%(char)s:
+	movl	out_len,%%ecx
+	cmpl	$%(char_room)d,%%ecx
+	jle	out_char_room
+	call	%(flush)s
+	movl	$0,%%ecx
+out_char_room:
+	movl	4(%%esp),%%eax
+	movb	%%al,out_buf(%%ecx)
+	addl	$1,%%ecx
+	jmp	out_newline
+%(string)s:
+	pushl	%%esi
+	movl	8(%%esp),%%esi
+	movl	out_len,%%ecx
+out_string_copy:
+	movzbl	(%%esi),%%eax
+	testl	%%eax,%%eax
+	je	out_string_end
+	cmpl	$%(string_room)d,%%ecx
+	jl	out_string_room
+	movl	%%ecx,out_len
+	call	%(flush)s
+	movl	$0,%%ecx
+	movzbl	(%%esi),%%eax
+out_string_room:
+	movb	%%al,out_buf(%%ecx)
+	addl	$1,%%ecx
+	addl	$1,%%esi
+	jmp	out_string_copy
+out_string_end:
+	popl	%%esi
+	jmp	out_newline
+%(int)s:
+	movl	out_len,%%ecx
+	cmpl	$%(int_room)d,%%ecx
+	jle	out_int_room
+	call	%(flush)s
+	movl	$0,%%ecx
+out_int_room:
+	pushl	%%esi
+	pushl	%%edi
+	movl	%%ecx,%%edi
+	movl	12(%%esp),%%ecx
+	testl	%%ecx,%%ecx
+	jl	out_int_sign
+	negl	%%ecx
+	jmp	out_int_digits
+out_int_sign:
+	movb	$45,out_buf(%%edi)
+	addl	$1,%%edi
+out_int_digits:
+	movl	$-10,%%eax
+out_int_count:
+	cmpl	%%eax,%%ecx
+	jg	out_int_counted
+	addl	$1,%%edi
+	cmpl	$-1000000000,%%eax
+	je	out_int_counted
+	imull	$10,%%eax
+	jmp	out_int_count
+out_int_counted:
+	movl	%%edi,%%esi
+out_int_digit:
+%(div)s
+	leal	(%%eax,%%eax,4),%%edx
+	addl	%%edx,%%edx
+	subl	%%ecx,%%edx
+	addl	$48,%%edx
+	movb	%%dl,out_buf(%%edi)
+	subl	$1,%%edi
+	movl	%%eax,%%ecx
+	testl	%%ecx,%%ecx
+	jne	out_int_digit
+	leal	1(%%esi),%%ecx
+	popl	%%edi
+	popl	%%esi
+	jmp	out_newline
+"""
+
+def output_runtime(template):
+    ''' The print runtime of a target from its template '''
+    return template % {
+        'size' : OUTPUT_SIZE,
+        'int_room' : OUTPUT_SIZE - 12, # "-2147483648\n"
+        'char_room' : OUTPUT_SIZE - 2,
+        'string_room' : OUTPUT_SIZE - 1,
+        'div' : '\n'.join('\t' + inst.replace(' ','\t') for inst in div_imm(10,'%ecx')),
+        'flush' : mangle('out_flush'),
+        'int' : mangle('out_int'),
+        'char' : mangle('out_char'),
+        'string' : mangle('out_string'),
+        'write' : mangle('write'),
+        'isatty' : mangle('isatty'),
+    }
+
+# append(array,value) returns the array, which realloc may have moved.
+# The capacity is doubled in the old block, and realloc copies it along.
+APPEND_RUNTIME=r"""
+.text
+%(name)s:
+	movl	4(%%esp),%%eax
+	movl	8(%%esp),%%edx
+	movl	4(%%eax),%%ecx
+	cmpl	8(%%eax),%%ecx
+	jae	%(name)s_grow
+%(name)s_store:
+	%(store)s	%(value)s,12(%%eax,%%ecx,%(size)d)
+	addl	$1,%%ecx
+	movl	%%ecx,4(%%eax)
+	ret
+%(name)s_grow:
+	shll	$1,8(%%eax)
+	movl	8(%%eax),%%ecx
+	leal	12(,%%ecx,%(size)d),%%ecx
+	pushl	%%edx
+	pushl	%%ecx
+	pushl	%%eax
+	call	%(realloc)s
+	addl	$8,%%esp
+	popl	%%edx
+	testl	%%eax,%%eax
+	je	%(exception)s
+	movl	4(%%eax),%%ecx
+	jmp	%(name)s_store
+"""
+
+# Bytes an arena gets from malloc at a time; a larger array gets a chunk
+# of its own
+ARENA_CHUNK = 1 << 20
+
+# Words of the arena's state a block saves when it begins: chunk, next, live
+ARENA_MARK = 3
+
+# Arenas hand out memory from chunks, each <prev><size><data...>. Their
+# state is <chunk><next><end><live bytes><reclaimed bytes><free chunks>.
+# arena_alloc(arena,size) takes size bytes at next, from a new chunk when
+# they do not fit. arena_mark(mark) saves the scope arena's chunk, next and
+# live, and arena_release(mark) returns to them; the chunks begun since
+# are kept for reuse, except larger ones, which go back to free.
+ARENA_RUNTIME=r"""
+.data
+arena_program:
+	.long 0,0,0,0,0,0
+arena_scope:
+	.long 0,0,0,0,0,0
+.text
+%(alloc)s:
+	movl	4(%%esp),%%edx
+	movl	8(%%esp),%%ecx
+	addl	$3,%%ecx
+	andl	$-4,%%ecx
+arena_alloc_bump:
+	movl	4(%%edx),%%eax
+	addl	%%eax,%%ecx
+	cmpl	8(%%edx),%%ecx
+	ja	arena_alloc_chunk
+	movl	%%ecx,4(%%edx)
+	subl	%%eax,%%ecx
+	addl	%%ecx,12(%%edx)
+	ret
+arena_alloc_chunk:
+	subl	%%eax,%%ecx
+	pushl	%%ebx
+	pushl	%%esi
+	movl	%%edx,%%esi
+	movl	%%ecx,%%ebx
+	movl	20(%%esi),%%eax
+	testl	%%eax,%%eax
+	je	arena_alloc_malloc
+	cmpl	$%(chunk_data)d,%%ebx
+	ja	arena_alloc_malloc
+	movl	(%%eax),%%ecx
+	movl	%%ecx,20(%%esi)
+	jmp	arena_alloc_push
+arena_alloc_malloc:
+	leal	8(%%ebx),%%eax
+	cmpl	$%(chunk)d,%%eax
+	jae	arena_alloc_size
+	movl	$%(chunk)d,%%eax
+arena_alloc_size:
+	pushl	%%eax
+	pushl	%%eax
+	call	%(malloc)s
+	addl	$4,%%esp
+	popl	%%ecx
+	testl	%%eax,%%eax
+	je	%(exception)s
+	movl	%%ecx,4(%%eax)
+arena_alloc_push:
+	movl	(%%esi),%%ecx
+	movl	%%ecx,(%%eax)
+	movl	%%eax,(%%esi)
+	movl	4(%%eax),%%ecx
+	addl	%%eax,%%ecx
+	movl	%%ecx,8(%%esi)
+	addl	$8,%%eax
+	movl	%%eax,4(%%esi)
+	movl	%%esi,%%edx
+	movl	%%ebx,%%ecx
+	popl	%%esi
+	popl	%%ebx
+	jmp	arena_alloc_bump
+%(mark)s:
+	movl	4(%%esp),%%edx
+	movl	$arena_scope,%%ecx
+	movl	(%%ecx),%%eax
+	movl	%%eax,(%%edx)
+	movl	4(%%ecx),%%eax
+	movl	%%eax,4(%%edx)
+	movl	12(%%ecx),%%eax
+	movl	%%eax,8(%%edx)
+	ret
+%(release)s:
+	pushl	%%ebx
+	pushl	%%esi
+	movl	12(%%esp),%%ebx
+	movl	$arena_scope,%%esi
+	movl	12(%%esi),%%eax
+	subl	8(%%ebx),%%eax
+	addl	%%eax,16(%%esi)
+	movl	8(%%ebx),%%eax
+	movl	%%eax,12(%%esi)
+arena_release_chunk:
+	movl	(%%esi),%%eax
+	cmpl	(%%ebx),%%eax
+	je	arena_release_done
+	movl	(%%eax),%%ecx
+	movl	%%ecx,(%%esi)
+	cmpl	$%(chunk)d,4(%%eax)
+	jne	arena_release_free
+	movl	20(%%esi),%%ecx
+	movl	%%ecx,(%%eax)
+	movl	%%eax,20(%%esi)
+	jmp	arena_release_chunk
+arena_release_free:
+	pushl	%%eax
+	call	%(free)s
+	addl	$4,%%esp
+	jmp	arena_release_chunk
+arena_release_done:
+	movl	4(%%ebx),%%ecx
+	movl	%%ecx,4(%%esi)
+	testl	%%eax,%%eax
+	je	arena_release_end
+	addl	4(%%eax),%%eax
+arena_release_end:
+	movl	%%eax,8(%%esi)
+	popl	%%esi
+	popl	%%ebx
+	ret
+"""
+
+# arena_report() writes the bytes allocated in the arenas and the bytes
+# reclaimed to stderr, after what print has buffered
+ARENA_REPORT=r"""
+.data
+arena_format:
+	.asciz "arena: %%lu bytes allocated, %%lu bytes reclaimed\n"
+.text
+%(report)s:
+	call	%(flush)s
+	movl	$arena_scope,%%ecx
+	movl	16(%%ecx),%%eax
+	pushl	%%eax
+	addl	12(%%ecx),%%eax
+	movl	$arena_program,%%ecx
+	addl	12(%%ecx),%%eax
+	pushl	%%eax
+	pushl	$arena_format
+	pushl	$2
+	call	%(dprintf)s
+	addl	$16,%%esp
+	ret
+"""
 
 FUN_PROLOGUE="""
 .text
@@ -65,6 +394,9 @@ TAB="\t"
             
 class Func:
 
+    prologue = FUN_PROLOGUE
+    epilogue = FUN_EPILOGUE
+
     def __init__(self,name,stack=0):
         self.name = name
         self.stack = stack
@@ -80,25 +412,147 @@ class Func:
 
     def block(self,buffer):
         name = mangle(self.name)
-        prologue = FUN_PROLOGUE % (name,name,self.stack)
-        return [prologue] + buffer + [FUN_EPILOGUE]         
+        prologue = self.prologue % (name,name,self.stack)
+        if self.name == 'main':
+            # The program ends when main returns
+            buffer = buffer + [TAB + 'call' + TAB + mangle('out_flush')]
+        return [prologue] + buffer + [self.epilogue]
         
 class Constants:
+    ''' Read-only pool of string literals, laid out like runtime strings:
+        <hdr><n><n+1><char_1>....<char_n><0>
+    '''
+
+    word = '.long'
+    align = 4
 
     def __init__(self):
         self.buffer = []
+        self.labels = {}
     
     def block(self):
-        return ['.data'] + self.buffer
+        return ['.section .rodata'] + self.buffer
     
     def add_string_constant(self,const):
-        self.buffer.append('.asciz "%s"' % const)
+        ''' Label of the literal, shared by equal literals '''
+        label = self.labels.get(const)
+        if label is None:
+            label = 'str%d' % len(self.labels)
+            self.labels[const] = label
+            self.buffer.append('.align %d' % self.align)
+            self.buffer.append('%s:' % label)
+            self.buffer.append(TAB + '%s 0,%d,%d' % (self.word,len(const),len(const)+1))
+            self.buffer.append(TAB + '.asciz %s' % asciz(const))
+        return label
+
+def asciz(s):
+    ''' Quote s for the .asciz directive '''
+    chars = []
+    for ch in s:
+        if ch in '"\\' or not ' ' <= ch <= '~':
+            ch = '\\%03o' % ord(ch)
+        chars.append(ch)
+    return '"%s"' % ''.join(chars)
+
+class Deferred(str):
+    ''' Code decided once the whole program is parsed, see resolve() '''
+
+    def code(self):
+        return [str(self)]
+
+class ConstLoad(Deferred):
+    ''' Load of a pooled constant into the pointer register. Once marked
+        writable it is emitted as a copy of the constant, allocated where
+        its escape.Site says.
+    '''
+
+    def __new__(cls,emitter,label,size,site=None):
+        e = emitter()
+        e.const_pointer(label)
+        self = str.__new__(cls,e.buffer[0])
+        self.emitter = emitter
+        self.label = label
+        self.size = size
+        self.site = site
+        self.writable = False
+        return self
+
+    def code(self):
+        if not self.writable:
+            return [str(self)]
+        e = self.emitter()
+        e.copy_const(self.label,self.size,self.site.arena if self.site else None)
+        return e.buffer
+
+class Allocation(Deferred):
+    ''' Allocation into the pointer register, from the arena its
+        escape.Site is given
+    '''
+
+    def __new__(cls,emitter,size,site):
+        e = emitter()
+        e.allocate(size)
+        self = str.__new__(cls,'\n'.join(e.buffer))
+        self.emitter = emitter
+        self.size = size
+        self.site = site
+        return self
+
+    def code(self):
+        e = self.emitter()
+        e.allocate(self.size,self.site.arena)
+        return e.buffer
+
+class ScopeBound(Deferred):
+    ''' Beginning or end of a block, where a block that is a scope of the
+        arena saves or restores the arena's state in its frame slots
+    '''
+
+    def __new__(cls,emitter,block,end):
+        self = str.__new__(cls,'')
+        self.emitter = emitter
+        self.block = block
+        self.end = end
+        return self
+
+    def code(self):
+        if not self.block.marked:
+            return []
+        e = self.emitter()
+        if self.end:
+            e.arena_release(self.block.index)
+        else:
+            e.arena_mark(self.block.index)
+        return e.buffer
 
         
 def stack_offset(index):
     return (index+1)*4
 
+def is_reg(operand):
+    return operand.startswith('%')
+
+def is_imm(operand):
+    return operand.startswith('$')
+
+def is_mem(operand):
+    return not is_reg(operand) and not is_imm(operand)
+
 class Emitter:
+    ''' i386 code, cdecl calls '''
+
+    word = 4 # bytes in a pointer and in a stack slot
+    pointer = '%esi'
+    scratch = '%ebx' # free for the accumulator's operations
+    Func = Func
+    Constants = Constants
+    link_flags = ['-m32','-no-pie'] # for gcc, the code uses absolute addresses
+    append_runtime = APPEND_RUNTIME
+    output_runtime = output_runtime(OUTPUT_RUNTIME)
+    arena_runtime = ARENA_RUNTIME
+    arena_report = ARENA_REPORT
+    # Element store of append for each element size
+    append_store = {1:('movb','%dl'),4:('movl','%edx')}
     
     def __init__(self):
         self.buffer = []
@@ -111,8 +565,81 @@ class Emitter:
     def flush(self,file):
         print >> file, '\n'.join(self.buffer)
 
+    def flush_object(self,file):
+        ''' Write the buffer as a relocatable ELF object, see assembler.py '''
+        file.write(assemble('\n'.join(self.buffer),self.word))
+
+    def optimize(self,optimizer):
+        ''' Rewrite the buffer in place, e.g. with peephole.Peephole '''
+        self.buffer[:] = optimizer.optimize(self.buffer)
+
     def emit_block(self,buffer):
         self.buffer.extend(buffer)
+
+    def load_const_pointer(self,label,size,site=None):
+        ''' See ConstLoad and resolve() '''
+        inst = ConstLoad(self.__class__,label,size,site)
+        self.emit_raw(inst)
+        return inst
+
+    def alloc(self,size,site=None):
+        ''' Allocate size bytes into the pointer register, see Allocation '''
+        if site is None:
+            self.allocate(size)
+        else:
+            self.emit_raw(Allocation(self.__class__,size,site))
+
+    def begin_scope(self,block):
+        self.emit_raw(ScopeBound(self.__class__,block,False))
+
+    def end_scope(self,block):
+        self.emit_raw(ScopeBound(self.__class__,block,True))
+
+    def const_pointer(self,label):
+        self.emit("movl $%s,%%esi" % label)
+
+    def allocate(self,size,arena=None):
+        ''' size bytes from malloc, or the arena named, into the pointer register '''
+        self.push_imm_int(size)
+        if arena is None:
+            self.call('malloc',1)
+        else:
+            self.emit("pushl $arena_%s" % arena)
+            self.call('arena_alloc',2)
+        self.move_pointer()
+
+    def arena_mark(self,index):
+        ''' Save the scope arena's state in the ARENA_MARK words from index '''
+        self.emit("leal -%d(%%ebp),%%eax" % stack_offset(index+ARENA_MARK-1))
+        self.push_acc()
+        self.call('arena_mark',1)
+
+    def arena_release(self,index):
+        ''' Take back the scope arena's memory since arena_mark(index) '''
+        self.emit("leal -%d(%%ebp),%%eax" % stack_offset(index+ARENA_MARK-1))
+        self.push_acc()
+        self.call('arena_release',1)
+
+    def copy_const(self,label,size,arena=None):
+        self.allocate(size,arena)
+        self.push_imm_int(size)
+        self.emit("pushl $%s" % label)
+        self.push_pointer()
+        self.call('memcpy',3)
+
+    def resolve(self):
+        ''' Expand the deferred code, once the program is parsed '''
+        buffer = []
+        for inst in self.buffer:
+            if isinstance(inst,Deferred):
+                buffer.extend(inst.code())
+            else:
+                buffer.append(inst)
+        self.buffer[:] = buffer
+
+    def uses_pointer(self):
+        ''' Whether the buffered code may change the pointer register '''
+        return any(self.pointer in inst for inst in self.buffer)
         
     def emit(self,s):
         s = s.replace(' ',TAB)
@@ -124,6 +651,33 @@ class Emitter:
 
     def begin_prog(self):
         self.emit_raw(PROG_PROLOGUE)
+        self.emit_raw(self.output_runtime)
+
+    def emit_append_runtime(self,size):
+        ''' Emit the append routine for size-byte elements, see DynamicArray.append '''
+        store,value = self.append_store[size]
+        self.emit_raw(self.append_runtime % {'name':mangle(append_routine(size)),
+            'store':store,'value':value,'size':size,'realloc':mangle('realloc'),
+            'exception':mangle('exception')})
+
+    def emit_arena_runtime(self,report=False):
+        ''' Emit the arenas, see escape.py, and arena_report if asked for '''
+        names = {
+            'chunk' : ARENA_CHUNK,
+            'chunk_data' : ARENA_CHUNK - 2*self.word,
+            'alloc' : mangle('arena_alloc'),
+            'mark' : mangle('arena_mark'),
+            'release' : mangle('arena_release'),
+            'report' : mangle('arena_report'),
+            'flush' : mangle('out_flush'),
+            'malloc' : mangle('malloc'),
+            'free' : mangle('free'),
+            'dprintf' : mangle('dprintf'),
+            'exception' : mangle('exception'),
+        }
+        self.emit_raw(self.arena_runtime % names)
+        if report:
+            self.emit_raw(self.arena_report % names)
         
     # def end_prog(self):
         # self.constants.emit()
@@ -138,18 +692,15 @@ class Emitter:
         
     def print_int(self):
         self.push_acc()
-        self.emit("pushl $int_format")
-        self.call('printf',2)
+        self.call('out_int',1)
 
     def print_char(self):
         self.push_acc()
-        self.emit("pushl $char_format")
-        self.call('printf',2)
+        self.call('out_char',1)
         
     def print_string(self):
         self.push_pointer()
-        self.emit("pushl $string_format")
-        self.call('printf',2)
+        self.call('out_string',1)
 
     def push_imm_int(self,value):
         self.emit("pushl $%d" % value)
@@ -195,7 +746,29 @@ class Emitter:
         self.emit("addl $4,%esp")
         
     def mul_imm_int(self,value):
-        self.emit("imull $%d,%%eax" % value)
+        code = mul_imm(value,'%eax',self.scratch)
+        if code is None:
+            code = ["imull $%d,%%eax" % value]
+        for inst in code:
+            self.emit(inst)
+
+    def add_imm_int(self,value):
+        self.emit("addl $%d,%%eax" % value)
+
+    def sub_imm_int(self,value):
+        self.emit("subl $%d,%%eax" % value)
+
+    def div_imm_int(self,value):
+        code = div_imm(value,'%eax',self.scratch)
+        if code is None:
+            code = ["movl $%d,%s" % (value,self.scratch),"cdq","idivl %s" % self.scratch]
+        for inst in code:
+            self.emit(inst)
+
+    def cmp_imm_int(self,value,cond):
+        self.emit("cmpl $%d,%%eax" % value)
+        self.emit("set%s %%al" % cond)
+        self.emit("movzbl %al,%eax")
 
     def shl_imm_int(self,value):
         self.emit("shll $%d,%%eax" % value)
@@ -217,6 +790,9 @@ class Emitter:
 
     def store_var_int(self,index):
         self.emit("movl %%eax,-%d(%%ebp)" % (stack_offset(index),))
+
+    def store_imm_var_int(self,index,value):
+        self.emit("movl $%d,-%d(%%ebp)" % (value,stack_offset(index)))
         
     def label(self,label):
         self.emit_raw("%s:" % label)
@@ -235,6 +811,10 @@ class Emitter:
 
     def jump_if_less(self,label):
         self.emit("jl %s" % label)
+
+    def check_index(self,length_offset):
+        self.emit("cmpl %d(%%esi),%%eax" % length_offset)
+        self.emit("jae %s" % mangle('exception'))
         
     def pop_cmp_int(self):
         self.emit("popl %ebx")
@@ -267,6 +847,15 @@ class Emitter:
     def move_pointer(self):
         self.emit("movl %eax,%esi")
 
+    def move_acc(self):
+        self.emit("movl %esi,%eax")
+
+    def store_acc_pointer_at(self,index=0):
+        self.emit("movl %%eax,%d(%%esi)" % index)
+
+    def load_pointer_at(self,index=0):
+        self.emit("movl %d(%%esi),%%esi" % index)
+
     def load_var_pointer(self,index):
         self.emit("movl -%d(%%ebp),%%esi" % (stack_offset(index),))
 
@@ -0,0 +1,555 @@
+''' x86-64 code for the System V ABI, selected with compiler.py --target x86-64.
+
+Emitter64 keeps the interface of emitter.Emitter, so sofortTypes generates
+code for either target. Ints stay 32-bit in %eax; pointers and stack slots
+are 8 bytes. The pointer register is %rbx, which calls preserve, and %r12
+keeps the stack pointer while a call runs on a 16-byte aligned stack.
+Arguments pushed for call() are popped into the argument registers.
+Data is addressed relative to %rip, so the output links as PIE.
+'''
+from emitter import *
+
+PROG_PROLOGUE=r"""
+.data
+exception_msg:
+	.asciz "Exception.\n"
+.section .note.GNU-stack,"",@progbits
+""" + """
+.text
+%s:
+    andq $-16,%%rsp
+    call %s
+    leaq exception_msg(%%rip),%%rdi
+    call %s
+    movl $1,%%edi
+    call %s
+""" % (mangle('exception'),mangle('out_flush'),mangle('puts'),mangle('exit'))
+
+# The print runtime of emitter.py, with the argument in %rdi
+OUTPUT_RUNTIME=r"""
+.data
+out_tty:
+	.long -1
+out_len:
+	.long 0
+out_buf:
+	.space %(size)d
+.text
+%(flush)s:
+	pushq	%%rbx
+	pushq	%%r12
+	movq	%%rsp,%%r12
+	andq	$-16,%%rsp
+	movl	$0,%%ebx
+out_flush_write:
+	movl	out_len(%%rip),%%edx
+	subl	%%ebx,%%edx
+	jle	out_flush_done
+	leaq	out_buf(%%rip),%%rsi
+	addq	%%rbx,%%rsi
+	movl	$1,%%edi
+	call	%(write)s
+	testq	%%rax,%%rax
+	jle	out_flush_done
+	addl	%%eax,%%ebx
+	jmp	out_flush_write
+out_flush_done:
+	movl	$0,%%eax
+	movl	%%eax,out_len(%%rip)
+	movq	%%r12,%%rsp
+	popq	%%r12
+	popq	%%rbx
+	ret
+out_newline:
+	leaq	out_buf(%%rip),%%rax
+	movb	$10,(%%rax,%%rcx)
+	addl	$1,%%ecx
+	movl	%%ecx,out_len(%%rip)
+	movl	out_tty(%%rip),%%eax
+	testl	%%eax,%%eax
+	jne	out_newline_tty
+	ret
+out_newline_tty:
+	jg	%(flush)s
+	pushq	%%r12
+	movq	%%rsp,%%r12
+	andq	$-16,%%rsp
+	movl	$1,%%edi
+	call	%(isatty)s
+	movq	%%r12,%%rsp
+	popq	%%r12
+	movl	%%eax,out_tty(%%rip)
+	testl	%%eax,%%eax
+	jne	%(flush)s
+	ret
+%(char)s:
+	movl	out_len(%%rip),%%ecx
+	cmpl	$%(char_room)d,%%ecx
+	jle	out_char_room
+	pushq	%%rdi
+	call	%(flush)s
+	popq	%%rdi
+	movl	$0,%%ecx
+out_char_room:
+	leaq	out_buf(%%rip),%%rax
+	movl	%%edi,%%edx
+	movb	%%dl,(%%rax,%%rcx)
+	addl	$1,%%ecx
+	jmp	out_newline
+%(string)s:
+	movl	out_len(%%rip),%%ecx
+	leaq	out_buf(%%rip),%%r8
+out_string_copy:
+	movzbl	(%%rdi),%%eax
+	testl	%%eax,%%eax
+	je	out_newline
+	cmpl	$%(string_room)d,%%ecx
+	jl	out_string_room
+	movl	%%ecx,out_len(%%rip)
+	pushq	%%rdi
+	call	%(flush)s
+	popq	%%rdi
+	movl	$0,%%ecx
+	leaq	out_buf(%%rip),%%r8
+	movzbl	(%%rdi),%%eax
+out_string_room:
+	movb	%%al,(%%r8,%%rcx)
+	addl	$1,%%ecx
+	addq	$1,%%rdi
+	jmp	out_string_copy
+%(int)s:
+	movl	out_len(%%rip),%%ecx
+	cmpl	$%(int_room)d,%%ecx
+	jle	out_int_room
+	pushq	%%rdi
+	call	%(flush)s
+	popq	%%rdi
+	movl	$0,%%ecx
+out_int_room:
+	leaq	out_buf(%%rip),%%r8
+	movl	%%ecx,%%esi
+	movl	%%edi,%%ecx
+	testl	%%ecx,%%ecx
+	jl	out_int_sign
+	negl	%%ecx
+	jmp	out_int_digits
+out_int_sign:
+	movb	$45,(%%r8,%%rsi)
+	addl	$1,%%esi
+out_int_digits:
+	movl	$-10,%%eax
+out_int_count:
+	cmpl	%%eax,%%ecx
+	jg	out_int_counted
+	addl	$1,%%esi
+	cmpl	$-1000000000,%%eax
+	je	out_int_counted
+	imull	$10,%%eax
+	jmp	out_int_count
+out_int_counted:
+	movl	%%esi,%%edi
+out_int_digit:
+%(div)s
+	leal	(%%eax,%%eax,4),%%edx
+	addl	%%edx,%%edx
+	subl	%%ecx,%%edx
+	addl	$48,%%edx
+	movb	%%dl,(%%r8,%%rsi)
+	subl	$1,%%esi
+	movl	%%eax,%%ecx
+	testl	%%ecx,%%ecx
+	jne	out_int_digit
+	movl	%%edi,%%ecx
+	addl	$1,%%ecx
+	jmp	out_newline
+"""
+
+# append(array,value) as for i386, with the arguments in %rdi and %rsi
+APPEND_RUNTIME=r"""
+.text
+%(name)s:
+	movq	%%rdi,%%rax
+	movq	%%rsi,%%rdx
+	movl	8(%%rax),%%ecx
+	cmpl	16(%%rax),%%ecx
+	jae	%(name)s_grow
+%(name)s_store:
+	%(store)s	%(value)s,24(%%rax,%%rcx,%(size)d)
+	addl	$1,%%ecx
+	movl	%%ecx,8(%%rax)
+	ret
+%(name)s_grow:
+	shll	$1,16(%%rax)
+	movl	16(%%rax),%%esi
+	leaq	24(,%%rsi,%(size)d),%%rsi
+	pushq	%%rdx
+	call	%(realloc)s
+	popq	%%rdx
+	testq	%%rax,%%rax
+	je	%(exception)s
+	movl	8(%%rax),%%ecx
+	jmp	%(name)s_store
+"""
+
+# The arenas of emitter.py, with the arguments in %rdi and %rsi
+ARENA_RUNTIME=r"""
+.data
+arena_program:
+	.quad 0,0,0,0,0,0
+arena_scope:
+	.quad 0,0,0,0,0,0
+.text
+%(alloc)s:
+	movq	%%rdi,%%rdx
+	movl	%%esi,%%ecx
+	addq	$7,%%rcx
+	andq	$-8,%%rcx
+arena_alloc_bump:
+	movq	8(%%rdx),%%rax
+	addq	%%rax,%%rcx
+	cmpq	16(%%rdx),%%rcx
+	ja	arena_alloc_chunk
+	movq	%%rcx,8(%%rdx)
+	subq	%%rax,%%rcx
+	addq	%%rcx,24(%%rdx)
+	ret
+arena_alloc_chunk:
+	subq	%%rax,%%rcx
+	pushq	%%rbx
+	pushq	%%r12
+	subq	$8,%%rsp
+	movq	%%rdx,%%rbx
+	movq	%%rcx,%%r12
+	movq	40(%%rbx),%%rax
+	testq	%%rax,%%rax
+	je	arena_alloc_malloc
+	cmpq	$%(chunk_data)d,%%r12
+	ja	arena_alloc_malloc
+	movq	(%%rax),%%rcx
+	movq	%%rcx,40(%%rbx)
+	jmp	arena_alloc_push
+arena_alloc_malloc:
+	leaq	16(%%r12),%%rdi
+	cmpq	$%(chunk)d,%%rdi
+	jae	arena_alloc_size
+	movl	$%(chunk)d,%%edi
+arena_alloc_size:
+	movq	%%rdi,(%%rsp)
+	call	%(malloc)s
+	testq	%%rax,%%rax
+	je	%(exception)s
+	movq	(%%rsp),%%rcx
+	movq	%%rcx,8(%%rax)
+arena_alloc_push:
+	movq	(%%rbx),%%rcx
+	movq	%%rcx,(%%rax)
+	movq	%%rax,(%%rbx)
+	movq	8(%%rax),%%rcx
+	addq	%%rax,%%rcx
+	movq	%%rcx,16(%%rbx)
+	addq	$16,%%rax
+	movq	%%rax,8(%%rbx)
+	movq	%%rbx,%%rdx
+	movq	%%r12,%%rcx
+	addq	$8,%%rsp
+	popq	%%r12
+	popq	%%rbx
+	jmp	arena_alloc_bump
+%(mark)s:
+	leaq	arena_scope(%%rip),%%rcx
+	movq	(%%rcx),%%rax
+	movq	%%rax,(%%rdi)
+	movq	8(%%rcx),%%rax
+	movq	%%rax,8(%%rdi)
+	movq	24(%%rcx),%%rax
+	movq	%%rax,16(%%rdi)
+	ret
+%(release)s:
+	pushq	%%rbx
+	pushq	%%r12
+	subq	$8,%%rsp
+	movq	%%rdi,%%r12
+	leaq	arena_scope(%%rip),%%rbx
+	movq	24(%%rbx),%%rax
+	subq	16(%%r12),%%rax
+	addq	%%rax,32(%%rbx)
+	movq	16(%%r12),%%rax
+	movq	%%rax,24(%%rbx)
+arena_release_chunk:
+	movq	(%%rbx),%%rax
+	cmpq	(%%r12),%%rax
+	je	arena_release_done
+	movq	(%%rax),%%rcx
+	movq	%%rcx,(%%rbx)
+	cmpq	$%(chunk)d,8(%%rax)
+	jne	arena_release_free
+	movq	40(%%rbx),%%rcx
+	movq	%%rcx,(%%rax)
+	movq	%%rax,40(%%rbx)
+	jmp	arena_release_chunk
+arena_release_free:
+	movq	%%rax,%%rdi
+	call	%(free)s
+	jmp	arena_release_chunk
+arena_release_done:
+	movq	8(%%r12),%%rcx
+	movq	%%rcx,8(%%rbx)
+	testq	%%rax,%%rax
+	je	arena_release_end
+	addq	8(%%rax),%%rax
+arena_release_end:
+	movq	%%rax,16(%%rbx)
+	addq	$8,%%rsp
+	popq	%%r12
+	popq	%%rbx
+	ret
+"""
+
+ARENA_REPORT=r"""
+.data
+arena_format:
+	.asciz "arena: %%lu bytes allocated, %%lu bytes reclaimed\n"
+.text
+%(report)s:
+	subq	$8,%%rsp
+	call	%(flush)s
+	leaq	arena_scope(%%rip),%%rcx
+	movq	32(%%rcx),%%rax
+	movq	%%rax,%%r8
+	addq	24(%%rcx),%%rax
+	leaq	arena_program(%%rip),%%rcx
+	addq	24(%%rcx),%%rax
+	movq	%%rax,%%rdx
+	movq	%%r8,%%rcx
+	leaq	arena_format(%%rip),%%rsi
+	movl	$2,%%edi
+	xorl	%%eax,%%eax
+	call	%(dprintf)s
+	addq	$8,%%rsp
+	ret
+"""
+
+FUN_PROLOGUE="""
+.text
+.globl %s
+%s:
+	pushq	%%rbp
+	movq	%%rsp,%%rbp
+	pushq	%%rbx
+	pushq	%%r12
+	subq	$%d,%%rsp   # locals
+"""
+
+FUN_EPILOGUE=r"""
+	movl	$0,%eax  # return 0
+	movq	-8(%rbp),%rbx
+	movq	-16(%rbp),%r12
+	leave
+	ret
+"""
+
+ARG_REGS = ['%rdi','%rsi','%rdx','%rcx','%r8','%r9']
+
+
+class Func64(Func):
+
+    prologue = FUN_PROLOGUE
+    epilogue = FUN_EPILOGUE
+
+class Constants64(Constants):
+
+    word = '.quad'
+    align = 8
+
+
+def stack_offset64(index):
+    # Below the saved %rbx and %r12
+    return (index+3)*8
+
+class Emitter64(Emitter):
+    ''' x86-64 code, System V calls '''
+
+    word = 8
+    pointer = '%rbx'
+    scratch = '%ecx'
+    Func = Func64
+    Constants = Constants64
+    link_flags = []
+    append_runtime = APPEND_RUNTIME
+    append_store = {1:('movb','%dl'),4:('movl','%edx'),8:('movq','%rdx')}
+    output_runtime = output_runtime(OUTPUT_RUNTIME)
+    arena_runtime = ARENA_RUNTIME
+    arena_report = ARENA_REPORT
+
+    def const_pointer(self,label):
+        self.emit("leaq %s(%%rip),%%rbx" % label)
+
+    def allocate(self,size,arena=None):
+        if arena is None:
+            self.emit("movl $%d,%%edi" % size)
+            self.call_c('malloc')
+        else:
+            self.emit("leaq arena_%s(%%rip),%%rdi" % arena)
+            self.emit("movl $%d,%%esi" % size)
+            self.call_c('arena_alloc')
+        self.move_pointer()
+
+    def arena_mark(self,index):
+        self.emit("leaq -%d(%%rbp),%%rdi" % stack_offset64(index+ARENA_MARK-1))
+        self.call_c('arena_mark')
+
+    def arena_release(self,index):
+        self.emit("leaq -%d(%%rbp),%%rdi" % stack_offset64(index+ARENA_MARK-1))
+        self.call_c('arena_release')
+
+    def copy_const(self,label,size,arena=None):
+        self.allocate(size,arena)
+        self.emit("movq %rbx,%rdi")
+        self.emit("leaq %s(%%rip),%%rsi" % label)
+        self.emit("movl $%d,%%edx" % size)
+        self.call_c('memcpy')
+
+    def begin_prog(self):
+        self.emit_raw(PROG_PROLOGUE)
+        self.emit_raw(self.output_runtime)
+
+    def print_int(self):
+        self.emit("movl %eax,%edi")
+        self.call_c('out_int')
+
+    def print_char(self):
+        self.emit("movl %eax,%edi")
+        self.call_c('out_char')
+
+    def print_string(self):
+        self.emit("movq %rbx,%rdi")
+        self.call_c('out_string')
+
+    def push_imm_int(self,value):
+        self.emit("pushq $%d" % value)
+
+    def push_acc(self):
+        self.emit("pushq %rax")
+
+    def pop_acc(self):
+        self.emit("popq %rax")
+
+    def push_pointer(self):
+        self.emit("pushq %rbx")
+
+    def pop_pointer(self):
+        self.emit("popq %rbx")
+
+    def pop_add_pointer(self):
+        self.emit("addq (%rsp),%rbx")
+        self.emit("addq $8,%rsp")
+
+    def add_acc_to_pointer(self):
+        self.emit("movslq %eax,%rax")
+        self.emit("addq %rax,%rbx")
+
+    def store_acc_int_at(self,index=0):
+        self.emit("movl %%eax,%d(%%rbx)" % index)
+
+    def store_imm_int_at(self,index,val):
+        self.emit("movl $%d,%d(%%rbx)" % (val,index))
+
+    def load_acc_int_at(self,index=0):
+        self.emit("movl %d(%%rbx),%%eax" % index)
+
+    def pop_add_int(self):
+        self.emit("addl %eax,(%rsp)")
+        self.emit("popq %rax")
+
+    def pop_sub_int(self):
+        self.emit("subl %eax,(%rsp)")
+        self.emit("popq %rax")
+
+    def pop_mul_int(self):
+        self.emit("imull (%rsp)")
+        self.emit("addq $8,%rsp")
+
+    def pop_div_int(self):
+        self.emit("movl %eax,%ecx")
+        self.emit("popq %rax")
+        self.emit("cdq")
+        self.emit("idivl %ecx")
+
+    def load_var_int(self,index):
+        self.emit("movl -%d(%%rbp),%%eax" % (stack_offset64(index),))
+
+    def store_var_int(self,index):
+        self.emit("movl %%eax,-%d(%%rbp)" % (stack_offset64(index),))
+
+    def store_imm_var_int(self,index,value):
+        self.emit("movl $%d,-%d(%%rbp)" % (value,stack_offset64(index)))
+
+    def check_index(self,length_offset):
+        self.emit("cmpl %d(%%rbx),%%eax" % length_offset)
+        self.emit("jae %s" % mangle('exception'))
+
+    def pop_cmp_int(self):
+        self.emit("popq %rcx")
+        self.emit("cmpl %eax,%ecx")
+
+    def pop_relation(self,cond):
+        self.emit("cmpl %eax,(%rsp)")
+        self.emit("set%s %%al" % cond)
+        self.emit("movzbl %al,%eax")
+        self.emit("addq $8,%rsp")
+
+    def pop_lt_int(self):
+        self.pop_relation('l')
+
+    def pop_gt_int(self):
+        self.pop_relation('g')
+
+    def pop_le_int(self):
+        self.pop_relation('le')
+
+    def pop_ge_int(self):
+        self.pop_relation('ge')
+
+    def move_pointer(self):
+        self.emit("movq %rax,%rbx")
+
+    def move_acc(self):
+        self.emit("movq %rbx,%rax")
+
+    def store_acc_pointer_at(self,index=0):
+        self.emit("movq %%rax,%d(%%rbx)" % index)
+
+    def load_pointer_at(self,index=0):
+        self.emit("movq %d(%%rbx),%%rbx" % index)
+
+    def load_var_pointer(self,index):
+        self.emit("movq -%d(%%rbp),%%rbx" % (stack_offset64(index),))
+
+    def store_var_pointer(self,index):
+        self.emit("movq %%rbx,-%d(%%rbp)" % (stack_offset64(index),))
+
+    def call(self,func,argc):
+        for reg in ARG_REGS[:argc]:
+            self.emit("popq %s" % reg)
+        self.call_c(func)
+
+    def call_c(self,func):
+        ''' Call with the arguments in registers already '''
+        # Expression temporaries leave the stack at any depth
+        self.emit("movq %rsp,%r12")
+        self.emit("andq $-16,%rsp")
+        self.emit("xorl %eax,%eax") # no vector registers for varargs
+        self.emit("call %s" % mangle(func))
+        self.emit("movq %r12,%rsp")
+
+    def load_acc_byte_at(self,index=0):
+        self.emit("movzbl %d(%%rbx),%%eax" % index)
+
+    def store_acc_byte_at(self,index=0):
+        self.emit("movb %%al,%d(%%rbx)" % index)
+
+    def store_imm_byte_at(self,index,val):
+        self.emit("movb $%d,%d(%%rbx)" % (val,index))
+
+    def add_imm_to_pointer(self,offset):
+        self.emit("addq $%d,%%rbx" % offset)
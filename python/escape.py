@@ -0,0 +1,134 @@
+''' Escape analysis of arrays and strings, to put them in arenas.
+
+Every array constructor, empty array and copied string literal is an
+allocation site. A site whose array is assigned straight to a variable
+local to a block is allocated in the scope arena, and the block takes the
+memory back when it ends: the body of a while loop at the end of every
+iteration. Other sites use the program arena, which is never reclaimed,
+except the ones for arrays appended to, which append may realloc: those
+stay with malloc.
+
+A variable is local to a block when
+  - a statement of the block itself declares it, not one nested in an if
+    or while, so every run of the block assigns it before using it,
+  - it is used only inside the block, and
+  - its array is never loaded whole, except to be printed; a whole load
+    is how another variable or array comes to refer to it.
+
+The blocks' scopes nest: a block takes back all the scope arena memory
+allocated since it began. So a site uses the scope of its variable's
+block only if no block in between takes back memory itself.
+
+The checkers call enter() and leave() around a block, top_level() before
+each of its statements and nested() before the body of an if or while,
+declare() and use() for variables, escape() for a whole load and site()
+for an allocation, whose name they set if it is assigned to a variable.
+resolve() then decides the arena of every site.
+'''
+
+PROGRAM,SCOPE = 'program','scope'
+
+
+class Block:
+    ''' A block of statements, a scope of the arena once marked '''
+
+    def __init__(self,parent=None):
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.marked = False
+
+    def common(self,other):
+        ''' The innermost block enclosing both '''
+        a,b = self,other
+        while a.depth > b.depth:
+            a = a.parent
+        while b.depth > a.depth:
+            b = b.parent
+        while a is not b:
+            a,b = a.parent,b.parent
+        return a
+
+
+class Site:
+    ''' An allocation. arena is None for malloc, PROGRAM or SCOPE, and
+        scope the block taking a SCOPE allocation back.
+    '''
+
+    def __init__(self,block):
+        self.block = block
+        self.name = None # the variable it is assigned to
+        self.arena = PROGRAM
+        self.scope = None
+
+
+class Escapes:
+
+    def __init__(self):
+        self.block = Block() # the function's statements, never a scope
+        self.top = self.block # the block a statement is directly in, None if nested
+        self.blocks = []
+        self.homes = {} # variable: block declaring it with a statement of its own
+        self.uses = {} # variable: innermost block of all its uses
+        self.escaped = set()
+        self.sites = []
+
+    def enter(self):
+        self.block = Block(self.block)
+        self.blocks.append(self.block)
+        return self.block
+
+    def leave(self):
+        self.block = self.block.parent
+        self.top = None
+
+    def top_level(self):
+        self.top = self.block
+
+    def nested(self):
+        self.top = None
+
+    def declare(self,name):
+        self.homes[name] = self.block if self.top is self.block else None
+        self.uses[name] = self.block
+
+    def use(self,name):
+        self.uses[name] = self.uses[name].common(self.block)
+
+    def escape(self,name):
+        self.escaped.add(name)
+
+    def site(self,block=None):
+        ''' A new allocation in block, the current one by default '''
+        site = Site(block or self.block)
+        self.sites.append(site)
+        return site
+
+    def local(self,name):
+        ''' The block name is local to, None if there is none '''
+        home = self.homes.get(name)
+        if home is None or home.parent is None or name in self.escaped:
+            return None
+        return home if self.uses[name] is home else None
+
+    def resolve(self,appended=()):
+        ''' Decide the arena of every site, return the blocks that are scopes '''
+        scoped = []
+        for site in self.sites:
+            if site.name in appended:
+                site.arena = None
+            elif site.name:
+                site.scope = self.local(site.name)
+                if site.scope:
+                    scoped.append(site)
+        # Inner scopes first, a block they mark is in the way of outer ones
+        scoped.sort(key=lambda site: -site.scope.depth)
+        for site in scoped:
+            block = site.block
+            while block is not site.scope and not block.marked:
+                block = block.parent
+            if block is site.scope:
+                site.arena = SCOPE
+                block.marked = True
+            else:
+                site.scope = None
+        return [block for block in self.blocks if block.marked]
@@ -0,0 +1,461 @@
+''' In-process execution of Sofort programs, for compiler.py --run.
+
+compile_program() turns the SofortParser AST into a tree of Python
+closures, one per node, built once: variables are resolved to slots of a
+list, types are checked and print formats chosen ahead of time, and
+operations on a constant or a variable get closures specialized for them,
+so running a statement is a few calls with no dispatch on node kinds.
+
+The semantics are those of the generated code:
+
+  - ints are 32-bit and wrap; division truncates toward zero, and
+    division by zero or of INT_MIN by -1 traps like idivl
+  - chars are ints in registers and variables and bytes in arrays
+  - arrays and strings are references; a string literal is a new string
+    each time it is evaluated; an array appended to is referenced by its
+    variable alone
+  - an index outside [0,length) prints "Exception." with puts and exits
+    with status 1
+  - print is printf "%d\\n", "%c\\n" or "%s\\n"; a string prints up to
+    its first NUL; output is buffered as the generated code buffers it,
+    so a trap loses the same lines
+
+run(ast,out) executes the program and returns its exit status.
+'''
+import sys
+from cStringIO import StringIO
+
+from sofortTypes import *
+from parser import ParserException, Appends
+from emitter import OUTPUT_SIZE
+
+BITS = INT_SIZE*8
+SIGN = 1 << (BITS-1)
+MASK = (1 << BITS) - 1
+
+# Exit status of a process killed by SIGFPE, as the shell reports it
+TRAP_STATUS = 128 + 8
+
+TYPE_MAP = {
+    'int' : Int,
+    'char' : Char,
+    'string' : String,
+}
+
+class IndexException(Exception):
+    ''' An array index failed the bounds check '''
+
+class Trap(Exception):
+    ''' The division would fault in idivl '''
+
+
+class Output:
+    ''' The print buffer of the generated code, flushed at the same points:
+        when a print may not fit, at the end and before "Exception.", and
+        after every line to a terminal. A trap loses what it holds.
+    '''
+    def __init__(self,out):
+        self.out = out
+        self.tty = out.isatty()
+        self.buffer = StringIO()
+        self.write,self.tell = self.buffer.write,self.buffer.tell
+
+    def clear(self):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def flush(self):
+        self.out.write(self.buffer.getvalue())
+        self.out.flush()
+        self.clear()
+
+    def string(self,text):
+        # The bytes are copied one by one, flushing when the buffer is full
+        room = OUTPUT_SIZE - 1 - self.tell()
+        while len(text) > room:
+            self.write(text[:room])
+            self.flush()
+            text,room = text[room:],OUTPUT_SIZE - 1
+        self.write(text + '\n')
+        if self.tty:
+            self.flush()
+
+
+def div(a,b):
+    if b == 0 or b == -1 and a == INT_MIN:
+        raise Trap()
+    return trunc_div(a,b)
+
+def div_imm(b):
+    ''' Division by a constant that cannot trap, except INT_MIN by -1 '''
+    if b == -1:
+        return lambda a: div(a,b)
+    if b > 0:
+        return lambda a: a // b if a >= 0 else -(-a // b)
+    return lambda a: -(a // -b) if a >= 0 else (-a) // -b
+
+
+class Expr:
+    ''' A compiled expression: the closure computing it, its type and,
+        for a constant or a variable, the value or the slot
+    '''
+    def __init__(self,get,type,const=None,slot=None):
+        self.get = get
+        self.type = type
+        self.const = const
+        self.slot = slot
+
+
+class ClosureCompiler:
+
+    def __init__(self,out):
+        self.output = Output(out)
+        self.frame = []
+        self.slots = {}
+        self.types = {}
+        self.appends = Appends()
+
+    def compile(self,ast):
+        main = None
+        for func in ast:
+            assert func[0] == 'FUNC'
+            if func[1] == 'main':
+                main = self.stat(func[4])
+        frame,size,output = self.frame,len(self.slots),self.output
+        def run():
+            frame[:] = [0] * size
+            output.clear()
+            try:
+                main()
+            except IndexException:
+                output.flush()
+                raise
+            output.flush()
+        return run
+
+    def stat(self,node):
+        return getattr(self,'stat_%s' % node[0])(node)
+
+    def expr(self,node):
+        return getattr(self,'expr_%s' % node[0])(node)
+
+    def Type(self,type):
+        typelist = type[1]
+        type = TYPE_MAP[typelist[-1]]()
+        for t in reversed(typelist[:-1]):
+            if t != '[':
+                raise ParserException('Illegal type %s' % str(type))
+            type = DynamicArray(type)
+        return type
+
+    def slot(self,name):
+        try:
+            return self.slots[name]
+        except KeyError:
+            raise ParserException('Unknown variable %s' % name)
+
+    def check_op(self,left,right,op):
+        if not left.typeof(right):
+            raise ParserException('Incompatible types in %s %s %s' % (left,op,right))
+        type = left.union(right)
+        if not type.get_operation(op):
+            raise ParserException('Operation "%s" not supported by type "%s"' % (op,type))
+        return type
+
+    # Statements
+
+    def stat_BLOCK(self,node):
+        stats = tuple(self.stat(s) for s in node[1])
+        if len(stats) == 1:
+            return stats[0]
+        if len(stats) == 2:
+            first,second = stats
+            def block2():
+                first()
+                second()
+            return block2
+        def block():
+            for s in stats:
+                s()
+        return block
+
+    def stat_DECLARE(self,node):
+        lval,expr = node[1:]
+        expr = self.expr(expr)
+        self.assigned(lval,node[2],expr.type)
+        if lval[1] not in self.slots:
+            self.slots[lval[1]] = len(self.slots)
+        self.types[lval[1]] = expr.type.runtime()
+        return self.store(lval,expr)
+
+    def stat_ASSIGN(self,node):
+        lval,expr = node[1:]
+        expr = self.expr(expr)
+        self.assigned(lval,node[2],expr.type)
+        return self.store(lval,expr)
+
+    def assigned(self,lval,node,type):
+        ''' Only a new array assigned to a variable is not shared '''
+        if lval[0] == 'ID' and isinstance(type,Array) and node[0] not in ('ARRAY_CONS','ARRAY_INIT'):
+            self.appends.share(lval[1])
+
+    def store(self,lval,expr):
+        get,frame = expr.get,self.frame
+        if lval[0] == 'ID':
+            slot = self.slot(lval[1])
+            if not self.types[lval[1]].typeof(expr.type):
+                raise ParserException('Illegal assignment of %s to %s' % (expr.type,self.types[lval[1]]))
+            if expr.const is not None:
+                value = expr.const
+                def store_const():
+                    frame[slot] = value
+                return store_const
+            def store_var():
+                frame[slot] = get()
+            return store_var
+        array,index = self.element(lval)
+        if not array.type.subtype.typeof(expr.type):
+            raise ParserException('Illegal assignment of %s to %s' % (expr.type,array.type.subtype))
+        if array.type.subtype.sizeof == 1:
+            value = get
+            get = lambda: value() & 0xff
+        slot,index = array.slot,index.get
+        def store_element():
+            value = get()
+            i = index()
+            a = frame[slot]
+            if not 0 <= i < len(a):
+                raise IndexException()
+            a[i] = value
+        return store_element
+
+    def stat_PRINT(self,node):
+        expr = self.expr(node[1])
+        type,get,output = expr.type,expr.get,self.output
+        if isinstance(type,String):
+            out_string = output.string
+            def print_string():
+                s = get()
+                end = s.index(0) if 0 in s else len(s)
+                out_string(''.join(map(chr,s[:end])))
+            return print_string
+        # Room the runtime checks for before a print, see OUTPUT_RUNTIME
+        write,tell,flush,tty = output.write,output.tell,output.flush,output.tty
+        if isinstance(type,Char):
+            room = OUTPUT_SIZE - 2
+            def print_char():
+                if tell() > room:
+                    flush()
+                write(chr(get() & 0xff) + '\n')
+                if tty:
+                    flush()
+            return print_char
+        if isinstance(type,Int):
+            room = OUTPUT_SIZE - 12 # "-2147483648\n"
+            def print_int():
+                if tell() > room:
+                    flush()
+                write('%d\n' % get())
+                if tty:
+                    flush()
+            return print_int
+        raise ParserException('Unsupported type %s' % type)
+
+    def stat_APPEND(self,node):
+        name = node[1][1]
+        slot,type = self.slot(name),self.types[name]
+        if not isinstance(type,DynamicArray) or isinstance(type,String):
+            raise ParserException('Cannot append to %s' % type)
+        self.appends.append(name)
+        expr = self.expr(node[2])
+        if not type.subtype.typeof(expr.type):
+            raise ParserException('Illegal append of %s to %s' % (expr.type,type))
+        get,frame = expr.get,self.frame
+        if type.subtype.sizeof == 1:
+            value = get
+            get = lambda: value() & 0xff
+        def append():
+            frame[slot].append(get())
+        return append
+
+    def condition(self,node):
+        cond = self.expr(node)
+        if isinstance(cond.type,Array):
+            # A pointer is never null
+            get = cond.get
+            def true():
+                get()
+                return True
+            return true
+        return cond.get
+
+    def stat_IF(self,node):
+        cond,then = self.condition(node[1]),self.stat(node[2])
+        def if_():
+            if cond():
+                then()
+        return if_
+
+    def stat_IFELSE(self,node):
+        cond,then,else_ = self.condition(node[1]),self.stat(node[2]),self.stat(node[3])
+        def if_else():
+            if cond():
+                then()
+            else:
+                else_()
+        return if_else
+
+    def stat_WHILE(self,node):
+        cond,body = self.condition(node[1]),self.stat(node[2])
+        def while_():
+            while cond():
+                body()
+        return while_
+
+    # Expressions
+
+    def expr_ID(self,node):
+        expr = self.variable(node)
+        if isinstance(expr.type,Array):
+            self.appends.share(node[1])
+        return expr
+
+    def variable(self,node):
+        slot,frame = self.slot(node[1]),self.frame
+        return Expr(lambda: frame[slot],self.types[node[1]],slot=slot)
+
+    def element(self,node):
+        array = self.variable(node)
+        if not isinstance(array.type,Array):
+            raise ParserException('Expected array, not "%s"' % array.type)
+        index = self.expr(node[2])
+        if not isinstance(index.type,Int):
+            raise ParserException('Array index must be int')
+        return array,index
+
+    def expr_INDEX(self,node):
+        array,index = self.element(node)
+        slot,frame = array.slot,self.frame
+        if index.const is not None:
+            i = index.const
+            if i < 0:
+                def fail():
+                    raise IndexException()
+                return Expr(fail,array.type.subtype.runtime())
+            def load_const():
+                a = frame[slot]
+                if i < len(a):
+                    return a[i]
+                raise IndexException()
+            return Expr(load_const,array.type.subtype.runtime())
+        get = index.get
+        def load():
+            i = get()
+            a = frame[slot]
+            if 0 <= i < len(a):
+                return a[i]
+            raise IndexException()
+        return Expr(load,array.type.subtype.runtime())
+
+    def constant(self,type,value):
+        return Expr(lambda: value,type.constant(value),value)
+
+    def expr_INT(self,node):
+        return self.constant(Int(),wrap(node[1]))
+
+    def expr_CHAR(self,node):
+        return self.constant(Char(),ord(node[1]))
+
+    def expr_STRING(self,node):
+        codes = map(ord,node[1])
+        return Expr(lambda: codes[:],String())
+
+    def expr_ARRAY_CONS(self,node):
+        elements = [self.expr(e) for e in node[1]]
+        subtype = elements[0].type.runtime()
+        for e in elements[1:]:
+            if not subtype.typeof(e.type):
+                raise ParserException('Type mismatch in array constructor:  %s and %s.' %
+                    (subtype,e.type))
+        gets = tuple(e.get for e in elements)
+        if subtype.sizeof == 1:
+            return Expr(lambda: [g() & 0xff for g in gets],DynamicArray(subtype))
+        return Expr(lambda: [g() for g in gets],DynamicArray(subtype))
+
+    def expr_ARRAY_INIT(self,node):
+        return Expr(lambda: [],DynamicArray(self.Type(node[1])))
+
+    def expr_NEG(self,node):
+        expr = self.expr(node[1])
+        type = expr.type
+        if not type.get_operation('neg'):
+            raise ParserException('Operation "neg" not supported by type "%s"' % type)
+        if expr.const is not None:
+            return self.constant(type.runtime(),wrap(-expr.const))
+        get = expr.get
+        return Expr(lambda: (SIGN - get() & MASK) - SIGN,type)
+
+    def expr_ARITH(self,node):
+        op = node[1]
+        left,right = self.expr(node[2]),self.expr(node[3])
+        type = self.check_op(left.type,right.type,op).runtime()
+        a,b = left.const,right.const
+        if a is not None and b is not None and (op != 'div' or b not in (0,-1)):
+            value = wrap(div(a,b) if op == 'div' else
+                {'add':a+b,'sub':a-b,'mul':a*b}[op])
+            return self.constant(type,value)
+        l,r,frame,slot = left.get,right.get,self.frame,left.slot
+        if op == 'div':
+            if b is not None and b != 0:
+                d = div_imm(b)
+                return Expr(lambda: d(l()),type)
+            return Expr(lambda: div(l(),r()),type)
+        if op == 'mul':
+            if b is not None:
+                return Expr(lambda: (l()*b + SIGN & MASK) - SIGN,type)
+            return Expr(lambda: (l()*r() + SIGN & MASK) - SIGN,type)
+        if b is not None:
+            # x + k and x - k, with the sign bias folded into k
+            k = (b if op == 'add' else -b) + SIGN
+            if slot is not None:
+                return Expr(lambda: (frame[slot] + k & MASK) - SIGN,type)
+            return Expr(lambda: (l() + k & MASK) - SIGN,type)
+        if op == 'add':
+            return Expr(lambda: (l() + r() + SIGN & MASK) - SIGN,type)
+        return Expr(lambda: (l() - r() + SIGN & MASK) - SIGN,type)
+
+    def expr_RELOP(self,node):
+        op = node[1]
+        left,right = self.expr(node[2]),self.expr(node[3])
+        self.check_op(left.type,right.type,op)
+        l,r,b,slot,frame = left.get,right.get,right.const,left.slot,self.frame
+        if slot is not None and b is not None:
+            get = {'lt':lambda: frame[slot] < b,'gt':lambda: frame[slot] > b,
+                'le':lambda: frame[slot] <= b,'ge':lambda: frame[slot] >= b}[op]
+        elif b is not None:
+            get = {'lt':lambda: l() < b,'gt':lambda: l() > b,
+                'le':lambda: l() <= b,'ge':lambda: l() >= b}[op]
+        else:
+            get = {'lt':lambda: l() < r(),'gt':lambda: l() > r(),
+                'le':lambda: l() <= r(),'ge':lambda: l() >= r()}[op]
+        return Expr(get,Int())
+
+
+def compile_program(ast,out=sys.stdout):
+    ''' A function running the program, printing to out '''
+    return ClosureCompiler(out).compile(ast)
+
+def run(ast,out=sys.stdout):
+    ''' Run the program, return its exit status '''
+    program = compile_program(ast,out)
+    try:
+        program()
+    except IndexException:
+        out.write('Exception.\n\n')
+        return 1
+    except Trap:
+        # The generated code dies with its buffer, see Output
+        out.flush()
+        sys.stderr.write('Floating point exception\n')
+        return TRAP_STATUS
+    return 0
@@ -0,0 +1,408 @@
+''' Incremental re-parsing of Sofort sources.
+
+IncrementalParser keeps the source text and, for every top-level statement
+of the last parse, its ASTNode, its start offset and the variables it
+declares and uses. After an edit only the statements overlapping the edited
+range are re-scanned and re-parsed; all other ASTNodes are reused.
+
+A statement's line is kept relative to the first line of the top-level
+statement it is in, and that line is shifted lazily like the start offsets,
+so an edit adding a line costs the same as one within a line. The ASTNodes
+are shared between the ASTs returned, so an AST from before an edit reads
+the lines after it.
+
+Example:
+
+  inc = IncrementalParser(open('prog.sofort').read(),'prog.sofort')
+  ast = inc.parse()
+  ast = inc.edit(10,12,'42')   # replace text[10:12] with '42'
+
+python incremental.py file.sofort [edits [seed]] makes random edits to the
+file and checks every AST, lines included, against a parse from scratch.
+'''
+import random
+import sys
+from bisect import bisect_left, bisect_right
+
+from scanner import *
+from parser import *
+
+
+class Source:
+    ''' Stands in for the source file, scanners only need its name '''
+
+    def __init__(self,name):
+        self.name = name
+
+
+class StatInfo(object):
+    ''' Bookkeeping for one top-level statement.
+        key orders statements without depending on offsets, so it stays
+        valid across edits (see IncrementalParser.new_keys).
+    '''
+    __slots__ = ('key','decls','names')
+
+    def __init__(self,key,node):
+        self.key = key
+        self.decls = set()
+        self.names = set()
+        collect_names(node,self.decls,self.names)
+
+
+def collect_names(node,decls,names):
+    ''' Gather variables declared and mentioned in an AST subtree '''
+    if isinstance(node,list):
+        for n in node:
+            collect_names(n,decls,names)
+        return
+    kind = node[0]
+    if kind == 'DECLARE':
+        decls.add(node[1][1])
+    elif kind == 'ID' or kind == 'INDEX':
+        names.add(node[1])
+    for n in node[1:]:
+        if isinstance(n,(tuple,list)):
+            collect_names(n,decls,names)
+
+
+class Lines(object):
+    ''' First line of a top-level statement. Past the split point of its
+        IncrementalParser the statement is also moved by shift[0].
+    '''
+    __slots__ = ('line','shift')
+
+    def __init__(self,line,shift=None):
+        self.line = line
+        self.shift = shift
+
+
+class LineNode(ASTTuple):
+    ''' Statement ASTNode whose line is an offset from its top-level
+        statement's Lines
+    '''
+
+    @property
+    def text(self):
+        top = self.top
+        if top.shift:
+            return top.line + top.shift[0] + self.offset
+        return top.line + self.offset
+
+
+def relative(node,top):
+    ''' Copy of a statement's ASTNode with its line, and those of the
+        statements nested in it, relative to top
+    '''
+    kind = node[0]
+    if kind == 'BLOCK':
+        fields = (kind,[relative(s,top) for s in node[1]])
+    elif kind == 'IF' or kind == 'WHILE':
+        fields = node[:2] + (relative(node[2],top),)
+    elif kind == 'IFELSE':
+        fields = node[:2] + (relative(node[2],top),relative(node[3],top))
+    else:
+        fields = node
+    copy = LineNode(fields)
+    copy.top = top
+    copy.offset = node.text - top.line
+    return copy
+
+def statement(parser):
+    ''' Parse a top-level statement '''
+    node = parser.Statement()
+    return relative(node,Lines(node.text))
+
+
+class EditNamespace(Namespace):
+    ''' Namespace seen by a statement re-parsed after an edit: names declared
+        by re-parsed statements so far, then names first declared by
+        statements ordered before self.key in the previous parse.
+    '''
+
+    def __init__(self,first_decl,removed):
+        Namespace.__init__(self)
+        self.begin_scope()
+        self.first_decl = first_decl
+        self.removed = removed
+        self.key = None
+
+    def get_var(self,name):
+        var = Namespace.get_var(self,name)
+        if var or name in self.removed:
+            return var
+        info = self.first_decl.get(name)
+        return info is not None and info.key < self.key
+
+
+class IncrementalParser:
+
+    def __init__(self,text,name='<edit>',engine='char'):
+        self.text = text
+        self.source = Source(name)
+        self.engine = engine
+        self.nodes = None
+
+    def top(self):
+        return [('FUNC','main',('TYPE',['int']),[],('BLOCK',self.nodes))]
+
+    def parse(self):
+        ''' Parse the whole text from scratch '''
+        self.nodes = None
+        parser = self.parser(0,1,0)
+        nodes,infos = [],[]
+        starts = []
+        while parser.token.kind != T_EOF:
+            starts.append(self.token_offset(parser))
+            node = statement(parser)
+            nodes.append(node)
+            infos.append(StatInfo(float(len(infos)),node))
+        self.nodes,self.infos,self.starts = nodes,infos,starts
+        # starts[i] is off by self.pending for i >= self.split, and
+        # the lines of nodes[i] by self.shift[0]
+        self.split,self.pending = len(starts),0
+        self.shift = [0]
+        self.first_decl = {}
+        for info in infos:
+            for name in info.decls:
+                self.first_decl[name] = info
+        return self.top()
+
+    def edit(self,start,end,new_text):
+        ''' Replace text[start:end] with new_text and update the AST.
+            If the new text does not parse, the exception propagates and the
+            next edit parses the whole text again.
+        '''
+        self.text = self.text[:start] + new_text + self.text[end:]
+        if self.nodes is None:
+            return self.parse()
+        try:
+            self.reparse(start,end,len(new_text) - (end - start))
+        except:
+            self.nodes = None
+            raise
+        return self.top()
+
+    def reparse(self,start,end,delta):
+        nodes,infos = self.nodes,self.infos
+        n = len(nodes)
+        # Statements whose extent (up to the next statement) touches [start,end]
+        first = max(self.locate(start,bisect_left) - 1,0)
+        last = self.locate(end,bisect_right) - 1
+        if first == 0:
+            parser = self.parser(0,1,0)
+        else:
+            offset = self.start_of(first)
+            parser = self.parser(offset,nodes[first].text,self.text.rfind('\n',0,offset) + 1)
+        removed = set()
+        for info in infos[first:last+1]:
+            removed.update(info.decls)
+        namespace = EditNamespace(self.first_decl,removed)
+        namespace.key = infos[first].key if n else 0.0
+        parser.namespace = namespace
+        # Parse until the scanner reaches the (shifted) start of an old statement
+        new_nodes,new_starts = [],[]
+        j = last + 1
+        while True:
+            offset = self.token_offset(parser)
+            while j < n and self.start_of(j) + delta < offset:
+                for name in infos[j].decls:
+                    removed.add(name)
+                j += 1
+            if parser.token.kind == T_EOF or j < n and self.start_of(j) + delta == offset:
+                break
+            new_starts.append(offset)
+            new_nodes.append(statement(parser))
+        line_delta = parser.token.line - nodes[j].text if j < n else 0
+        keys = self.new_keys(first,j,len(new_nodes))
+        new_infos = [StatInfo(k,node) for k,node in zip(keys,new_nodes)]
+        # Names whose declared-ness after the edited region changed
+        old_decls = set()
+        for info in infos[first:j]:
+            old_decls.update(info.decls)
+        new_decls = set()
+        for info in new_infos:
+            new_decls.update(info.decls)
+        diff = dict((name,name in old_decls) for name in old_decls ^ new_decls)
+        # Re-parse later statements mentioning such names, until it settles.
+        # namespace already holds everything declared by the new statements.
+        redone = []
+        k = j
+        while diff and k < n:
+            info = infos[k]
+            if not diff.viewkeys() & info.names:
+                k += 1
+                continue
+            offset = self.start_of(k) + delta
+            parser = self.parser(offset,nodes[k].text + line_delta,self.text.rfind('\n',0,offset) + 1)
+            namespace.key = info.key
+            parser.namespace = namespace
+            node = statement(parser)
+            redo = StatInfo(info.key,node)
+            for name,old_declared in diff.items():
+                new_declared = not old_declared or name in redo.decls
+                old_declared = old_declared or name in info.decls
+                if old_declared == new_declared:
+                    del diff[name]
+                else:
+                    diff[name] = old_declared
+            redone.append((k,node,redo))
+            k += 1
+        self.commit(first,j,new_nodes,new_infos,new_starts,redone,delta,line_delta)
+
+    def commit(self,first,j,new_nodes,new_infos,new_starts,redone,delta,line_delta):
+        nodes,infos = self.nodes,self.infos
+        self.settle(j)
+        # Lines from j on follow, without visiting their statements
+        self.shift[0] += line_delta
+        for info in infos[first:j]:
+            for name in info.decls:
+                if self.first_decl.get(name) is info:
+                    del self.first_decl[name]
+        for k,node,redo in redone:
+            old = infos[k]
+            for name in old.decls:
+                if self.first_decl.get(name) is old:
+                    del self.first_decl[name]
+            node.top.line -= self.shift[0]
+            node.top.shift = self.shift
+            nodes[k] = node
+            infos[k] = redo
+        # Re-point first declarations: a name may now be declared earlier
+        for info in new_infos + [redo for k,node,redo in redone]:
+            for name in info.decls:
+                current = self.first_decl.get(name)
+                if current is None or info.key < current.key:
+                    self.first_decl[name] = info
+        m = len(new_nodes)
+        nodes[first:j] = new_nodes
+        infos[first:j] = new_infos
+        self.starts[first:j] = new_starts
+        self.split = first + m
+        self.pending += delta
+
+    def new_keys(self,first,j,count):
+        ''' Order keys for count statements replacing infos[first:j] '''
+        infos = self.infos
+        lo = infos[first-1].key if first > 0 else -1.0
+        hi = infos[j].key if j < len(infos) else lo + count + 1
+        step = (hi - lo) / (count + 1)
+        if count and step < 1e-6:
+            # Ran out of room between neighbours, renumber everything
+            for i,info in enumerate(infos):
+                info.key = float(i) * (count + 1)
+            return self.new_keys(first,j,count)
+        return [lo + step * (i + 1) for i in range(count)]
+
+    def start_of(self,i):
+        if i >= self.split:
+            return self.starts[i] + self.pending
+        return self.starts[i]
+
+    def locate(self,offset,bisect):
+        ''' bisect the statement starts, which are stored in two sorted parts '''
+        starts,k = self.starts,self.split
+        if k < len(starts) and offset >= starts[k] + self.pending:
+            return bisect(starts,offset - self.pending,k)
+        return bisect(starts,offset,0,k)
+
+    def settle(self,i):
+        ''' Move the split point to i, so that starts below i are exact.
+            Costs the distance between consecutive edits, not the file size.
+        '''
+        starts,pending,nodes = self.starts,self.pending,self.nodes
+        shift = self.shift
+        if i > self.split:
+            for t in xrange(self.split,i):
+                starts[t] += pending
+                top = nodes[t].top
+                top.line += shift[0]
+                top.shift = None
+        else:
+            for t in xrange(i,self.split):
+                starts[t] -= pending
+                top = nodes[t].top
+                top.line -= shift[0]
+                top.shift = shift
+        self.split = i
+
+    def parser(self,start,line,line_start):
+        scanner = make_scanner(self.source,self.engine,
+            data=self.text,start=start,line=line,line_start=line_start)
+        parser = SofortParser(scanner)
+        parser.namespace.begin_scope()
+        return parser
+
+    def token_offset(self,parser):
+        return parser.scanner.offset(parser.token.pos)
+
+def statement_lines(node,lines=None):
+    ''' (kind,first line) of every statement, nested ones included '''
+    lines = [] if lines is None else lines
+    if isinstance(node,list):
+        for n in node:
+            statement_lines(n,lines)
+        return lines
+    if getattr(node,'text',None) is not None:
+        lines.append((node[0],node.text))
+    for n in node[1:]:
+        if isinstance(n,(tuple,list)):
+            statement_lines(n,lines)
+    return lines
+
+def fresh_parse(text):
+    try:
+        return IncrementalParser(text).parse()
+    except AppException:
+        return None
+
+def check(text,edits=1000,seed=0):
+    ''' Make random edits to text and compare each AST, and the lines of
+        its statements, with a parse from scratch. An edit that breaks the
+        program is undone by the next one. Returns the edits whose AST
+        differed.
+    '''
+    r = random.Random(seed)
+    inc = IncrementalParser(text)
+    fresh_parse(text) and inc.parse()
+    differ = []
+    undo = None
+    for i in xrange(edits):
+        lines = [0] + [k + 1 for k,c in enumerate(text) if c == '\n' and k + 1 < len(text)]
+        start = end = r.choice(lines)
+        choice = r.random()
+        if undo:
+            start,end,new_text = undo
+        elif choice < 0.3:
+            new_text = '\n' * r.randrange(1,3)
+        elif choice < 0.5:
+            end = text.find('\n',start) + 1 or len(text) # remove a line
+            new_text = ''
+        elif choice < 0.7:
+            a = r.choice(lines)
+            new_text = text[a:text.find('\n',a) + 1] # copy a line
+        else:
+            start = r.randrange(len(text) + 1)
+            end = min(len(text),start + r.randrange(3))
+            new_text = r.choice(['',' ','1','\n','x','{'])
+        undo = start,start + len(new_text),text[start:end]
+        text = text[:start] + new_text + text[end:]
+        try:
+            ast = inc.edit(start,end,new_text)
+        except AppException:
+            ast = None
+        expected = fresh_parse(text)
+        if expected is not None:
+            undo = None
+        if ast != expected or ast and statement_lines(ast) != statement_lines(expected):
+            differ.append((start,end,new_text))
+    return differ
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: incremental.py file.sofort [edits [seed]]'
+        sys.exit(1)
+    differ = check(open(sys.argv[1]).read(),*[int(a) for a in sys.argv[2:]])
+    for edit in differ:
+        print 'differs after edit %d:%d %r' % edit
+    print '%d edits differ' % len(differ)
+    sys.exit(1 if differ else 0)
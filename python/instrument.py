@@ -0,0 +1,147 @@
+''' Wall time and peak memory per compiler phase, and counters, for
+compiler.py --profile.
+
+The driver marks the start of each phase with phase(name) and records
+counts with count(name,value). Without --profile it gets NOT_PROFILED,
+whose methods do nothing, so the cost is a few empty calls per compile.
+
+Scanning is interleaved with parsing, so a profiled scanner has its
+scan() wrapped and timed. The scan time is reported as a phase of its
+own and taken out of the phase that drove the scanner.
+
+Peak memory is the process's peak resident size when the phase ended;
+Python 2 cannot tell which phase allocated what.
+'''
+import json
+import re
+import resource
+import time
+
+# Frame allocation in a function prologue, by either backend
+FRAME = re.compile(r'sub[lq]\s+\$(\d+),%[er]sp')
+
+def max_rss():
+    ''' Peak resident size of the process in KB (on Linux) '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def asm_counts(buffer):
+    ''' (instructions,labels,frame bytes) of an emitter's buffer '''
+    instructions = labels = stack = 0
+    for line in '\n'.join(buffer).split('\n'):
+        line = line.strip()
+        if not line or line[0] in '.#':
+            continue
+        if line.endswith(':'):
+            labels += 1
+            continue
+        instructions += 1
+        frame = FRAME.match(line)
+        if frame:
+            stack += int(frame.group(1))
+    return instructions,labels,stack
+
+def ir_variables(funcs):
+    ''' Source variables of Simple-IR functions, the registers not named %n '''
+    names = set()
+    for header,body in funcs:
+        for inst in body:
+            if inst[0] in ('label','jmp','mark','release'):
+                continue
+            if inst[0] == 'jz':
+                operands = inst[2:-1]
+            elif inst[0] == 'alloc':
+                operands = inst[-1:] # not the arena
+            else:
+                operands = inst[2:]
+            names.update(op for op in operands if isinstance(op,str) and op[0] != '%')
+    return names
+
+def count_nodes(node):
+    if isinstance(node,list):
+        return sum(count_nodes(n) for n in node)
+    return 1 + sum(count_nodes(n) for n in node[1:] if isinstance(n,(tuple,list)))
+
+
+class NotProfiled:
+    ''' Instrument that records nothing '''
+
+    enabled = False
+
+    def phase(self,name):
+        pass
+
+    def count(self,name,value):
+        pass
+
+    def scanner(self,scanner):
+        return scanner
+
+NOT_PROFILED = NotProfiled()
+
+
+class Profile:
+
+    enabled = True
+
+    def __init__(self):
+        self.phases = [] # (name,seconds,peak KB)
+        self.counters = [] # (name,value)
+        self.current = None
+        self.scan_time = 0.0
+
+    def phase(self,name):
+        ''' End the running phase, if any, and start name '''
+        now = time.time()
+        self.stop(now)
+        self.current = name,now
+
+    def stop(self,now=None):
+        if self.current is None:
+            return
+        name,start = self.current
+        seconds = (now or time.time()) - start
+        if self.scan_time:
+            self.phases.append(('scan',self.scan_time,None))
+            seconds -= self.scan_time
+            self.scan_time = 0.0
+        self.phases.append((name,seconds,max_rss()))
+        self.current = None
+
+    def count(self,name,value):
+        self.counters.append((name,value))
+
+    def scanner(self,scanner):
+        ''' The scanner, with scan() timed and tokens counted '''
+        scan,clock = scanner.scan,time.time
+        tokens = [0]
+        def timed_scan():
+            start = clock()
+            token = scan()
+            self.scan_time += clock() - start
+            tokens[0] += 1
+            return token
+        scanner.scan = timed_scan
+        self.count('tokens',tokens)
+        return scanner
+
+    def values(self):
+        # Counters given as one-element lists were still counting when added
+        return [(name,value[0] if isinstance(value,list) else value)
+            for name,value in self.counters]
+
+    def report(self,file,format='table'):
+        self.stop()
+        total = sum(seconds for name,seconds,peak in self.phases)
+        if format == 'json':
+            json.dump({'phases':[{'name':name,'seconds':seconds,'peak_kb':peak}
+                for name,seconds,peak in self.phases],'total_seconds':total,
+                'counters':dict(self.values())},file,indent=1,sort_keys=True)
+            print >> file
+            return
+        print >> file, '%-10s %10s %6s %10s' % ('phase','ms','%','peak KB')
+        for name,seconds,peak in self.phases:
+            print >> file, '%-10s %10.2f %6.1f %10s' % (name,seconds*1000,
+                100.0 * seconds / total if total else 0.0,'-' if peak is None else peak)
+        print >> file, '%-10s %10.2f' % ('total',total*1000)
+        for name,value in self.values():
+            print >> file, '%-16s %10d' % (name.replace('_',' '),value)
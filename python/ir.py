@@ -1,3 +1,38 @@
+''' Lowering of the SofortParser AST to Simple-IR.
+
+Simple-IR is a linear three-address code over an unlimited number of virtual
+registers. Operands are virtual registers (strings: source variables keep
+their names, temporaries are %1, %2, ...) or int immediates. Every
+instruction is a tuple starting with its opcode; most carry one of IR_TYPES:
+
+  ('cp', t, src, dst)             dst = src
+  ('neg', t, a, dst)              dst = -a
+  (op, t, a, b, dst)              op in add, sub, mul, div
+  (rel, t, a, b, dst)             rel in lt, gt, le, ge; dst is 0/1 (i32)
+  ('ld', t, base, offset, dst)    dst = *(base + offset)
+  ('st', t, src, base, offset)    *(base + offset) = src
+  ('alloc', 'ptr', size, arena, dst)
+                                  dst = size bytes from malloc (arena None)
+                                  or the 'program' or 'scope' arena
+  ('append', t, a, v, a)          append v to array a, which may move
+  ('chk', 'i32', index, length)   exception unless 0 <= index < length
+  ('print', t, a)                 i32 int, i8 char, ptr string
+  ('mark', n)                     save the scope arena's state in mark n
+  ('release', n)                  free the scope arena's memory since mark n
+  ('label', L)
+  ('jmp', L)
+  ('jz', t, a, L)                 jump to L if a == 0
+  ('ret', t, a)
+
+A function is a header ('func', name, return type, params) and its list of
+instructions. A block lowered with a mark and a release is a scope of the
+arena, see escape.py.
+'''
+import sys
+
+from sofortTypes import *
+from parser import ParserException, Appends
+from escape import Escapes
 
 IR_TYPES = ['i8','i16','i32','ptr']
 
@@ -7,7 +42,14 @@ TYPE_MAP = {
     'string' : String,
     '[' : DynamicArray,
 }
-        
+
+ARITH_OPS = ['add','sub','mul','div']
+
+REL_OPS = ['lt','gt','le','ge']
+
+# Elements allocated for an empty array, as compiler.Parser does
+ARRAY_INIT_SPACE = 8
+
 class ASTParser:
     ''' Parses AST tree and produces Simple-IR
     '''
@@ -15,21 +57,30 @@ class ASTParser:
     def __init__(self,ast):
         self.root = ast
         self.out = sys.stdout
-    
+        self.funcs = []
+        self.appends = Appends()
+
     def parse(self):
         for func in self.root:
-            self.visit_func(func)
-    
+            self.funcs.append( self.visit_func(func) )
+        return self.funcs
+
+    def dump(self,out=None):
+        out = out or self.out
+        for header,body in self.funcs:
+            print >> out, format_ir(header)
+            for inst in body:
+                print >> out, format_ir(inst)
+
     def visit_func(self,func):
         assert func[0] == 'FUNC'
         _f,name,ret_type,params,block = func
         ret_type = self.Type(ret_type)
         func_params = [] # TODO
         func_hdr = ('func',name,ret_type.ir_type,func_params)
-        print func_hdr
         body = self.visit_func_block(name,ret_type,func_params,block)
-        print body
-        
+        return func_hdr,body
+
     def Type(self,type):
         typelist = type[1]
         type = TYPE_MAP[typelist[-1]]() # Construct the type
@@ -39,73 +90,330 @@ class ASTParser:
             type = DynamicArray(type)
         return type
 
-    def visit_func_block(name,ret_type,params,block):
+    def visit_func_block(self,name,ret_type,params,block):
         assert block[0] == 'BLOCK'
-        stat_list = block[1]
-        ir_list = [self.visit(s) for s in stat_list]
-        return ir_list
-    
+        self.vars = {}
+        self.temp_num = 0
+        self.lbl_num = 0
+        self.escapes = Escapes()
+        self.site = None # allocation of the last array or string
+        ir_list = self.statements(block[1])
+        return self.arenas(ir_list) + [('ret',ret_type.ir_type,0)]
+
+    def arenas(self,ir):
+        ''' Decide the allocations' arenas and number the scopes' marks '''
+        marks = dict((block,n) for n,block in
+            enumerate(self.escapes.resolve(self.appends.appended)))
+        out = []
+        for inst in ir:
+            if inst[0] in ('mark','release'):
+                if inst[1] in marks:
+                    out.append((inst[0],marks[inst[1]]))
+            elif inst[0] == 'alloc':
+                out.append(inst[:3] + (inst[3].arena,) + inst[4:])
+            else:
+                out.append(inst)
+        return out
+
     def visit(self,node,*args):
         op = getattr(self,'visit_%s' % node[0])
-        return op(self,node,*args)
-            
-    def visit_ASSIGN(stat):
+        return op(node,*args)
+
+    def new_temp(self,type):
+        self.temp_num += 1
+        return VarLocation('%%%d' % self.temp_num,type)
+
+    def new_label(self):
+        self.lbl_num += 1
+        return 'L%d' % self.lbl_num
+
+    def value(self,node,escapes=True):
+        ''' Lower an expression, making sure its value ends up in a register
+            or an immediate. An array loaded whole escapes, unless not.
+        '''
+        expr = self.visit(node)
+        if node[0] == 'ID' and isinstance(expr.loc.type,Array):
+            self.appends.share(node[1])
+            if escapes:
+                self.escapes.escape(node[1])
+        if isinstance(expr.loc,MemLocation):
+            temp = self.new_temp(expr.loc.type)
+            return IRNode(temp,expr.ir + expr.loc.load(temp))
+        return expr
+
+    def check_op(self,left,right,op):
+        if not left.typeof(right):
+            raise ParserException('Incompatible types in %s %s %s' % (left,op,right))
+
+    # Statements
+
+    def statements(self,stats):
+        ir = []
+        for s in stats:
+            self.escapes.top_level()
+            ir.extend( self.visit(s).ir )
+        return ir
+
+    def visit_BLOCK(self,stat):
+        block = self.escapes.enter()
+        ir = [('mark',block)] + self.statements(stat[1]) + [('release',block)]
+        self.escapes.leave()
+        return IRNode(None,ir)
+
+    def assigned(self,lval,node,type):
+        ''' Only a new array assigned to a variable is not shared '''
+        if lval[0] != 'ID' or not isinstance(type,Array):
+            return
+        if node[0] in ('ARRAY_CONS','ARRAY_INIT','STRING'):
+            self.site.name = lval[1]
+        if node[0] not in ('ARRAY_CONS','ARRAY_INIT'):
+            self.appends.share(lval[1])
+
+    def visit_DECLARE(self,stat):
+        lval,expr = stat[1:]
+        expr = self.value(expr)
+        self.assigned(lval,stat[2],expr.loc.type)
+        self.escapes.declare(lval[1])
+        var = VarLocation(lval[1],expr.loc.type)
+        self.vars[var.id] = var
+        return IRNode(None,expr.ir + var.store(expr.loc))
+
+    def visit_ASSIGN(self,stat):
         lval,expr = stat[1:]
-        expr = self.visit(expr)
+        expr = self.value(expr)
+        self.assigned(lval,stat[2],expr.loc.type)
         #Either z[x] = y or x = y
         # Get lval location
         lval = self.visit(lval)
+        if not lval.loc.type.typeof(expr.loc.type):
+            raise ParserException('Illegal assignment of %s to %s' % (expr.loc.type,lval.loc.type))
         # now, direct store or mem store
         store_ir = lval.loc.store(expr.loc)
-        return expr.ir + lval.ir + store_ir
+        return IRNode(None,expr.ir + lval.ir + store_ir)
 
-    def visit_ID(stat):
+    def visit_PRINT(self,stat):
+        expr = self.value(stat[1],False)
+        type = expr.loc.type
+        if not isinstance(type,(Int,Char,String)):
+            raise ParserException('Unsupported type %s' % type)
+        return IRNode(None,expr.ir + [('print',type.ir_type,expr.loc.id)])
+
+    def visit_APPEND(self,stat):
+        array = self.visit(stat[1]).loc
+        type = array.type
+        if not isinstance(type,DynamicArray) or isinstance(type,String):
+            raise ParserException('Cannot append to %s' % type)
+        self.appends.append(array.id)
+        expr = self.value(stat[2])
+        if not type.subtype.typeof(expr.loc.type):
+            raise ParserException('Illegal append of %s to %s' % (expr.loc.type,type))
+        ir = [('append',type.subtype.ir_type,array.id,expr.loc.id,array.id)]
+        return IRNode(None,expr.ir + ir)
+
+    def condition(self,node,label_false):
+        cond = self.value(node)
+        return cond.ir + [('jz',cond.loc.type.ir_type,cond.loc.id,label_false)]
+
+    def visit_IF(self,stat):
+        label_end = self.new_label()
+        ir = self.condition(stat[1],label_end)
+        self.escapes.nested()
+        ir += self.visit(stat[2]).ir
+        return IRNode(None,ir + [('label',label_end)])
+
+    def visit_IFELSE(self,stat):
+        label_else = self.new_label()
+        label_end = self.new_label()
+        ir = self.condition(stat[1],label_else)
+        self.escapes.nested()
+        ir += self.visit(stat[2]).ir
+        ir += [('jmp',label_end),('label',label_else)]
+        self.escapes.nested()
+        ir += self.visit(stat[3]).ir
+        return IRNode(None,ir + [('label',label_end)])
+
+    def visit_WHILE(self,stat):
+        label_loop = self.new_label()
+        label_exit = self.new_label()
+        ir = [('label',label_loop)]
+        ir += self.condition(stat[1],label_exit)
+        self.escapes.nested()
+        ir += self.visit(stat[2]).ir
+        return IRNode(None,ir + [('jmp',label_loop),('label',label_exit)])
+
+    # Expressions
+
+    def visit_ID(self,stat):
         id = stat[1]
-        
+        try:
+            var = self.vars[id]
+        except KeyError:
+            raise ParserException('Unknown variable %s' % id)
+        self.escapes.use(id)
+        return IRNode(var,[])
+
+    def visit_INDEX(self,stat):
+        array = self.visit_ID(stat).loc
+        if not isinstance(array.type,Array):
+            raise ParserException('Expected array, not "%s"' % array.type)
+        index = self.value(stat[2])
+        if not index.loc.type.typeof(Int()):
+            raise ParserException('Array index must be int')
+        type = array.type
+        length = self.new_temp(Int())
+        ir = index.ir + MemLocation(array.id,Int(),type.length_offset).load(length)
+        ir += [('chk','i32',index.loc.id,length.id)]
+        size = type.subtype.sizeof
+        if size == 1:
+            offset = index.loc
+        else:
+            offset = self.new_temp(Int())
+            ir += [('mul','i32',index.loc.id,size,offset.id)]
+        addr = self.new_temp(type)
+        ir += [('add','ptr',array.id,offset.id,addr.id)]
+        return IRNode(MemLocation(addr.id,type.subtype,type.header_size),ir)
+
+    def visit_INT(self,stat):
+        return IRNode(ImmLocation(stat[1],Int()),[])
+
+    def visit_CHAR(self,stat):
+        return IRNode(ImmLocation(ord(stat[1]),Char()),[])
+
+    def visit_STRING(self,stat):
+        literal = stat[1]
+        type = String()
+        ptr = self.new_temp(type)
+        ir = self.alloc(type,len(literal)+1,len(literal),ptr)
+        for i,ch in enumerate(literal + '\0'):
+            ir += ST(ImmLocation(ord(ch),Char()),MemLocation(ptr.id,Char(),type.header_size+i))
+        return IRNode(ptr,ir)
+
+    def visit_ARITH(self,stat):
+        op,left,right = stat[1:]
+        left = self.value(left)
+        right = self.value(right)
+        self.check_op(left.loc.type,right.loc.type,op)
+        type = left.loc.type.union(right.loc.type)
+        if not type.get_operation(op):
+            raise ParserException('Operation "%s" not supported by type "%s"' % (op,type))
+        dst = self.new_temp(type)
+        ir = left.ir + right.ir + [(op,type.ir_type,left.loc.id,right.loc.id,dst.id)]
+        return IRNode(dst,ir)
+
+    def visit_RELOP(self,stat):
+        op,left,right = stat[1:]
+        left = self.value(left)
+        right = self.value(right)
+        self.check_op(left.loc.type,right.loc.type,op)
+        type = left.loc.type.union(right.loc.type)
+        if not type.get_operation(op):
+            raise ParserException('Operation "%s" not supported by type "%s"' % (op,type))
+        dst = self.new_temp(Int())
+        ir = left.ir + right.ir + [(op,type.ir_type,left.loc.id,right.loc.id,dst.id)]
+        return IRNode(dst,ir)
+
+    def visit_NEG(self,stat):
+        expr = self.value(stat[1])
+        type = expr.loc.type
+        if not type.get_operation('neg'):
+            raise ParserException('Operation "neg" not supported by type "%s"' % type)
+        if isinstance(expr.loc,ImmLocation):
+            return IRNode(ImmLocation(wrap(-expr.loc.id),type),expr.ir)
+        dst = self.new_temp(type)
+        return IRNode(dst,expr.ir + [('neg',type.ir_type,expr.loc.id,dst.id)])
+
+    def visit_ARRAY_CONS(self,stat):
+        elements = [self.value(e) for e in stat[1]]
+        subtype = elements[0].loc.type
+        for e in elements[1:]:
+            if not subtype.typeof(e.loc.type):
+                raise ParserException('Type mismatch in array constructor:  %s and %s.' %
+                    (subtype,e.loc.type))
+        type = DynamicArray(subtype)
+        ptr = self.new_temp(type)
+        ir = []
+        for e in elements:
+            ir += e.ir
+        ir += self.alloc(type,len(elements),len(elements),ptr)
+        for i,e in enumerate(elements):
+            ir += ST(e.loc,MemLocation(ptr.id,subtype,type.header_size+i*subtype.sizeof))
+        return IRNode(ptr,ir)
+
+    def visit_ARRAY_INIT(self,stat):
+        type = DynamicArray(self.Type(stat[1]))
+        ptr = self.new_temp(type)
+        return IRNode(ptr,self.alloc(type,ARRAY_INIT_SPACE,0,ptr))
+
+    def alloc(self,type,space,length,ptr):
+        ''' Allocate an array with room for space elements, see escape.Site '''
+        self.site = self.escapes.site()
+        ir = [('alloc','ptr',type.header_size+space*type.subtype.sizeof,self.site,ptr.id)]
+        ir += ST(ImmLocation(space,Int()),MemLocation(ptr.id,Int(),type.capacity_offset))
+        return ir + ST(ImmLocation(length,Int()),MemLocation(ptr.id,Int(),type.length_offset))
+
 
 class IRNode:
-    
+
     def __init__(self,loc=None,ir=[]):
         self.ir = ir
         self.loc = loc
 
-        
+
 class IRLocation:
     pass
-        
+
 class VarLocation(IRLocation):
+    ''' Virtual register '''
 
-    def __init__(self,id,type)
+    def __init__(self,id,type):
         self.id = id
         self.type = type
-    
-    def store(self,from_loc): 
+
+    def store(self,from_loc):
         return from_loc.load(self)
-            
+
     def load(self,to_loc):
-        return []
+        if to_loc.id == self.id:
+            return []
+        return CP(self,to_loc)
+
+class ImmLocation(VarLocation):
+    ''' Constant operand; its id is the value itself '''
+
+    def store(self,from_loc):
+        raise ParserException('Cannot store to a constant')
 
 class MemLocation(IRLocation):
 
-    def __init__(self,id,offset=0)
+    def __init__(self,id,type,offset=0):
         self.id = id
         self.type = type
         self.offset = offset
-    
+
     def store(self,from_loc):
         return ST(from_loc,self)
 
     def load(self,to_loc):
         return LD(self,to_loc)
-#IR        
-        
+#IR
+
 def CP(from_loc,to_loc):
-    return [('cp',from_loc.type,from_loc.id,to_loc.id)]
-        
+    return [('cp',from_loc.type.ir_type,from_loc.id,to_loc.id)]
+
 def ST(from_loc,to_loc):
-    return [('st',from_loc.type,from_loc.id,to_loc.id)]
-        
+    return [('st',to_loc.type.ir_type,from_loc.id,to_loc.id,to_loc.offset)]
+
 def LD(from_loc,to_loc):
-    return [('ld',to_loc.type,from_loc.id,to_loc.id)]
+    return [('ld',from_loc.type.ir_type,from_loc.id,from_loc.offset,to_loc.id)]
 
 
+def format_ir(inst):
+    ''' Human-readable form of an IR instruction '''
+    op = inst[0]
+    if op == 'label':
+        return '%s:' % inst[1]
+    elif op == 'func':
+        return 'func %s(%s) %s' % (inst[1],', '.join(inst[3]),inst[2])
+    elif op in ('jmp','mark','release'):
+        return '    %s %s' % (op,inst[1])
+    return '    %s %s %s' % (op,inst[1],', '.join(str(a) for a in inst[2:]))
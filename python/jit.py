@@ -0,0 +1,186 @@
+''' Running generated code in this process, for compiler.py --jit.
+
+Program(text,word) assembles the emitter's output with assembler.py and
+maps it into anonymous mmap pages: code read and execute, the string pool
+read-only and the rest read-write. C functions are looked up in the
+process through ctypes. On x86-64 each call goes through a jmp *addr stub
+next to the code, because libc may be too far away for a 32-bit
+displacement.
+
+A small runtime wraps main: jit_entry saves the callee-saved registers and
+the stack pointer, and exit() returns its status to Python from any
+depth. Nothing touches the file system, and the output is written to
+file descriptor 1, after what Python's own sys.stdout has buffered.
+
+The code must be for the host, so the x86-64 emitter runs in a 64-bit
+Python and the i386 one in a 32-bit Python. A division that traps kills
+the process with SIGFPE, as it does to the compiled program.
+'''
+import ctypes
+import mmap
+import platform
+import struct
+
+from assembler import Assembler
+from emitter import mangle
+
+RUNTIME = {
+    8 : """
+.data
+jit_saved_sp:
+	.quad 0
+.text
+jit_entry:
+	pushq	%%rbx
+	pushq	%%rbp
+	pushq	%%r12
+	pushq	%%r13
+	pushq	%%r14
+	pushq	%%r15
+	subq	$8,%%rsp
+	movq	%%rsp,jit_saved_sp(%%rip)
+	call	%(main)s
+jit_return:
+	movq	jit_saved_sp(%%rip),%%rsp
+	addq	$8,%%rsp
+	popq	%%r15
+	popq	%%r14
+	popq	%%r13
+	popq	%%r12
+	popq	%%rbp
+	popq	%%rbx
+	ret
+%(exit)s:
+	movl	%%edi,%%eax
+	jmp	jit_return
+""",
+    4 : """
+.data
+jit_saved_sp:
+	.long 0
+.text
+jit_entry:
+	pushl	%%ebx
+	pushl	%%esi
+	pushl	%%edi
+	pushl	%%ebp
+	movl	%%esp,jit_saved_sp
+	call	%(main)s
+jit_return:
+	movl	jit_saved_sp,%%esp
+	popl	%%ebp
+	popl	%%edi
+	popl	%%esi
+	popl	%%ebx
+	ret
+%(exit)s:
+	movl	4(%%esp),%%eax
+	jmp	jit_return
+""",
+}
+
+# jmp *0(%rip) followed by the address
+STUB = '\xff\x25\x00\x00\x00\x00'
+STUB_SIZE = len(STUB) + 8
+
+PROT = {
+    '.text' : mmap.PROT_READ | mmap.PROT_EXEC,
+    '.rodata' : mmap.PROT_READ,
+}
+
+class JitError(Exception):
+    pass
+
+libc = ctypes.CDLL(None)
+libc.mprotect.argtypes = [ctypes.c_void_p,ctypes.c_size_t,ctypes.c_int]
+
+def host_word():
+    ''' Word size of the code this process can run, None if not x86 '''
+    machine = platform.machine().lower()
+    if machine not in ('x86_64','amd64','i386','i486','i586','i686','x86'):
+        return None
+    return ctypes.sizeof(ctypes.c_void_p)
+
+def page_align(n):
+    return n + -n % mmap.PAGESIZE
+
+
+class Program:
+    ''' Machine code of one program, mapped into this process '''
+
+    def __init__(self,text,word):
+        if word != host_word():
+            raise JitError('cannot run %d-bit code in this process' % (word*8))
+        runtime = RUNTIME[word] % {'main':mangle('main'),'exit':mangle('exit')}
+        sections,defined = Assembler(word).assemble(text + runtime).link()
+        externals = sorted(set(r[1] for s in sections for r in s[3]) - set(defined))
+        offsets,size = [],0
+        for name,data,align,relocs in sections:
+            if name == '.text' and word == 8:
+                stubs = len(data)
+                data += '\0' * (STUB_SIZE * len(externals))
+            offsets.append(size)
+            size += page_align(len(data))
+        self.map = mmap.mmap(-1,max(size,1),mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS,
+            mmap.PROT_READ | mmap.PROT_WRITE)
+        base = ctypes.addressof(ctypes.c_char.from_buffer(self.map))
+        address = dict((label,base + offsets[number] + offset)
+            for label,(number,offset) in defined.items())
+        calls = {}
+        for i,name in enumerate(externals):
+            address[name] = self.symbol(name)
+            if word == 8:
+                calls[name] = address['jit_entry'] - defined['jit_entry'][1] + stubs + i*STUB_SIZE
+        for (name,data,align,relocs),offset in zip(sections,offsets):
+            for at,symbol,size,kind,addend in relocs:
+                place = base + offset + at
+                if kind == 'abs':
+                    value = address[symbol] + addend
+                else:
+                    value = calls.get(symbol,address[symbol]) + addend - place
+                data[at:at+size] = self.pack(value,size,kind,word)
+            if name == '.text' and word == 8:
+                for i,external in enumerate(externals):
+                    at = stubs + i*STUB_SIZE
+                    data[at:at+STUB_SIZE] = STUB + struct.pack('<Q',address[external])
+            self.map[offset:offset+len(data)] = str(data)
+        for (name,data,align,relocs),offset in zip(sections,offsets):
+            if name in PROT and data:
+                if libc.mprotect(base + offset,page_align(len(data)),PROT[name]):
+                    raise JitError('mprotect failed for %s' % name)
+        self.entry = ctypes.CFUNCTYPE(ctypes.c_int)(address['jit_entry'])
+
+    def symbol(self,name):
+        try:
+            return ctypes.cast(getattr(libc,name),ctypes.c_void_p).value
+        except AttributeError:
+            raise JitError('undefined symbol %s' % name)
+
+    def pack(self,value,size,kind,word):
+        if size == 8:
+            return struct.pack('<Q',value & (1 << 64) - 1)
+        if kind == 'abs' and word == 4:
+            value = struct.unpack('<i',struct.pack('<I',value & 0xffffffff))[0]
+        if not -(1 << 31) <= value < (1 << 31):
+            raise JitError('displacement out of range')
+        return struct.pack('<i',value)
+
+    def __call__(self):
+        ''' Run main, return the exit status '''
+        libc.fflush(None)
+        status = self.entry()
+        libc.fflush(None)
+        return status
+
+    def close(self):
+        self.entry = None
+        self.map.close()
+
+
+def run(emitter):
+    ''' Run the code in the emitter's buffer, return the exit status '''
+    program = Program('\n'.join(emitter.buffer),emitter.word)
+    try:
+        return program()
+    finally:
+        program.close()
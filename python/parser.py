@@ -1,5 +1,5 @@
 
-from scanner import AppException
+from scanner import *
 
 class ParserException(AppException):
     
@@ -10,6 +10,29 @@ class ParserException(AppException):
         Exception.__init__(self,s)
 
 
+class Appends:
+    ''' Arrays appended to, which nothing else may refer to. Append may
+        move an array, and another variable or array holding it would be
+        left pointing to freed memory. Semantic checks call share() for a
+        variable whose array may be referenced from elsewhere and append()
+        for one appended to; either order is an error.
+    '''
+
+    def __init__(self):
+        self.appended = set()
+        self.shared = set()
+
+    def append(self,name,*pos):
+        if name in self.shared:
+            raise ParserException('Cannot append to %s, another variable or array may refer to it' % name,*pos)
+        self.appended.add(name)
+
+    def share(self,name,*pos):
+        if name in self.appended:
+            raise ParserException('Array %s is appended to, nothing else may refer to it' % name,*pos)
+        self.shared.add(name)
+
+
 class ASTTuple(tuple):
     pass
 
@@ -20,27 +43,42 @@ def ASTNode(tp,text=None):
         return t
 
 
+class TupleBuilder:
+    ''' Builds the AST out of nested tuples '''
+
+    def node(self,*fields):
+        return fields
+
+    def stat(self,node,first_line):
+        return ASTNode(node,first_line)
+
+    def top(self,funcs):
+        return funcs
+
+
 class SofortParser:
 
-    def __init__(self,scanner):
+    def __init__(self,scanner,builder=None):
         self.scanner = scanner
         self.namespace = Namespace()
+        self.builder = builder or TupleBuilder()
+        self.node = self.builder.node
         self.next()
 
     def next(self):
         self.token = self.scanner.scan()
         return self.token
 
-    def match(self,tok):
-        if self.token == tok:
+    def match(self,kind):
+        if self.token.kind == kind:
             self.next()
             return True
         return False
 
-    def expect(self,tok):
+    def expect(self,kind):
         #print self.token
-        if self.token != tok:
-            raise ParserException('Expected "%s"'%tok,*self.scanner.pos())
+        if self.token.kind != kind:
+            raise ParserException('Expected "%s"'%KIND_NAME[kind],*self.scanner.pos())
         return self.next()
 
     def Top(self):
@@ -53,55 +91,69 @@ class SofortParser:
     def _Top(self):
         stat_list = []
         self.namespace.begin_scope()
-        while self.token is not EOF:
+        while self.token.kind != T_EOF:
             stat_list.append( self.Statement() )
-        if self.token is not EOF:
+        if self.token.kind != T_EOF:
             raise ParserException('EOF')
-        return [('FUNC','main',('TYPE',['int']),[],('BLOCK',stat_list))]
+        node = self.node
+        return self.builder.top([node('FUNC','main',node('TYPE',['int']),[],node('BLOCK',stat_list))])
    
     def Statement(self):
         first_line = self.scanner.line
-        if isinstance(self.token,Ident):
+        kind = self.token.kind
+        if kind == T_IDENT:
             stat = self.Assignment()
-        elif self.token == 'print':
+        elif kind == T_PRINT:
             stat = self.Print()
-        elif self.token == 'if':
+        elif kind == T_APPEND:
+            stat = self.Append()
+        elif kind == T_IF:
             stat = self.If()
-        elif self.token == 'while':
+        elif kind == T_WHILE:
             stat = self.While()
-        elif self.token == '{':
+        elif kind == T_LBRACE:
             stat = self.Block()
         else:
             raise ParserException('Expected statement',*self.scanner.pos())  
-        #text=self.scanner.content[first_line]
-        return ASTNode(stat,first_line)
+        #text=self.scanner.line_text(first_line)
+        return self.builder.stat(stat,first_line)
 
     def While(self):
         self.next()
         expr = self.Expression()
         stat = self.Statement()
-        return 'WHILE',expr,stat
+        return self.node('WHILE',expr,stat)
 
     def Block(self):
         self.next()
         stats = []
-        while not self.match('}'):
+        while not self.match(T_RBRACE):
             stats.append( self.Statement() )
-        return 'BLOCK',stats
+        return self.node('BLOCK',stats)
         
     def Print(self):
         self.next()
         expr = self.Expression()
-        return 'PRINT',expr
+        return self.node('PRINT',expr)
+
+    def Append(self):
+        ''' append a, <Expr> adds an element at the end of array a '''
+        self.next()
+        var = self.token.value
+        self.expect(T_IDENT)
+        self.check_var(var)
+        self.expect(T_COMMA)
+        expr = self.Expression()
+        return self.node('APPEND',self.node('ID',var),expr)
         
     def If(self):
         self.next()
         expr = self.Expression()
         stat1 = self.Statement()       
-        if self.match('else'):
+        if self.match(T_ELSE):
             stat2 = self.Statement()
-            return 'IFELSE',expr,stat1,stat2
-        return 'IF',expr,stat1
+            return self.node('IFELSE',expr,stat1,stat2)
+        return self.node('IF',expr,stat1)
 
     def Assignment(self):
         ''' Assignment acts as both declaration and ordinary assignment.
@@ -109,23 +161,23 @@ class SofortParser:
             If x is first used, it is declaration of var x of type(Expr).
             Otherwise, it is ordinary assignment where type(x) must match type(Expr).
         '''
+        var = self.token.value
         lval = self.Lvalue()
-        self.expect('=')
+        self.expect(T_ASSIGN)
         expr = self.Expression()
-        var = lval[1]
         if self.namespace.get_var(var):
-            return 'ASSIGN',lval,expr
+            return self.node('ASSIGN',lval,expr)
         self.namespace.add_var(var)
-        return 'DECLARE',lval,expr
+        return self.node('DECLARE',lval,expr)
  
     def Lvalue(self):
         id = self.token.value
         self.next()
-        if self.match('['):
+        if self.match(T_LBRACKET):
             index = self.Expression()
-            self.expect(']')
-            return 'INDEX',id,index
-        return 'ID',id
+            self.expect(T_RBRACKET)
+            return self.node('INDEX',id,index)
+        return self.node('ID',id)
 
     def Expression(self):
         return self.RelationalExpression()
@@ -133,67 +185,70 @@ class SofortParser:
     def RelationalExpression(self):
         left = self.ArithmeticExpression()
         while True:
-            op = RELOPS.get(self.token,None)
+            op = RELOPS.get(self.token.kind,None)
             if not op:
                 break
             self.next()
             right = self.ArithmeticExpression()
-            left = ('RELOP',op,left,right)
+            left = self.node('RELOP',op,left,right)
         return left
         
         
     def ArithmeticExpression(self):
         left = self.Product()
         while True:
-            if self.token == '+':
+            kind = self.token.kind
+            if kind == T_PLUS:
                 op = 'add'
-            elif self.token == '-':
+            elif kind == T_MINUS:
                 op = 'sub'
             else:
                 break
             self.next()
             right = self.Product()
-            left = ('ARITH',op,left,right)
+            left = self.node('ARITH',op,left,right)
         return left
         
     def Product(self):
         left = self.Factor()
         while True:
-            if self.token == '*':
+            kind = self.token.kind
+            if kind == T_STAR:
                 op = 'mul'
-            elif self.token == '/':
+            elif kind == T_SLASH:
                 op = 'div'
             else:
                 break
             self.next()
             right = self.Factor()
-            left = ('ARITH',op,left,right)
+            left = self.node('ARITH',op,left,right)
         return left
 
     def Factor(self):
-        if self.match('-'):  # unary minus
+        if self.match(T_MINUS):  # unary minus
             expr = self.UnaryExpression()
-            expr = ('NEG',expr)
+            expr = self.node('NEG',expr)
         else:
             expr = self.UnaryExpression()
         return expr        
 
     def UnaryExpression(self):
-        if isinstance(self.token,Ident):
+        kind = self.token.kind
+        if kind == T_IDENT:
             expr = self.VarOrFunc()
-        elif isinstance(self.token,int):
-            expr = ('INT',self.token)
+        elif kind == T_INT:
+            expr = self.node('INT',self.token.value)
             self.next()
-        elif isinstance(self.token,CharLiteral):
-            expr = ('CHAR',self.token.value)
+        elif kind == T_CHAR:
+            expr = self.node('CHAR',self.token.value)
             self.next()
-        elif isinstance(self.token,StringLiteral):
-            expr = ('STRING',self.token.value)
+        elif kind == T_STRING:
+            expr = self.node('STRING',self.token.value)
             self.next()
-        elif self.match('('):
+        elif self.match(T_LPAREN):
             expr = self.Expression()
-            self.expect(')')
-        elif self.match('['):
+            self.expect(T_RPAREN)
+        elif self.match(T_LBRACKET):
             expr = self.ArrayConstructor()
         else:
             raise ParserException('Unexpected token %s' % str(self.token))
@@ -203,40 +258,41 @@ class SofortParser:
         var = self.token.value
         self.check_var(var)
         self.next()
-        if self.match('['): # array element
+        if self.match(T_LBRACKET): # array element
             index = self.Expression()
-            self.expect(']')
-            return 'INDEX',var,index
-        return 'ID',var
+            self.expect(T_RBRACKET)
+            return self.node('INDEX',var,index)
+        return self.node('ID',var)
         
             
     def ArrayConstructor(self):
-        if self.match(']'):
+        if self.match(T_RBRACKET):
             # Zero-length array
             # Still a small space is allocated in case of further expansion.
             arr_subtype = self.Type()
-            return 'ARRAY_INIT',arr_subtype
+            return self.node('ARRAY_INIT',arr_subtype)
         init_list = []
         init_list.append( self.Expression() )
         # Now we know the array's subtype
-        while not self.match(']'):
-            self.expect(',')
+        while not self.match(T_RBRACKET):
+            self.expect(T_COMMA)
             # allow for extra ',' at the end
-            if self.match(']'):
+            if self.match(T_RBRACKET):
                 break;
             init_list.append( self.Expression() )
-        return 'ARRAY_CONS',init_list
+        return self.node('ARRAY_CONS',init_list)
         
     def Type(self):
         type_desc = []
-        while self.match('[]'):
+        while self.match(T_LBRACKET):
+            self.expect(T_RBRACKET)
             type_desc.append('[')
-        if self.token in PRIMITIVE_TYPES:
+        if self.token.kind == T_IDENT and self.token.value in PRIMITIVE_TYPES:
             type_desc.append( self.token.value )
         else:
             raise ParserException('Expected type, found %s' % str(self.token),*self.scanner.pos())
         self.next()
-        return ('TYPE',type_desc)
+        return self.node('TYPE',type_desc)
 
     def check_var(self,name):
         if not self.namespace.get_var(name):
@@ -0,0 +1,340 @@
+''' Peephole optimizer for the assembly in an Emitter buffer.
+
+The buffer is parsed into instructions; everything else (labels, prologue
+and data blocks) is kept verbatim and acts as a barrier. Every rule in RULES
+looks at a fixed number of consecutive instructions and returns their
+replacement, or None when it does not apply. Rules longer than the window
+are not used, and the window also bounds how far ahead a rule may look to
+prove a register or the flags dead. Passes repeat until nothing changes.
+
+The generated code never reads the flags after a conditional jump or
+across a label, so the flags are treated as dead there.
+
+  peephole = Peephole(window=6)
+  emitter.optimize(peephole)
+  peephole.report(sys.stderr)
+'''
+import re
+
+from emitter import TAB, is_reg, is_imm, is_mem
+
+DEFAULT_WINDOW = 8
+
+REG_RE = re.compile(r'%([a-z]+)')
+
+# Sub-registers name the 32-bit register they are part of
+REG_NAMES = {
+    'al':'eax','ah':'eax','ax':'eax',
+    'bl':'ebx','bh':'ebx','bx':'ebx',
+    'cl':'ecx','ch':'ecx','cx':'ecx',
+    'dl':'edx','dh':'edx','dx':'edx',
+    'si':'esi','di':'edi','bp':'ebp','sp':'esp',
+}
+
+# Jump taken when the condition set by setCC is false
+NEGATE = {'e':'ne','ne':'e','l':'ge','ge':'l','g':'le','le':'g',
+    'b':'ae','ae':'b','a':'be','be':'a'}
+
+MOVES = set(['movl','movzbl','movzxb','movsbl','leal'])
+
+READ_MODIFY = set(['addl','subl','andl','orl','xorl','shll','sarl','shrl',
+    'negl','notl','incl','decl','movb'])
+
+COMPARES = set(['cmpl','cmpb','testl','testb'])
+
+FLAG_WRITERS = READ_MODIFY - set(['movb']) | COMPARES | set(['imull','idivl','call'])
+
+BARRIERS = set(['ret','leave','jmp'])
+
+
+class Inst:
+
+    def __init__(self,op,args=[]):
+        self.op = op
+        self.args = args
+
+    def __str__(self):
+        if self.args:
+            return TAB + self.op + TAB + ','.join(self.args)
+        return TAB + self.op
+
+    def __eq__(self,other):
+        return isinstance(other,Inst) and (self.op,self.args) == (other.op,other.args)
+
+    def __ne__(self,other):
+        return not self == other
+
+
+def parse(entry):
+    ''' Inst for an entry written by Emitter.emit, None for anything else '''
+    if not entry.startswith(TAB) or '\n' in entry:
+        return None
+    fields = entry.split(TAB,2)
+    if len(fields) == 2:
+        return Inst(fields[1])
+    return Inst(fields[1],split_args(fields[2]))
+
+def split_args(s):
+    args,depth,start = [],0,0
+    for i,c in enumerate(s):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            args.append(s[start:i])
+            start = i + 1
+    args.append(s[start:])
+    return args
+
+
+def registers(arg):
+    return set(REG_NAMES.get(r,r) for r in REG_RE.findall(arg))
+
+def mentions(arg,reg):
+    return reg in registers(arg)
+
+def reads_kills(inst):
+    ''' Registers inst reads, and those it overwrites without reading '''
+    op,args = inst.op,inst.args
+    read,kill = set(),set()
+    for a in args[:-1]:
+        read |= registers(a)
+    dst = args[-1] if args else None
+    if dst is not None:
+        if is_mem(dst):
+            read |= registers(dst)
+        elif op in MOVES or op == 'popl':
+            if dst[1:] in ('eax','ebx','ecx','edx','esi','edi','ebp','esp'):
+                kill.add(dst[1:])
+            else:
+                read |= registers(dst)
+        else:
+            read |= registers(dst)
+    if op == 'imull' and len(args) == 1:
+        read.add('eax')
+        kill.add('edx')
+    elif op == 'idivl':
+        read |= set(['eax','edx'])
+    elif op in ('cdq','cltd'):
+        read.add('eax')
+        kill.add('edx')
+    elif op == 'call':
+        kill |= set(['eax','ecx','edx'])
+    elif op in ('ret','leave'):
+        read |= set(['eax','ebp'])
+    return read,kill
+
+def reads_flags(inst):
+    op = inst.op
+    return (op.startswith('j') and op != 'jmp' or op.startswith('set')
+        or op.startswith('cmov') or op in ('adcl','sbbl'))
+
+
+class Rule:
+
+    def __init__(self,name,size,func):
+        self.name = name
+        self.size = size
+        self.func = func
+
+
+class Peephole:
+
+    def __init__(self,window=DEFAULT_WINDOW,rules=None):
+        self.window = max(window,2)
+        self.rules = [r for r in (rules or RULES) if r.size <= self.window]
+        self.hits = dict((r.name,0) for r in self.rules)
+        self.saved = dict((r.name,0) for r in self.rules)
+
+    def optimize(self,buffer):
+        code = [parse(entry) or entry for entry in buffer]
+        changed = True
+        while changed:
+            changed = False
+            i = 0
+            while i < len(code):
+                for rule in self.rules:
+                    window = code[i:i+rule.size]
+                    if len(window) < rule.size:
+                        continue
+                    result = rule.func(self,window,code,i+rule.size)
+                    if result is not None:
+                        code[i:i+rule.size] = result
+                        self.hits[rule.name] += 1
+                        self.saved[rule.name] += rule.size - len(result)
+                        changed = True
+                        # Let rules that start a little earlier see the result
+                        i = max(i - self.window + 1,0)
+                        break
+                else:
+                    i += 1
+        return [str(c) for c in code]
+
+    def dead(self,code,j,reg):
+        ''' Is reg overwritten before being read, looking from code[j]? '''
+        for item in code[j:j+self.window]:
+            if not isinstance(item,Inst) or item.op.startswith('j'):
+                return False
+            read,kill = reads_kills(item)
+            if reg in read:
+                return False
+            if reg in kill:
+                return True
+        return False
+
+    def flags_dead(self,code,j):
+        for item in code[j:j+self.window]:
+            if not isinstance(item,Inst):
+                return True
+            if reads_flags(item):
+                return False
+            if item.op in FLAG_WRITERS or item.op in BARRIERS:
+                return True
+        return False
+
+    def report(self,out):
+        print >> out, '%-20s %8s %8s' % ('rule','hits','saved')
+        for rule in self.rules:
+            print >> out, '%-20s %8d %8d' % (rule.name,self.hits[rule.name],self.saved[rule.name])
+        print >> out, '%-20s %8d %8d' % ('total',sum(self.hits.values()),sum(self.saved.values()))
+
+
+def instructions(window):
+    return all(isinstance(i,Inst) for i in window)
+
+def move(src,dst):
+    if src == dst:
+        return []
+    return [Inst('movl',[src,dst])]
+
+# Rules: func(peephole,window,code,next) -> replacement list or None
+
+def push_pop(p,w,code,next):
+    ''' pushl X; popl R  ->  movl X,R '''
+    if instructions(w) and w[0].op == 'pushl' and w[1].op == 'popl':
+        return move(w[0].args[0],w[1].args[0])
+
+def store_reload(p,w,code,next):
+    ''' movl R,M; movl M,R2  ->  movl R,M; movl R,R2 '''
+    a,b = w
+    if (instructions(w) and a.op == 'movl' and b.op == 'movl' and is_reg(a.args[0])
+            and is_mem(a.args[1]) and a.args[1] == b.args[0]):
+        return [a] + move(a.args[0],b.args[1])
+
+def push_through_reg(p,w,code,next):
+    ''' movl X,R; pushl R  ->  pushl X, when R is dead afterwards '''
+    a,b = w
+    if (instructions(w) and a.op == 'movl' and b.op == 'pushl' and is_reg(a.args[1])
+            and b.args[0] == a.args[1] and p.dead(code,next,a.args[1][1:])):
+        return [Inst('pushl',[a.args[0]])]
+
+def move_through_reg(p,w,code,next):
+    ''' movl X,R; movl R,Y  ->  movl X,Y, when R is dead afterwards '''
+    a,b = w
+    if not (instructions(w) and a.op == 'movl' and b.op == 'movl'):
+        return None
+    x,r = a.args
+    y = b.args[1]
+    if (is_reg(r) and b.args[0] == r and y != r and not mentions(y,r[1:])
+            and not (is_mem(x) and is_mem(y)) and p.dead(code,next,r[1:])):
+        return [Inst('movl',[x,y])]
+
+def stack_operand(x):
+    return mentions(x,'esp') or mentions(x,'eax')
+
+def stack_binop(p,w,code,next):
+    ''' pushl X; movl Y,%eax; addl %eax,(%esp); popl %eax  ->  movl X,%eax; addl Y,%eax '''
+    if not instructions(w):
+        return None
+    push,load,op,pop = w
+    if (push.op == 'pushl' and load.op == 'movl' and load.args[1] == '%eax'
+            and op.op in ('addl','subl') and op.args == ['%eax','(%esp)']
+            and pop.op == 'popl' and pop.args == ['%eax']):
+        x,y = push.args[0],load.args[0]
+        if not stack_operand(y) and not mentions(x,'esp'):
+            return move(x,'%eax') + [Inst(op.op,[y,'%eax'])]
+
+def stack_mul(p,w,code,next):
+    ''' pushl X; movl Y,%eax; imull (%esp); addl $4,%esp  ->  movl X,%eax; imull Y,%eax '''
+    if not instructions(w):
+        return None
+    push,load,mul,pop = w
+    if (push.op == 'pushl' and load.op == 'movl' and load.args[1] == '%eax'
+            and mul.op == 'imull' and mul.args == ['(%esp)']
+            and pop.op == 'addl' and pop.args == ['$4','%esp']):
+        x,y = push.args[0],load.args[0]
+        if not stack_operand(y) and not mentions(x,'esp') and p.flags_dead(code,next):
+            return move(x,'%eax') + [Inst('imull',[y,'%eax'])]
+
+def stack_cmp(p,w,code,next):
+    ''' pushl X; movl Y,%eax; cmpl %eax,(%esp); setCC %al; movzbl %al,%eax; addl $4,%esp
+        ->  movl X,%eax; cmpl Y,%eax; setCC %al; movzbl %al,%eax
+    '''
+    if not instructions(w):
+        return None
+    push,load,cmp,set,ext,pop = w
+    if (push.op == 'pushl' and load.op == 'movl' and load.args[1] == '%eax'
+            and cmp.op == 'cmpl' and cmp.args == ['%eax','(%esp)']
+            and set.op.startswith('set') and set.args == ['%al']
+            and ext.op == 'movzbl' and ext.args == ['%al','%eax']
+            and pop.op == 'addl' and pop.args == ['$4','%esp']):
+        x,y = push.args[0],load.args[0]
+        if not stack_operand(y) and not mentions(x,'esp') and p.flags_dead(code,next):
+            return move(x,'%eax') + [Inst('cmpl',[y,'%eax']),set,ext]
+
+def known_flags(p,w,code,next):
+    ''' setCC %al; movzbl %al,%eax; orl %eax,%eax; je L
+        ->  setCC %al; movzbl %al,%eax; jNCC L
+    '''
+    if not instructions(w):
+        return None
+    set,ext,test,jump = w
+    cc = set.op[3:]
+    if (cc in NEGATE and set.args == ['%al'] and ext.op == 'movzbl' and ext.args == ['%al','%eax']
+            and test.op == 'orl' and test.args == ['%eax','%eax'] and jump.op == 'je'):
+        return [set,ext,Inst('j' + NEGATE[cc],jump.args)]
+
+def known_flags_pop(p,w,code,next):
+    ''' As known_flags with an addl $k,%esp in between, which becomes leal '''
+    if not instructions(w):
+        return None
+    set,ext,pop,test,jump = w
+    if pop.op == 'addl' and is_imm(pop.args[0]) and pop.args[1] == '%esp':
+        result = known_flags(p,[set,ext,test,jump],code,next)
+        if result:
+            lea = Inst('leal',['%s(%%esp)' % pop.args[0][1:],'%esp'])
+            return result[:2] + [lea] + result[2:]
+
+def push_pop_across(p,w,code,next):
+    ''' pushl X; I; popl R  ->  movl X,R; I, when I leaves R and the stack alone '''
+    if not instructions(w):
+        return None
+    push,inst,pop = w
+    if push.op != 'pushl' or pop.op != 'popl':
+        return None
+    x,r = push.args[0],pop.args[0]
+    if (inst.op in MOVES | READ_MODIFY | COMPARES and len(inst.args) == 2
+            and not mentions(x,'esp') and not any(mentions(a,'esp') or mentions(a,r[1:]) for a in inst.args)
+            and not (is_mem(x) and is_mem(inst.args[1]) and inst.op not in COMPARES)):
+        return move(x,r) + [inst]
+
+def jump_to_next(p,w,code,next):
+    ''' jmp L; L:  ->  L: '''
+    jump,label = w
+    if isinstance(jump,Inst) and jump.op == 'jmp' and label == jump.args[0] + ':':
+        return [label]
+
+RULES = [
+    Rule('push_pop',2,push_pop),
+    Rule('store_reload',2,store_reload),
+    Rule('push_through_reg',2,push_through_reg),
+    Rule('move_through_reg',2,move_through_reg),
+    Rule('jump_to_next',2,jump_to_next),
+    Rule('push_pop_across',3,push_pop_across),
+    Rule('stack_binop',4,stack_binop),
+    Rule('stack_mul',4,stack_mul),
+    Rule('known_flags',4,known_flags),
+    Rule('known_flags_pop',5,known_flags_pop),
+    Rule('stack_cmp',6,stack_cmp),
+]
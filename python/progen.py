@@ -0,0 +1,163 @@
+''' Synthetic Sofort programs of a given shape and size, for benchmarks.
+
+    python progen.py shape size [width [seed]]
+
+size is about the number of statements. width is what makes a statement
+big for the shape, with a default for each:
+
+  straight  long straight-line code on a few int variables
+  nested    if and while nested width deep, repeated
+  arrays    array constructors of width elements, indexed and printed
+  strings   string literals of width characters
+  expr      expressions width parentheses deep
+  mixed     the other shapes in turn
+
+The programs compile with every backend and also run: loops run once,
+indices are in bounds and divisors are not zero. A nest takes about three
+statements a level, so its depth is capped for the program to grow with
+size.
+'''
+import random
+import sys
+
+SHAPES = ['straight','nested','arrays','strings','expr','mixed']
+
+WIDTH = {
+    'straight' : 4,
+    'nested' : 20,
+    'arrays' : 200,
+    'strings' : 200,
+    'expr' : 30,
+}
+
+# Deeper nesting than this runs into the parsers' recursion limit
+MAX_DEPTH = 60
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz ,.!'
+
+def suffix(n):
+    ''' n in letters, since names cannot contain digits '''
+    s = ''
+    while True:
+        s += LETTERS[n % 26]
+        n /= 26
+        if not n:
+            return s
+
+VARS = ['x' + suffix(i) for i in range(8)]
+
+
+class Generator:
+
+    def __init__(self,seed=0):
+        self.random = random.Random(seed)
+        self.lines = ['%s = %d' % (v,i + 1) for i,v in enumerate(VARS)]
+        self.count = 0
+
+    def name(self,prefix):
+        self.count += 1
+        return prefix + suffix(self.count)
+
+    def atom(self):
+        r = self.random
+        if r.random() < 0.6:
+            return r.choice(VARS)
+        return str(r.randrange(1000))
+
+    def chain(self,terms):
+        ''' Terms joined by operators, left to right '''
+        r = self.random
+        e = self.atom()
+        for i in range(terms - 1):
+            op = r.choice('+-*+-/')
+            if op == '/':
+                e += ' / %d' % r.randrange(1,10)
+            else:
+                e += ' %s %s' % (op,self.atom())
+        return e
+
+    def cond(self):
+        r = self.random
+        return '%s %s %s' % (r.choice(VARS),r.choice(['<','>','<=','>=']),self.atom())
+
+    def straight(self,width):
+        r = self.random
+        if r.random() < 0.2:
+            return ['print %s' % self.chain(width)]
+        return ['%s = %s' % (r.choice(VARS),self.chain(width))]
+
+    def nested(self,width):
+        ''' width levels alternating if and while, each loop running once '''
+        width = min(width,MAX_DEPTH)
+        counters = [self.name('k') for i in range(0,width,2)]
+        lines = ['%s = 0' % k for k in counters]
+        for depth in range(width):
+            indent = '    ' * depth
+            if depth % 2:
+                lines.append('%sif %s {' % (indent,self.cond()))
+            else:
+                lines.append('%swhile %s < 1 {' % (indent,counters[depth/2]))
+            lines.append('%s    %s' % (indent,self.straight(2)[0]))
+        for depth in reversed(range(width)):
+            indent = '    ' * depth
+            if depth % 2 == 0:
+                k = counters[depth/2]
+                lines.append('%s    %s = %s + 1' % (indent,k,k))
+            lines.append('%s}' % indent)
+        return lines
+
+    def arrays(self,width):
+        r = self.random
+        a = self.name('a')
+        return ['%s = [%s]' % (a,','.join(self.atom() for i in range(width))),
+            '%s[%d] = %s' % (a,r.randrange(width),self.chain(3)),
+            'print %s[%d]' % (a,r.randrange(width))]
+
+    def strings(self,width):
+        r = self.random
+        s = self.name('s')
+        text = ''.join(r.choice(LETTERS) for i in range(width))
+        return ['%s = "%s"' % (s,text),
+            "%s[%d] = '%s'" % (s,r.randrange(width),r.choice(LETTERS[:26])),
+            'print %s' % s]
+
+    def expr(self,width):
+        ''' An expression nested width deep, two terms per level '''
+        r = self.random
+        e = self.atom()
+        for i in range(min(width,MAX_DEPTH)):
+            op = r.choice('+-*')
+            if r.random() < 0.5:
+                e = '(%s %s %s)' % (e,op,self.atom())
+            else:
+                e = '(%s %s %s)' % (self.atom(),op,e)
+        return ['%s = %s' % (r.choice(VARS),e)]
+
+    def program(self,shape,size,width=None):
+        shapes = SHAPES[:-1] if shape == 'mixed' else [shape]
+        widths = dict((shape,width or WIDTH[shape]) for shape in shapes)
+        if 'nested' in widths:
+            widths['nested'] = max(1,min(widths['nested'],size / (3*len(shapes))))
+        statements = 0
+        i = 0
+        while statements < size:
+            shape = shapes[i % len(shapes)]
+            lines = getattr(self,shape)(widths[shape])
+            self.lines.extend(lines)
+            statements += len([l for l in lines if not l.strip() == '}'])
+            i += 1
+        return '\n'.join(self.lines) + '\n'
+
+
+def generate(shape,size,width=None,seed=0):
+    ''' Source text of a program of about size statements '''
+    if shape not in SHAPES:
+        raise ValueError('unknown shape %s' % shape)
+    return Generator(seed).program(shape,size,width)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'usage: progen.py %s size [width [seed]]' % '|'.join(SHAPES)
+        sys.exit(1)
+    args = [int(a) for a in sys.argv[2:]]
+    sys.stdout.write(generate(sys.argv[1],*args))
@@ -0,0 +1,256 @@
+''' Value range analysis over Simple-IR, used to drop array bounds checks.
+
+Every virtual register holding an int gets an interval [lo,hi] of the
+values it may have at each instruction; a pointer register may also have
+an interval for the length of the array it points to. Lengths come from
+the store that initializes a new array ('alloc' followed by a store at
+the length offset) and flow through copies and length loads; an 'append'
+adds one to the length of its array.
+
+Branches refine the operands of the relation they test, and a passed
+'chk' refines its index, so an induction variable bounded by the loop
+condition gets a finite range inside the loop even though it is widened
+at the loop head. A 'chk' whose index range lies within [0,length) for
+every possible length is removed, together with the length load that fed
+only the check.
+'''
+from sofortTypes import INT_MIN, INT_MAX, DynamicArray, Int, trunc_div
+
+FULL = (INT_MIN,INT_MAX)
+
+LENGTH_OFFSET = DynamicArray(Int()).length_offset
+
+# Relation holding when the one tested does not
+NEGATED = {'lt':'ge','ge':'lt','gt':'le','le':'gt'}
+
+# Visits of a label before its ranges are widened
+WIDEN_AFTER = 2
+
+
+def clamp(lo,hi):
+    ''' Interval of an operation result; anything that may wrap is unknown '''
+    if lo < INT_MIN or hi > INT_MAX:
+        return FULL
+    return (lo,hi)
+
+def join(a,b):
+    return (min(a[0],b[0]),max(a[1],b[1]))
+
+def widen(old,new):
+    return (INT_MIN if new[0] < old[0] else old[0],
+        INT_MAX if new[1] > old[1] else old[1])
+
+def arith(op,a,b):
+    if op == 'add':
+        return clamp(a[0] + b[0],a[1] + b[1])
+    elif op == 'sub':
+        return clamp(a[0] - b[1],a[1] - b[0])
+    elif op == 'mul':
+        corners = [x*y for x in a for y in b]
+        return clamp(min(corners),max(corners))
+    elif op == 'div':
+        if b[0] <= 0 <= b[1]:
+            return FULL
+        corners = [trunc_div(x,y) for x in a for y in b]
+        return clamp(min(corners),max(corners))
+
+def relation(op,a,b):
+    ''' 0/1 result of a comparison, exact when the ranges decide it '''
+    if op == 'lt':
+        true,false = a[1] < b[0],a[0] >= b[1]
+    elif op == 'gt':
+        true,false = a[0] > b[1],a[1] <= b[0]
+    elif op == 'le':
+        true,false = a[1] <= b[0],a[0] > b[1]
+    else:
+        true,false = a[0] >= b[1],a[1] < b[0]
+    if true:
+        return (1,1)
+    if false:
+        return (0,0)
+    return (0,1)
+
+def refine(op,a,b):
+    ''' Narrow a and b given that "a op b" holds; None if it cannot '''
+    if op in ('gt','ge'):
+        swapped = refine({'gt':'lt','ge':'le'}[op],b,a)
+        return swapped and swapped[::-1]
+    strict = 1 if op == 'lt' else 0
+    a,b = (a[0],min(a[1],b[1] - strict)),(max(b[0],a[0] + strict),b[1])
+    if a[0] > a[1] or b[0] > b[1]:
+        return None
+    return a,b
+
+
+class State:
+    ''' Ranges of int registers and array lengths of pointer registers '''
+
+    def __init__(self,ranges=None,lengths=None):
+        self.ranges = ranges or {}
+        self.lengths = lengths or {}
+
+    def copy(self):
+        return State(dict(self.ranges),dict(self.lengths))
+
+    def get(self,a):
+        if isinstance(a,str):
+            return self.ranges.get(a,FULL)
+        return (a,a)
+
+    def set(self,v,r):
+        if r == FULL:
+            self.ranges.pop(v,None)
+        else:
+            self.ranges[v] = r
+        self.lengths.pop(v,None)
+
+    def merge(self,other,widening=False):
+        ''' Join other into self, True if anything changed '''
+        combine = widen if widening else join
+        changed = False
+        for table,theirs in ((self.ranges,other.ranges),(self.lengths,other.lengths)):
+            for v,r in table.items():
+                new = combine(r,theirs[v]) if v in theirs else FULL
+                if new == FULL:
+                    del table[v]
+                    changed = True
+                elif new != r:
+                    table[v] = new
+                    changed = True
+        return changed
+
+    def __eq__(self,other):
+        return self.ranges == other.ranges and self.lengths == other.lengths
+
+
+def transfer(inst,state):
+    op = inst[0]
+    if op == 'cp':
+        src,dst = inst[2],inst[3]
+        state.set(dst,state.get(src))
+        if src in state.lengths:
+            state.lengths[dst] = state.lengths[src]
+    elif op == 'neg':
+        lo,hi = state.get(inst[2])
+        state.set(inst[3],clamp(-hi,-lo))
+    elif op in ('add','sub','mul','div'):
+        r = FULL if inst[1] == 'ptr' else arith(op,state.get(inst[2]),state.get(inst[3]))
+        state.set(inst[4],r)
+    elif op in NEGATED:
+        state.set(inst[4],relation(op,state.get(inst[2]),state.get(inst[3])))
+    elif op == 'ld':
+        t,base,offset,dst = inst[1:]
+        if t == 'i32' and offset == LENGTH_OFFSET and base in state.lengths:
+            state.set(dst,state.lengths[base])
+        elif t == 'i8':
+            state.set(dst,(0,255))
+        else:
+            state.set(dst,FULL)
+    elif op == 'st':
+        t,src,base,offset = inst[1:]
+        if t == 'i32' and offset == LENGTH_OFFSET:
+            state.lengths[base] = state.get(src)
+    elif op == 'alloc':
+        state.set(inst[-1],FULL)
+    elif op == 'append':
+        length = state.lengths.get(inst[2])
+        state.set(inst[4],FULL)
+        if length:
+            length = clamp(length[0] + 1,length[1] + 1)
+            if length != FULL:
+                state.lengths[inst[4]] = length
+    elif op == 'chk':
+        index,length = inst[2:]
+        lo,hi = state.get(index)
+        r = (max(lo,0),min(hi,state.get(length)[1] - 1))
+        if isinstance(index,str) and r[0] <= r[1]:
+            state.set(index,r)
+
+
+def branch_states(body,i,state):
+    ''' States on the fall-through and jump edges of the jz at body[i] '''
+    taken,fall = state,state.copy()
+    cond = body[i][2]
+    prev = body[i-1] if i > 0 else None
+    if not (prev and prev[0] in NEGATED and prev[4] == cond):
+        return fall,taken
+    op,a,b = prev[0],prev[2],prev[3]
+    for s,rel in ((fall,op),(taken,NEGATED[op])):
+        refined = refine(rel,s.get(a),s.get(b))
+        if refined is None:
+            # This edge is never taken
+            s.ranges = None
+            continue
+        for v,r in zip((a,b),refined):
+            if isinstance(v,str):
+                lengths = s.lengths.get(v)
+                s.set(v,r)
+                if lengths:
+                    s.lengths[v] = lengths
+    return fall,taken
+
+
+def analyze(body):
+    ''' State at the entry of every instruction, None where unreachable '''
+    n = len(body)
+    labels = dict((inst[1],i) for i,inst in enumerate(body) if inst[0] == 'label')
+    states = [None] * n
+    visits = [0] * n
+    if n:
+        states[0] = State()
+    work = [0]
+    while work:
+        i = work.pop()
+        state = states[i].copy()
+        inst = body[i]
+        op = inst[0]
+        if op == 'jmp':
+            edges = [(labels[inst[1]],state)]
+        elif op == 'jz':
+            fall,taken = branch_states(body,i,state)
+            edges = [(i+1,fall),(labels[inst[3]],taken)]
+        elif op == 'ret':
+            edges = []
+        else:
+            transfer(inst,state)
+            edges = [(i+1,state)]
+        for j,s in edges:
+            if j >= n or s.ranges is None:
+                continue
+            if states[j] is None:
+                states[j] = s.copy()
+            else:
+                visits[j] += 1
+                widening = body[j][0] == 'label' and visits[j] > WIDEN_AFTER
+                if not states[j].merge(s,widening):
+                    continue
+            if j not in work:
+                work.append(j)
+    return states
+
+
+def eliminate_checks(body):
+    ''' body without the 'chk's the range analysis proves redundant '''
+    states = analyze(body)
+    result = []
+    for inst,state in zip(body,states):
+        if inst[0] == 'chk' and state is not None:
+            index = state.get(inst[2])
+            length = state.get(inst[3])
+            if index[0] >= 0 and index[1] < length[0]:
+                continue
+        result.append(inst)
+    return remove_dead_loads(result)
+
+def remove_dead_loads(body):
+    used = set()
+    for inst in body:
+        if inst[0] == 'alloc':
+            continue # its operands are not registers
+        elif inst[0] in ('cp','neg','ld'):
+            used.update(a for a in inst[2:-1] if isinstance(a,str))
+        elif inst[0] in ('add','sub','mul','div') or inst[0] in NEGATED:
+            used.update(a for a in inst[2:4] if isinstance(a,str))
+        else:
+            used.update(a for a in inst[2:] if isinstance(a,str))
+    return [inst for inst in body if inst[0] != 'ld' or inst[-1] in used]
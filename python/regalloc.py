@@ -0,0 +1,540 @@
+''' Register-allocating backend: Simple-IR to 32-bit x86.
+
+Every virtual register gets a live interval from a liveness analysis over the
+function's control flow graph. Instruction i reads its operands at position
+2*i and writes its result at 2*i+1, so a value whose last use is at i can
+share a register with the result of i. Intervals are then assigned to
+REGISTERS by linear scan; when all registers are busy the interval ending
+last is spilled to a stack slot.
+
+%eax is never allocated: it is the scratch register for spilled operands,
+byte stores, idivl and call results. Values living across a call prefer the
+callee-saved registers; caller-saved ones are pushed around the call.
+
+Usage:
+
+  emitter = generate(ASTParser(ast).parse())
+  emitter.flush(file)
+'''
+from emitter import *
+from sofortTypes import String, append_routine
+from ranges import eliminate_checks
+from strength import mul_imm, div_imm
+
+REGISTERS = ['%ebx','%ecx','%edx','%edi','%esi']
+
+CALLEE_SAVED = ['%ebx','%edi','%esi']
+
+CALLER_SAVED = ['%ecx','%edx']
+
+BYTE_REGS = {'%eax':'%al','%ebx':'%bl','%ecx':'%cl','%edx':'%dl'}
+
+ARITH_INST = {'add':'addl','sub':'subl','mul':'imull'}
+
+SET_INST = {'lt':'setl','gt':'setg','le':'setle','ge':'setge'}
+
+# Jump taken when the relation does not hold
+JUMP_FALSE = {'lt':'jge','gt':'jle','le':'jg','ge':'jl'}
+
+CALLS = set(['print','alloc','append','mark','release'])
+
+STRING_HEADER = String().header_size
+
+# Element size of the arrays appended to
+APPEND_SIZE = {'i8':1,'i32':4,'ptr':4}
+
+
+def operands(inst):
+    ''' Virtual registers read and the one written (or None) by inst '''
+    op = inst[0]
+    if op in ('cp','neg','ld'):
+        uses,dst = inst[2:3],inst[-1]
+    elif op in ('add','sub','mul','div','lt','gt','le','ge','append'):
+        uses,dst = inst[2:4],inst[4]
+    elif op == 'st':
+        uses,dst = inst[2:4],None
+    elif op == 'alloc':
+        uses,dst = (),inst[-1]
+    elif op in ('chk',):
+        uses,dst = inst[2:4],None
+    elif op in ('print','jz','ret'):
+        uses,dst = inst[2:3],None
+    else:
+        uses,dst = (),None
+    return [u for u in uses if isinstance(u,str)],dst
+
+
+def fold_copies(body):
+    ''' Let an instruction write straight into the variable its temporary is
+        copied to: "add a,b,%1; cp %1,x" becomes "add a,b,x".
+    '''
+    count = {}
+    for inst in body:
+        for u in operands(inst)[0]:
+            count[u] = count.get(u,0) + 1
+    result = []
+    i = 0
+    while i < len(body):
+        inst = body[i]
+        dst = operands(inst)[1]
+        if (dst and dst.startswith('%') and count[dst] == 1 and i + 1 < len(body)
+                and body[i+1][0] == 'cp' and body[i+1][2] == dst):
+            result.append(inst[:-1] + (body[i+1][3],))
+            i += 2
+        else:
+            result.append(inst)
+            i += 1
+    return result
+
+
+def liveness(body):
+    ''' live_in and live_out sets of every instruction '''
+    n = len(body)
+    labels = dict((inst[1],i) for i,inst in enumerate(body) if inst[0] == 'label')
+    succ = []
+    info = []
+    for i,inst in enumerate(body):
+        op = inst[0]
+        if op == 'jmp':
+            succ.append([labels[inst[1]]])
+        elif op == 'jz':
+            succ.append([i+1,labels[inst[3]]])
+        elif op == 'ret' or i + 1 == n:
+            succ.append([])
+        else:
+            succ.append([i+1])
+        info.append(operands(inst))
+    live_in = [set() for i in range(n)]
+    live_out = [set() for i in range(n)]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(xrange(n)):
+            out = set()
+            for s in succ[i]:
+                out |= live_in[s]
+            uses,dst = info[i]
+            live = out - set([dst])
+            live.update(uses)
+            if live != live_in[i] or out != live_out[i]:
+                live_in[i],live_out[i] = live,out
+                changed = True
+    return live_in,live_out
+
+
+class Interval:
+
+    def __init__(self,vreg,pos):
+        self.vreg = vreg
+        self.start = self.end = pos
+        self.crosses_call = False
+
+    def extend(self,pos):
+        if pos < self.start:
+            self.start = pos
+        elif pos > self.end:
+            self.end = pos
+
+
+def build_intervals(body,live_in,live_out):
+    intervals = {}
+    def extend(v,pos):
+        if v in intervals:
+            intervals[v].extend(pos)
+        else:
+            intervals[v] = Interval(v,pos)
+    for i,inst in enumerate(body):
+        for v in live_in[i]:
+            extend(v,2*i)
+        for v in live_out[i]:
+            extend(v,2*i+1)
+        dst = operands(inst)[1]
+        if dst:
+            extend(dst,2*i+1)
+        if inst[0] in CALLS:
+            for v in live_in[i] & live_out[i]:
+                intervals[v].crosses_call = True
+    return sorted(intervals.values(),key=lambda iv: (iv.start,iv.vreg))
+
+
+class LinearScan:
+    ''' Assigns each interval a register or a spill slot number '''
+
+    def __init__(self,registers=REGISTERS):
+        self.registers = registers
+        self.locs = {}
+        self.slots = 0
+
+    def allocate(self,intervals):
+        free = list(self.registers)
+        active = []
+        for iv in intervals:
+            # Expire intervals that ended before this one starts
+            for old in list(active):
+                if old.end < iv.start:
+                    active.remove(old)
+                    free.append(self.locs[old.vreg])
+            if free:
+                reg = self.choose(free,iv)
+                free.remove(reg)
+                self.locs[iv.vreg] = reg
+                active.append(iv)
+                active.sort(key=lambda a: a.end)
+                continue
+            victim = active[-1]
+            if victim.end > iv.end:
+                self.locs[iv.vreg] = self.locs[victim.vreg]
+                self.spill(victim)
+                active[-1] = iv
+                active.sort(key=lambda a: a.end)
+            else:
+                self.spill(iv)
+        return self.locs
+
+    def choose(self,free,iv):
+        prefer = CALLEE_SAVED if iv.crosses_call else CALLER_SAVED
+        for reg in prefer:
+            if reg in free:
+                return reg
+        return free[0]
+
+    def spill(self,iv):
+        self.locs[iv.vreg] = self.slots
+        self.slots += 1
+
+
+class FunctionCodegen:
+    ''' Emits one IR function through an Emitter '''
+
+    def __init__(self,emitter,header,body,alloc_stats=False):
+        self.emitter = emitter
+        self.emit = emitter.emit
+        self.name = header[1]
+        self.body = fold_copies(body)
+        self.live_in,self.live_out = liveness(self.body)
+        allocator = LinearScan()
+        self.locs = allocator.allocate(build_intervals(self.body,self.live_in,self.live_out))
+        used = set(self.locs.values())
+        self.saved = [r for r in CALLEE_SAVED if r in used]
+        self.slots = allocator.slots
+        # The marks of the arena's scopes follow the spill slots
+        self.marks = len([inst for inst in self.body if inst[0] == 'mark'])
+        self.alloc_stats = alloc_stats
+        self.labels = {}
+
+    def operand(self,a):
+        if not isinstance(a,str):
+            return '$%d' % a
+        loc = self.locs[a]
+        if isinstance(loc,str):
+            return loc
+        return '-%d(%%ebp)' % stack_offset(len(self.saved) + loc)
+
+    def label(self,name):
+        if name not in self.labels:
+            self.labels[name] = self.emitter.new_label()
+        return self.labels[name]
+
+    def generate(self):
+        name = mangle(self.name)
+        self.emitter.emit_raw('\n.text\n.globl %s\n%s:' % (name,name))
+        self.emit('pushl %ebp')
+        self.emit('movl %esp,%ebp')
+        for reg in self.saved:
+            self.emit('pushl %s' % reg)
+        frame = self.slots + ARENA_MARK*self.marks
+        if frame:
+            self.emit('subl $%d,%%esp' % (frame*4))
+        body = self.body
+        i = 0
+        while i < len(body):
+            inst = body[i]
+            op = inst[0]
+            if op in JUMP_FALSE and i + 1 < len(body) and self.fuses(i):
+                self.compare(inst[2],inst[3])
+                self.emit('%s %s' % (JUMP_FALSE[op],self.label(body[i+1][3])))
+                i += 2
+                continue
+            if op in ARITH_INST:
+                self.arith(i,*inst)
+            else:
+                getattr(self,'gen_%s' % op)(i,*inst)
+            i += 1
+
+    def fuses(self,i):
+        ''' A relation only used by the following jz becomes cmp and jcc '''
+        jz = self.body[i+1]
+        dst = self.body[i][4]
+        return jz[0] == 'jz' and jz[2] == dst and dst not in self.live_out[i+1]
+
+    def save_caller_saved(self,i,dst=None):
+        saved = [r for r in CALLER_SAVED
+            if any(self.locs[v] == r for v in self.live_out[i] if v != dst)]
+        for reg in saved:
+            self.emit('pushl %s' % reg)
+        return saved
+
+    def restore(self,saved):
+        for reg in reversed(saved):
+            self.emit('popl %s' % reg)
+
+    def move(self,src,dst):
+        if src == dst:
+            return
+        if is_mem(src) and is_mem(dst):
+            self.emit('movl %s,%%eax' % src)
+            src = '%eax'
+        self.emit('movl %s,%s' % (src,dst))
+
+    def compare(self,a,b):
+        ''' Set flags for a - b '''
+        A,B = self.operand(a),self.operand(b)
+        if not is_reg(A) and not (is_mem(A) and not is_mem(B)):
+            self.emit('movl %s,%%eax' % A)
+            A = '%eax'
+        self.emit('cmpl %s,%s' % (B,A))
+
+    def gen_label(self,i,op,name):
+        self.emitter.label(self.label(name))
+
+    def gen_jmp(self,i,op,name):
+        self.emitter.jump(self.label(name))
+
+    def gen_jz(self,i,op,t,a,name):
+        A = self.operand(a)
+        if not isinstance(a,str):
+            if a == 0:
+                self.emitter.jump(self.label(name))
+            return
+        if is_reg(A):
+            self.emit('testl %s,%s' % (A,A))
+        else:
+            self.emit('cmpl $0,%s' % A)
+        self.emit('je %s' % self.label(name))
+
+    def gen_cp(self,i,op,t,src,dst):
+        self.move(self.operand(src),self.operand(dst))
+
+    def gen_neg(self,i,op,t,a,dst):
+        A,D = self.operand(a),self.operand(dst)
+        if is_reg(D) or A == D:
+            self.move(A,D)
+            self.emit('negl %s' % D)
+        else:
+            self.emit('movl %s,%%eax' % A)
+            self.emit('negl %eax')
+            self.emit('movl %%eax,%s' % D)
+
+    def arith(self,i,op,t,a,b,dst):
+        A,B,D = self.operand(a),self.operand(b),self.operand(dst)
+        if op == 'mul' and isinstance(b,str) and not isinstance(a,str):
+            a,b,A,B = b,a,B,A
+        if op == 'mul' and not isinstance(b,str) and self.mul_imm(A,b,D):
+            return
+        inst = ARITH_INST[op]
+        if is_reg(D):
+            if D != B or D == A:
+                self.move(A,D)
+                self.emit('%s %s,%s' % (inst,B,D))
+                return
+            elif op != 'sub':
+                self.emit('%s %s,%s' % (inst,A,D))
+                return
+        self.emit('movl %s,%%eax' % A)
+        self.emit('%s %s,%%eax' % (inst,B))
+        self.emit('movl %%eax,%s' % D)
+
+    def mul_imm(self,A,value,D):
+        ''' Multiply by a constant without imull, False if not worth it '''
+        R = D if is_reg(D) else '%eax'
+        code = mul_imm(value,R,'%eax' if R != '%eax' else None)
+        if code is None:
+            return False
+        self.move(A,R)
+        for inst in code:
+            self.emit(inst)
+        self.move(R,D)
+        return True
+
+    def gen_div(self,i,op,t,a,b,dst):
+        A,B,D = self.operand(a),self.operand(b),self.operand(dst)
+        code = None
+        if not isinstance(b,str) and isinstance(a,str):
+            code = div_imm(b,A)
+        # idivl takes edx:eax, leaves the remainder in edx
+        pushed = B == '%edx' or code and A == '%edx' or any(self.locs[v] == '%edx'
+            for v in self.live_out[i] if v != dst)
+        if pushed:
+            self.emit('pushl %edx')
+            if B == '%edx':
+                B = '(%esp)'
+            if code and A == '%edx':
+                # The dividend is read after edx is overwritten
+                code = div_imm(b,'(%esp)')
+        if code is not None:
+            for inst in code:
+                self.emit(inst)
+        else:
+            self.emit('movl %s,%%eax' % A)
+            if not isinstance(b,str):
+                self.emit('pushl %s' % B)
+                B = '(%esp)'
+            self.emit('cdq')
+            self.emit('idivl %s' % B)
+            if not isinstance(b,str):
+                self.emit('addl $4,%esp')
+        if pushed:
+            self.emit('popl %edx')
+        self.emit('movl %%eax,%s' % D)
+
+    def relation(self,i,op,t,a,b,dst):
+        self.compare(a,b)
+        self.emit('%s %%al' % SET_INST[op])
+        D = self.operand(dst)
+        if is_reg(D):
+            self.emit('movzbl %%al,%s' % D)
+        else:
+            self.emit('movzbl %al,%eax')
+            self.emit('movl %%eax,%s' % D)
+
+    gen_lt = gen_gt = gen_le = gen_ge = relation
+
+    def base(self,base):
+        B = self.operand(base)
+        if is_mem(B):
+            self.emit('movl %s,%%eax' % B)
+            B = '%eax'
+        return B
+
+    def gen_ld(self,i,op,t,base,offset,dst):
+        B,D = self.base(base),self.operand(dst)
+        inst = 'movzbl' if t == 'i8' else 'movl'
+        if is_reg(D):
+            self.emit('%s %d(%s),%s' % (inst,offset,B,D))
+        else:
+            self.emit('%s %d(%s),%%eax' % (inst,offset,B))
+            self.emit('movl %%eax,%s' % D)
+
+    def gen_st(self,i,op,t,src,base,offset):
+        S,B = self.operand(src),self.operand(base)
+        if t == 'i8':
+            inst = 'movb'
+            if isinstance(src,str):
+                S = BYTE_REGS.get(S)
+        else:
+            inst = 'movl'
+            if is_mem(S):
+                S = None
+        restore = False
+        if S is None:
+            # The value has to go through %eax
+            self.emit('movl %s,%%eax' % self.operand(src))
+            S = BYTE_REGS['%eax'] if t == 'i8' else '%eax'
+            if is_mem(B):
+                self.emit('pushl %edx')
+                self.emit('movl %s,%%edx' % B)
+                B = '%edx'
+                restore = True
+        elif is_mem(B):
+            self.emit('movl %s,%%eax' % B)
+            B = '%eax'
+        self.emit('%s %s,%d(%s)' % (inst,S,offset,B))
+        if restore:
+            self.emit('popl %edx')
+
+    def gen_alloc(self,i,op,t,size,arena,dst):
+        saved = self.save_caller_saved(i,dst)
+        self.emit('pushl $%d' % size)
+        if arena is None:
+            self.emitter.call('malloc',1)
+        else:
+            self.emit('pushl $arena_%s' % arena)
+            self.emitter.call('arena_alloc',2)
+        self.restore(saved)
+        self.move('%eax',self.operand(dst))
+
+    def gen_mark(self,i,op,n):
+        self.arena_call(i,'arena_mark',n)
+
+    def gen_release(self,i,op,n):
+        self.arena_call(i,'arena_release',n)
+
+    def arena_call(self,i,routine,n):
+        ''' routine on the n-th mark's ARENA_MARK frame words '''
+        saved = self.save_caller_saved(i)
+        index = len(self.saved) + self.slots + ARENA_MARK*n
+        self.emit('leal -%d(%%ebp),%%eax' % stack_offset(index+ARENA_MARK-1))
+        self.emit('pushl %eax')
+        self.emitter.call(routine,1)
+        self.restore(saved)
+
+    def gen_append(self,i,op,t,array,value,dst):
+        saved = self.save_caller_saved(i,dst)
+        self.emit('pushl %s' % self.operand(value))
+        self.emit('pushl %s' % self.operand(array))
+        self.emitter.call(append_routine(APPEND_SIZE[t]),2)
+        self.restore(saved)
+        self.move('%eax',self.operand(dst))
+
+    def gen_chk(self,i,op,t,index,length):
+        ''' One unsigned compare also catches negative indexes '''
+        I,L = self.operand(index),self.operand(length)
+        if not isinstance(index,str):
+            self.emit('cmpl %s,%s' % (I,L))
+            self.emit('jbe %s' % mangle('exception'))
+            return
+        if is_mem(I) and is_mem(L):
+            self.emit('movl %s,%%eax' % L)
+            L = '%eax'
+        self.emit('cmpl %s,%s' % (L,I))
+        self.emit('jae %s' % mangle('exception'))
+
+    def gen_print(self,i,op,t,a):
+        saved = self.save_caller_saved(i)
+        A = self.operand(a)
+        if t == 'ptr':
+            if is_reg(A):
+                self.emit('leal %d(%s),%%eax' % (STRING_HEADER,A))
+            else:
+                self.emit('movl %s,%%eax' % A)
+                self.emit('addl $%d,%%eax' % STRING_HEADER)
+            A = '%eax'
+        self.emit('pushl %s' % A)
+        self.emitter.call({'i32':'out_int','i8':'out_char','ptr':'out_string'}[t],1)
+        self.restore(saved)
+
+    def gen_ret(self,i,op,t,a):
+        if self.name == 'main':
+            # The program ends when main returns
+            self.emitter.call('arena_report' if self.alloc_stats else 'out_flush',0)
+        self.emit('movl %s,%%eax' % self.operand(a))
+        if self.saved:
+            self.emit('leal -%d(%%ebp),%%esp' % (len(self.saved)*4))
+            for reg in reversed(self.saved):
+                self.emit('popl %s' % reg)
+            self.emit('popl %ebp')
+        else:
+            self.emit('leave')
+        self.emit('ret')
+
+
+def generate(funcs,emitter=None,checks=False,alloc_stats=False):
+    ''' Emit a whole program from ASTParser.parse() output. Unless checks
+        is set, bounds checks the range analysis proves redundant are dropped.
+        With alloc_stats main reports the arenas' use when it returns.
+    '''
+    emitter = emitter or Emitter()
+    emitter.begin_prog()
+    sizes = set()
+    arenas = alloc_stats
+    for header,body in funcs:
+        if not checks:
+            body = eliminate_checks(body)
+        FunctionCodegen(emitter,header,body,alloc_stats).generate()
+        sizes.update(APPEND_SIZE[inst[1]] for inst in body if inst[0] == 'append')
+        arenas = arenas or any(inst[0] == 'alloc' and inst[3] for inst in body)
+    for size in sorted(sizes):
+        emitter.emit_append_runtime(size)
+    if arenas:
+        emitter.emit_arena_runtime(alloc_stats)
+    return emitter
@@ -1,4 +1,11 @@
 
+from array import array
+import mmap
+from operator import itemgetter
+import os
+import re
+import stat
+
 class AppException(Exception):
     pass
 
@@ -36,102 +43,156 @@ ops_or_parens = operands + parens + separators
 
 EOF = ''
 
-keywords = set(['if','while','else','print'])
-
-class Token:
-    
-    def __hash__(self):
-        return self.value.__hash__()
-        
-    def __cmp__(self,other):
-        return self.value.__cmp__(other.value)
-
-
-class StringLiteral(Token):
-
-    def __init__(self,literal):
-        self.value = literal
-
-    def __eq__(self,other):
-        return self.value == other
-
-    def __ne__(self,other):
-        return self.value != other
- 
-class IntLiteral(Token):
-
-    def __init__(self,literal):
-        self.value = literal
-
-class CharLiteral(Token):
-
-    def __init__(self,literal):
-        self.value = literal    
-        
-    def __eq__(self,other):
-        return self.value == other
-
-    def __ne__(self,other):
-        return self.value != other
-        
-class Word(Token):
-
-    def __init__(self,name):
-        self.value = name
-
-    def __eq__(self,other):
-        try:
-            return self.value == other or self.value == other.value
-        except AttributeError:
-            return False
+keywords = set(['if','while','else','print','append'])
+
+# Token kinds
+
+(T_EOF, T_IDENT, T_INT, T_CHAR, T_STRING,
+ T_IF, T_WHILE, T_ELSE, T_PRINT, T_APPEND,
+ T_PLUS, T_MINUS, T_STAR, T_SLASH, T_ASSIGN,
+ T_LT, T_GT, T_LE, T_GE,
+ T_LPAREN, T_RPAREN, T_LBRACE, T_RBRACE, T_LBRACKET, T_RBRACKET, T_COMMA) = range(26)
+
+# Kinds of keywords and operators, which are fully determined by their spelling
+TOKEN_KIND = {
+    'if' : T_IF, 'while' : T_WHILE, 'else' : T_ELSE, 'print' : T_PRINT, 'append' : T_APPEND,
+    '+' : T_PLUS, '-' : T_MINUS, '*' : T_STAR, '/' : T_SLASH, '=' : T_ASSIGN,
+    '<' : T_LT, '>' : T_GT, '<=' : T_LE, '>=' : T_GE,
+    '(' : T_LPAREN, ')' : T_RPAREN, '{' : T_LBRACE, '}' : T_RBRACE,
+    '[' : T_LBRACKET, ']' : T_RBRACKET, ',' : T_COMMA,
+}
+
+KIND_NAME = dict((kind,spelling) for spelling,kind in TOKEN_KIND.items())
+KIND_NAME.update({T_EOF:'EOF', T_IDENT:'identifier', T_INT:'int literal',
+    T_CHAR:'char literal', T_STRING:'string literal'})
+
+RELOPS = {
+    T_LT : 'lt',
+    T_GT : 'gt',
+    T_LE : 'le',
+    T_GE : 'ge',
+}
+
+PRIMITIVE_TYPES = set(['int','char','string'])
+
+# A token position packs the line above the column. A whole array
+# constructor may be on one line, so columns get 32 bits.
+COL_BITS = 32
+COL_MASK = (1 << COL_BITS) - 1
+
+def pack_pos(line,col):
+    if col > COL_MASK:
+        raise AppException('line %d is longer than %d characters' % (line,COL_MASK))
+    return line << COL_BITS | col
+
+class Token(tuple):
+    ''' Compact token: (kind, value, packed position of its first char).
+        Identifier values are interned, keyword and operator values are
+        their (constant) spelling.
+    '''
+    __slots__ = ()
+    kind = property(itemgetter(0))
+    value = property(itemgetter(1))
+    pos = property(itemgetter(2))
+
+    @property
+    def line(self):
+        return self[2] >> COL_BITS
+
+    @property
+    def col(self):
+        return self[2] & COL_MASK
 
-    def __ne__(self,other):
-        try:
-            return self.value != other or self.value != other.value
-        except AttributeError:
-            return False
-            
     def __str__(self):
-        return str(self.value)
+        return str(self[1])
 
-class Ident(Word):
+def word_token(id,pos):
+    kind = TOKEN_KIND.get(id,T_IDENT)
+    if kind == T_IDENT:
+        id = intern(id)
+    return Token((kind,id,pos))
 
-    def __init__(self,name):
-        Word.__init__(self,name)
+def op_token(op,pos):
+    return Token((TOKEN_KIND[op],op,pos))
+
 
-class Keyword(Word):
-    
-    def __init__(self,name):
-        Word.__init__(self,name)
+# Input
+
+CHUNK_SIZE = 64*1024
+
+def read_source(file):
+    ''' Return the whole contents of file as an indexable buffer.
+        Regular files are memory-mapped, anything else (stdin, pipes, StringIO)
+        is read in large chunks.
+    '''
+    try:
+        fd = file.fileno()
+        st = os.fstat(fd)
+    except (AttributeError,IOError,OSError):
+        fd = None
+    if fd is not None and stat.S_ISREG(st.st_mode) and st.st_size > 0:
+        try:
+            return mmap.mmap(fd,0,access=mmap.ACCESS_READ)
+        except (mmap.error,ValueError):
+            pass
+    chunks = []
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return ''.join(chunks)
 
 
 class Scanner:
     
-    def __init__(self,file):
+    def __init__(self,file,data=None,start=0,line=1,line_start=0):
+        ''' Scan the contents of file, or of data if given (file then only
+            provides the name). Scanning may begin at any offset start,
+            lying on the given line which begins at offset line_start.
+        '''
         self.token = None
         self.file = file
-        self.line = 1
-        self.col = 0
-        self.buffer = []
-        self.content = [self.buffer]
+        self.data = read_source(file) if data is None else data
+        self.index = start
+        self.line = line
+        self.col = start - line_start
+        self.line_start = line_start
+        self.first_line = line
+        self.lines = array('l',[line_start]) # offsets of line starts
         self.getchar()
         
     def pos(self):
-        return self.file.name,self.line,self.col,''.join(self.buffer)
+        return self.file.name,self.line,self.col,self.data[self.line_start:self.index]
+
+    def line_text(self,n):
+        ''' Text of line n (counting from 1) without the trailing newline '''
+        start = self.lines[n-self.first_line]
+        end = self.data.find('\n',start)
+        if end < 0:
+            end = len(self.data)
+        return self.data[start:end]
+
+    def offset(self,pos):
+        ''' Source offset of a packed token position '''
+        return self.lines[(pos >> COL_BITS) - self.first_line] + (pos & COL_MASK) - 1
         
     def getchar(self):
-        self.char = self.file.read(1)
+        i = self.index
+        self.char = self.data[i:i+1] # '' past the end
+        self.index = i + 1
         self.col += 1
-        self.buffer.append(self.char)
 
     def nextline(self):
         self.line += 1
         self.col = 0
-        self.buffer = []
-        self.content.append(self.buffer)
+        self.line_start = self.index
+        self.lines.append(self.index)
         
     def skipline(self):
         while self.char != '\n':
+            if self.char == EOF:
+                return
             self.getchar()
         self.nextline()
         self.getchar()
@@ -149,27 +210,28 @@ class Scanner:
                 
     def scan(self):
         self.skipwhite()
+        pos = pack_pos(self.line,self.col)
         if self.char in digits:
-            return self.scanNumber()
+            return Token((T_INT,self.scanNumber(),pos))
         elif self.char in letters:
-            return self.scanIdentifier()
+            return word_token(self.scanIdentifier(),pos)
         elif self.char in ['<','>']:
             token = self.char 
             self.getchar()
             if self.char == '=':
                 token = token + '='
                 self.getchar()
-            return token
+            return op_token(token,pos)
         elif self.char in ops_or_parens:
             token = self.char 
             self.getchar()
-            return token
+            return op_token(token,pos)
         elif self.char == "'":
-            return self.scanCharLiteral()
+            return Token((T_CHAR,self.scanCharLiteral(),pos))
         elif self.char == '"':
-            return self.scanStringLiteral()
+            return Token((T_STRING,self.scanStringLiteral(),pos))
         elif self.char == '':
-            return EOF
+            return Token((T_EOF,EOF,pos))
         else:
             raise IllegalCharException(self.char,self)
 
@@ -192,26 +254,27 @@ class Scanner:
         self.getchar()
         chars = []
         while self.char != '"':
+            if self.char == EOF:
+                raise ScannerException('Unterminated string literal',self)
             if self.char == '\\':
                 chars.append(self.scanEscapeSeq())
             else:
                 chars.append(self.char)
                 self.getchar()
         self.getchar() # '"'
-        string = ''.join(chars)
-        return StringLiteral(string)
+        return ''.join(chars)
         
     def scanCharLiteral(self):
         self.getchar()
         if self.char == '\\':
-            char = self.scanEscapeSeq()
+            char = self.scanEscapeSeq() # leaves us on the closing "'"
         else:
             char = self.char
-        self.getchar()
+            self.getchar()
         if self.char != "'":
             raise ScannerException('Expected "\'", found "%s"' % repr(self.char),self)
         self.getchar()
-        return CharLiteral(char)
+        return char
     
     def scanNumber(self):
         s = self.char
@@ -227,8 +290,225 @@ class Scanner:
         while self.char in letters:
             id.append(self.char)
             self.getchar()
-        id = ''.join(id)
-        if id in keywords:
-            return Keyword(id)
+        return ''.join(id)
+
+
+# Alternative tokenizer engines.
+# Both produce exactly the same tokens and the same line/col/pos() as Scanner,
+# but consume whole identifiers, numbers and literals at once instead of
+# going through getchar() for every character.
+
+ESCAPES = {'\\':'\\', 'n':'\n', 't':'\t', '"':'"'}
+
+ESCAPE_RE = re.compile(r'\\(.)',re.S)
+
+def unescape(literal):
+    if '\\' not in literal:
+        return literal
+    return ESCAPE_RE.sub(lambda m: ESCAPES.get(m.group(1),m.group(0)),literal)
+
+
+class BufferScanner(Scanner):
+    ''' Base for engines working directly on the source buffer.
+        self.index always points one past the lookahead char, as in Scanner,
+        and line_start is the offset of the first char of the current line.
+    '''
+
+    def __init__(self,file,data=None,start=0,line=1,line_start=0):
+        self.token = None
+        self.file = file
+        self.data = read_source(file) if data is None else data
+        self.size = len(self.data)
+        self.line = line
+        self.line_start = line_start
+        self.first_line = line
+        self.lines = array('l',[line_start])
+        self.advance(start)
+
+    def advance(self,end):
+        ''' Make data[end] the lookahead char '''
+        self.char = self.data[end:end+1]
+        self.index = end + 1
+        self.col = self.index - self.line_start
+
+    def newline(self,offset):
+        ''' Record '\\n' found at offset '''
+        self.line += 1
+        self.line_start = offset + 1
+        self.lines.append(self.line_start)
+
+    def unterminated_char(self,end):
+        self.advance(end)
+        raise ScannerException('Expected "\'", found "%s"' % repr(self.char),self)
+
+
+# Table-driven engine
+
+C_OTHER, C_WHITE, C_NEWLINE, C_COMMENT, C_DIGIT, C_LETTER, C_OP, C_CMP, C_QUOTE, C_DQUOTE = range(10)
+
+CHAR_CLASS = [C_OTHER] * 256
+for c in " \t\r":
+    CHAR_CLASS[ord(c)] = C_WHITE
+CHAR_CLASS[ord('\n')] = C_NEWLINE
+CHAR_CLASS[ord(LINE_COMMENT)] = C_COMMENT
+for c in digits:
+    CHAR_CLASS[ord(c)] = C_DIGIT
+for c in letters:
+    CHAR_CLASS[ord(c)] = C_LETTER
+for c in ops_or_parens:
+    CHAR_CLASS[ord(c)] = C_OP
+for c in '<>':
+    CHAR_CLASS[ord(c)] = C_CMP
+CHAR_CLASS[ord("'")] = C_QUOTE
+CHAR_CLASS[ord('"')] = C_DQUOTE
+del c
+
+class TableScanner(BufferScanner):
+    ''' Dispatches on a precomputed character class table and runs a small
+        DFA over the buffer for every token.
+    '''
+
+    def scan(self):
+        data = self.data
+        size = self.size
+        cls = CHAR_CLASS
+        i = self.index - 1
+        while i < size:
+            c = cls[ord(data[i])]
+            if c == C_WHITE:
+                i += 1
+            elif c == C_NEWLINE:
+                self.newline(i)
+                i += 1
+            elif c == C_COMMENT:
+                i = data.find('\n',i)
+                if i < 0:
+                    i = size
+            else:
+                break
+        else:
+            self.advance(size)
+            return Token((T_EOF,EOF,pack_pos(self.line,self.col)))
+        start = i
+        pos = pack_pos(self.line,start + 1 - self.line_start)
+        if c == C_DIGIT:
+            i += 1
+            while i < size and cls[ord(data[i])] == C_DIGIT:
+                i += 1
+            token = Token((T_INT,int(data[start:i]),pos))
+        elif c == C_LETTER:
+            i += 1
+            while i < size and cls[ord(data[i])] == C_LETTER:
+                i += 1
+            token = word_token(data[start:i],pos)
+        elif c == C_OP:
+            i += 1
+            token = op_token(data[start],pos)
+        elif c == C_CMP:
+            i += 1
+            if data[i:i+1] == '=':
+                i += 1
+            token = op_token(data[start:i],pos)
+        elif c == C_QUOTE:
+            i += 1
+            if data[i:i+1] == '\\':
+                i += 1
+            i += 1
+            if data[i:i+1] != "'":
+                self.unterminated_char(i)
+            i += 1
+            token = Token((T_CHAR,unescape(data[start+1:i-1]),pos))
+        elif c == C_DQUOTE:
+            i += 1
+            while i < size:
+                ch = data[i]
+                if ch == '"':
+                    break
+                i += 2 if ch == '\\' else 1
+            else:
+                self.advance(size)
+                raise ScannerException('Unterminated string literal',self)
+            i += 1
+            token = Token((T_STRING,unescape(data[start+1:i-1]),pos))
         else:
-            return Ident(id)
+            self.advance(start)
+            raise IllegalCharException(self.char,self)
+        self.advance(i)
+        return token
+
+
+# Regex engine
+
+TOKEN_RE = re.compile(r'''
+     (?P<white>[ \t\r]+)
+    |(?P<newline>\n)
+    |(?P<comment>\#[^\n]*)
+    |(?P<number>[0-9]+)
+    |(?P<word>[a-zA-Z]+)
+    |(?P<op>[<>]=?|[-+*/=(){}\[\],])
+    |(?P<char>'(?:\\.|.)')
+    |(?P<badchar>'(?:\\.|.)?)
+    |(?P<string>"(?:\\.|[^"\\])*")
+    |(?P<badstring>")
+    |(?P<illegal>.)
+''',re.X|re.S)
+
+class RegexScanner(BufferScanner):
+    ''' Drives a single compiled master regex with finditer. '''
+
+    def __init__(self,file,*args,**kw):
+        BufferScanner.__init__(self,file,*args,**kw)
+        self.tokens = self.tokenize()
+
+    def scan(self):
+        return self.tokens.next()
+
+    def tokenize(self):
+        newline = self.newline
+        advance = self.advance
+        for m in TOKEN_RE.finditer(self.data,self.index - 1):
+            kind = m.lastgroup
+            if kind == 'white' or kind == 'comment':
+                continue
+            elif kind == 'newline':
+                newline(m.start())
+                continue
+            pos = pack_pos(self.line,m.start() + 1 - self.line_start)
+            if kind == 'number':
+                token = Token((T_INT,int(m.group()),pos))
+            elif kind == 'word':
+                token = word_token(m.group(),pos)
+            elif kind == 'op':
+                token = op_token(m.group(),pos)
+            elif kind == 'char':
+                token = Token((T_CHAR,unescape(m.group()[1:-1]),pos))
+            elif kind == 'string':
+                token = Token((T_STRING,unescape(m.group()[1:-1]),pos))
+            elif kind == 'badchar':
+                self.unterminated_char(m.end())
+            elif kind == 'badstring':
+                advance(self.size)
+                raise ScannerException('Unterminated string literal',self)
+            else:
+                advance(m.start())
+                raise IllegalCharException(self.char,self)
+            advance(m.end())
+            yield token
+        advance(self.size)
+        eof = Token((T_EOF,EOF,pack_pos(self.line,self.col)))
+        while True:
+            yield eof
+
+
+ENGINES = {
+    'char' : Scanner,
+    'table' : TableScanner,
+    'regex' : RegexScanner,
+}
+
+def make_scanner(file,engine='char',**kw):
+    try:
+        scanner_class = ENGINES[engine]
+    except KeyError:
+        raise AppException('Unknown scanner engine %s' % engine)
+    return scanner_class(file,**kw)
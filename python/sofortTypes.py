@@ -1,5 +1,12 @@
+from copy import copy
 
-WORD = 4 # machine word size
+WORD = 4 # machine word size, see set_word()
+INT_SIZE = 4 # int is 32-bit on every target
+
+def set_word(size):
+    ''' Word size of the target; types created afterwards use it '''
+    global WORD
+    WORD = size
 
 def powerOf2(n):
     pow = 1
@@ -8,8 +15,30 @@ def powerOf2(n):
             return i
         pow *= 2
     return None
+
+def append_routine(size):
+    ''' Runtime routine appending to arrays of size-byte elements '''
+    return 'append%d' % size
+
+INT_MIN = -(1 << (INT_SIZE*8 - 1))
+INT_MAX = (1 << (INT_SIZE*8 - 1)) - 1
+
+def wrap(value):
+    ''' Two's complement value of an int '''
+    bits = INT_SIZE*8
+    value &= (1 << bits) - 1
+    if value >> (bits-1):
+        value -= 1 << bits
+    return value
+
+def trunc_div(a,b):
+    ''' Quotient rounded toward zero, as idivl computes it '''
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
     
 class Type:
+
+    const = None # value known at compile time, if any
     
     def __str__(self):
         return self.name
@@ -21,6 +50,10 @@ class Type:
         opname = 'op_'+operation
         return getattr(self,opname,None)
 
+    def runtime(self):
+        ''' The same type for a value computed at run time '''
+        return self.__class__() if self.const is not None else self
+
     def union(self,other):
         if isinstance(self,other.__class__):
             return other
@@ -70,22 +103,33 @@ class BasicType(Type):
     def push(self,emitter):
         emitter.push_acc()
 
+    def constant(self,value):
+        ''' The same type for a value known at compile time '''
+        type = self.__class__()
+        type.const = value
+        return type
+
+    def load_const(self,emitter):
+        emitter.load_imm_int(self.const)
+
 # Abstract subclass for all array-like types
 class Array(ComplexType):
     pass
         
 class DynamicArray(Array):
-    ''' Array of homogeneous objects: <ptr> --> <hdr><n><el_1><el_2>....<el_n>
-        It's contents is allocated dynamically.
+    ''' Array of homogeneous objects: <ptr> --> <hdr><n><cap><el_1><el_2>....<el_n>
+        It's contents is allocated dynamically, with room for cap elements.
     '''
     name = 'array'
     def __init__(self,subtype):
         self.subtype = subtype
         self.sizeof = WORD
         self.stack_size = 1
-        self.header_size = 2*WORD
+        self.header_size = 3*WORD
+        self.length_offset = WORD
+        self.capacity_offset = 2*WORD
         shift = powerOf2(subtype.sizeof)
-        if shift == 1:
+        if shift == 0:
             self.offset_op = lambda e: None
         elif shift is None:
             self.offset_op = lambda e: e.mul_imm_int(subtype.sizeof)
@@ -98,60 +142,78 @@ class DynamicArray(Array):
     def shl_offset(self,emitter):
         emitter.shl_imm_int(self.subtype.sizeof)
     
-    def alloc(self,emitter,length):
-        # Word for header, word for length, rest for contents
-        emitter.push_imm_int(2*WORD+length*self.subtype.sizeof)
-        emitter.call('malloc',1)
-        emitter.move_pointer()
-        self.length = length
+    def alloc(self,emitter,length,site=None):
+        # Words for header, length and capacity, rest for contents
+        emitter.alloc(self.header_size+length*self.subtype.sizeof,site)
+        emitter.store_imm_int_at(self.capacity_offset,length)
         
     def store_at(self,emitter,index=0):
-        self.subtype.store_at(emitter,index*self.subtype.sizeof+self.header_size)
+        ''' Store the element in the accumulator, a pointer too '''
+        offset = index*self.subtype.sizeof+self.header_size
+        if isinstance(self.subtype,ComplexType):
+            emitter.store_acc_pointer_at(offset)
+        else:
+            self.subtype.store_at(emitter,offset)
         
     def load_at(self,emitter,index=0):
-        self.subtype.load_at(emitter,index*self.subtype.sizeof+self.header_size)
+        ''' Load the element, a pointer replacing the array's own '''
+        offset = index*self.subtype.sizeof+self.header_size
+        if isinstance(self.subtype,ComplexType):
+            emitter.load_pointer_at(offset)
+        else:
+            self.subtype.load_at(emitter,offset)
         
     def add_offset(self,emitter):
-        emitter.push_acc()
-        emitter.push_acc()
-        self.op_len(emitter)
-        emitter.pop_cmp_int()
-        label = emitter.new_label()
-        emitter.jump_if_less(label)
-        emitter.call('exception',0)
-        emitter.label(label)
-        emitter.pop_acc()
+        # Unsigned compare: a negative index fails as a huge one
+        emitter.check_index(self.length_offset)
         self.offset_op(emitter) # acc *= sizeof(subtype)
         emitter.add_acc_to_pointer()
     
     def set_length(self,emitter,length):
-        emitter.store_imm_int_at(1,length)
+        emitter.store_imm_int_at(self.length_offset,length)
+        self.length = length
+
+    def append(self,emitter):
+        ''' Append the value pushed last to the array in the pointer register.
+            The array may move; the pointer register is left pointing to it.
+        '''
+        emitter.push_pointer()
+        emitter.call(append_routine(self.subtype.sizeof),2)
+        emitter.move_pointer()
+
+    def runtime(self):
+        ''' The same type, forgetting the length of a new array '''
+        if 'length' not in self.__dict__:
+            return self
+        type = copy(self)
+        del type.length
+        return type
         
     def op_len(self,emitter):
-        emitter.load_acc_int_at(1)
+        emitter.load_acc_int_at(self.length_offset)
         
 class String(DynamicArray):
     ''' String is array of chars. This string type is mutable.
-        <ptr> --> <hdr><n><char_1><char_2>....<char_n><0>
+        <ptr> --> <hdr><n><n+1><char_1><char_2>....<char_n><0>
     '''  
     name = 'string'
     
     def __init__(self):
         DynamicArray.__init__(self,Char())
     
-    def alloc(self,emitter,length):
+    def alloc(self,emitter,length,site=None):
         # Allocate one extra char for null at the end
-        DynamicArray.alloc(self,emitter,length+1)
-        self.length = length
-        self.set_length(emitter,self.length)
+        DynamicArray.alloc(self,emitter,length+1,site)
+        self.set_length(emitter,length)
         
-    def load_literal(self,emitter,literal):
-        self.alloc(emitter,len(literal))
-        index = 0
-        for ch in literal:
-            emitter.store_imm_byte_at(index+self.header_size,ord(ch))
-            index += 1
-        emitter.store_imm_byte_at(index+self.header_size,0)
+    def load_literal(self,emitter,literal,constants,site=None):
+        ''' Point to the literal in the constant pool. The returned load
+            must be made writable if the string may be modified, and the
+            copy is then allocated where site says.
+        '''
+        label = constants.add_string_constant(literal)
+        self.length = len(literal)
+        return emitter.load_const_pointer(label,self.header_size+len(literal)+1,site)
         
     
     def load_c_string(self,emitter):
@@ -185,6 +247,32 @@ class IntegralOps:
         
     def op_lt(self,emitter):
         emitter.pop_lt_int()
+
+    # The right operand is a constant
+
+    def op_add_imm(self,emitter,value):
+        emitter.add_imm_int(value)
+
+    def op_sub_imm(self,emitter,value):
+        emitter.sub_imm_int(value)
+
+    def op_mul_imm(self,emitter,value):
+        emitter.mul_imm_int(value)
+
+    def op_div_imm(self,emitter,value):
+        emitter.div_imm_int(value)
+
+    def op_ge_imm(self,emitter,value):
+        emitter.cmp_imm_int(value,'ge')
+
+    def op_gt_imm(self,emitter,value):
+        emitter.cmp_imm_int(value,'g')
+
+    def op_le_imm(self,emitter,value):
+        emitter.cmp_imm_int(value,'le')
+
+    def op_lt_imm(self,emitter,value):
+        emitter.cmp_imm_int(value,'l')
         
         
 class Int(BasicType,IntegralOps):
@@ -193,7 +281,7 @@ class Int(BasicType,IntegralOps):
     ir_type = 'i32'
     
     def __init__(self):
-        self.sizeof = WORD
+        self.sizeof = INT_SIZE
         self.stack_size = 1        
 
     def load_literal(self,emitter,literal):
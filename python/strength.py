@@ -0,0 +1,188 @@
+''' Strength reduction of multiplication and division by constants.
+
+Both functions return a list of AT&T instructions, or None when imull or
+idivl is the better choice. Results are exact in 32-bit two's complement:
+products wrap like imull and quotients truncate toward zero like idivl.
+
+    mul_imm(value,reg,scratch)  reg *= value, by shifts, lea and add/sub.
+        scratch is a free register for the 2**k+-1 forms, may be None.
+    div_imm(value,x,scratch)    x / value in %eax, clobbers %edx like idivl.
+        x is a register or memory operand other than %edx; the magic-number
+        form copies it to scratch when it is %eax.
+
+Division by a power of two is an arithmetic shift, after adding 2**k-1 to
+negative dividends. Other divisors multiply by a magic number and keep the
+high word (Hacker's Delight, 10-4). Division by 0 and -1 is left to idivl,
+which traps on them.
+
+Run this module to check the sequences against idivl and imull semantics.
+'''
+from sofortTypes import INT_SIZE, wrap, powerOf2
+
+BITS = INT_SIZE*8
+
+# Factors leal can multiply by: (r,r,scale) computes r*(scale+1)
+LEA_FACTORS = {3:2, 5:4, 9:8}
+
+
+def mul_imm(value,reg,scratch=None):
+    value = wrap(value)
+    if value == 0:
+        return ['movl $0,%s' % reg]
+    n = abs(value)
+    code = None
+    if powerOf2(n) is not None:
+        code = [] if n == 1 else ['shll $%d,%s' % (powerOf2(n),reg)]
+    else:
+        for factor,scale in sorted(LEA_FACTORS.items()):
+            k = powerOf2(n // factor) if n % factor == 0 else None
+            if k is not None:
+                code = ['leal (%s,%s,%d),%s' % (reg,reg,scale,reg)]
+                if k:
+                    code.append('shll $%d,%s' % (k,reg))
+                break
+        if code is None and scratch:
+            for delta,inst in ((-1,'addl'),(1,'subl')):
+                k = powerOf2(n + delta)
+                if k is not None:
+                    code = ['movl %s,%s' % (reg,scratch),
+                        'shll $%d,%s' % (k,reg),
+                        '%s %s,%s' % (inst,scratch,reg)]
+                    break
+    if code is None:
+        return None
+    if value < 0:
+        code.append('negl %s' % reg)
+    if len(code) > 3:
+        return None
+    return code
+
+
+def magic(d):
+    ''' Multiplier and shift for signed division by d, 2 <= |d| < 2**31 '''
+    two = 1 << (BITS-1)
+    ad = abs(d)
+    t = two + (1 if d < 0 else 0)
+    anc = t - 1 - t % ad
+    p = BITS - 1
+    q1,r1 = two // anc,two % anc
+    q2,r2 = two // ad,two % ad
+    while True:
+        p += 1
+        q1,r1 = 2*q1,2*r1
+        if r1 >= anc:
+            q1,r1 = q1 + 1,r1 - anc
+        q2,r2 = 2*q2,2*r2
+        if r2 >= ad:
+            q2,r2 = q2 + 1,r2 - ad
+        delta = ad - r2
+        if not (q1 < delta or q1 == delta and r1 == 0):
+            break
+    m = q2 + 1
+    if d < 0:
+        m = -m
+    return wrap(m),p - BITS
+
+def div_imm(value,x,scratch=None):
+    value = wrap(value)
+    if value in (0,-1):
+        return None
+    load = [] if x == '%eax' else ['movl %s,%%eax' % x]
+    if value == 1:
+        return load
+    k = powerOf2(abs(value))
+    if k is not None:
+        code = load + ['cdq',
+            'shrl $%d,%%edx' % (BITS-k),
+            'addl %edx,%eax',
+            'sarl $%d,%%eax' % k]
+        if value < 0:
+            code.append('negl %eax')
+        return code
+    m,s = magic(value)
+    code = []
+    if x == '%eax':
+        if not scratch:
+            return None
+        code.append('movl %%eax,%s' % scratch)
+        x = scratch
+    code += ['movl $%d,%%eax' % m,'imull %s' % x]
+    if value > 0 and m < 0:
+        code.append('addl %s,%%edx' % x)
+    elif value < 0 and m > 0:
+        code.append('subl %s,%%edx' % x)
+    if s:
+        code.append('sarl $%d,%%edx' % s)
+    code += ['movl %edx,%eax','shrl $%d,%%eax' % (BITS-1),'addl %edx,%eax']
+    return code
+
+
+def run(code,regs):
+    ''' Interpret the instructions above over a dict of register values '''
+    mask = (1 << BITS) - 1
+    def get(a):
+        if a.startswith('$'):
+            return wrap(int(a[1:]))
+        return regs[a]
+    for inst in code:
+        op,_,args = inst.partition(' ')
+        if op == 'leal':
+            base,index,scale = args[1:args.index(')')].split(',')
+            dst = args.split(',')[-1]
+            regs[dst] = wrap(regs[base] + regs[index]*int(scale))
+            continue
+        args = args.split(',')
+        if op == 'cdq':
+            regs['%edx'] = -1 if regs['%eax'] < 0 else 0
+        elif op == 'imull':
+            product = get(args[0]) * regs['%eax']
+            regs['%eax'],regs['%edx'] = wrap(product),wrap(product >> BITS)
+        elif op == 'negl':
+            regs[args[0]] = wrap(-regs[args[0]])
+        elif op == 'movl':
+            regs[args[1]] = get(args[0])
+        elif op == 'addl':
+            regs[args[1]] = wrap(regs[args[1]] + get(args[0]))
+        elif op == 'subl':
+            regs[args[1]] = wrap(regs[args[1]] - get(args[0]))
+        elif op == 'shll':
+            regs[args[1]] = wrap(regs[args[1]] << get(args[0]))
+        elif op == 'sarl':
+            regs[args[1]] = regs[args[1]] >> get(args[0])
+        elif op == 'shrl':
+            regs[args[1]] = wrap((regs[args[1]] & mask) >> get(args[0]))
+        else:
+            raise ValueError(inst)
+    return regs
+
+def idivl(a,b):
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+def check(samples=200):
+    ''' Compare the sequences with imull and idivl, return the failures '''
+    import random
+    r = random.Random(0)
+    lo,hi = -(1 << (BITS-1)),(1 << (BITS-1)) - 1
+    edges = [0,1,2,3,-1,-2,-3,7,-7,100,-100,lo,lo+1,hi,hi-1]
+    divisors = set(edges + range(-130,131) + [1 << k for k in range(BITS-1)]
+        + [-(1 << k) for k in range(BITS)] + [r.randint(lo,hi) for i in range(samples)])
+    values = edges + [r.randint(lo,hi) for i in range(samples)]
+    failures = []
+    for d in sorted(divisors):
+        for x,scratch in (('%eax','%ebx'),('%ecx',None)):
+            mul,div = mul_imm(d,x,scratch),div_imm(d,x,scratch)
+            for v in values:
+                regs = dict.fromkeys(['%eax','%ebx','%edx'],0)
+                regs[x] = v
+                if mul is not None and run(mul,dict(regs))[x] != wrap(v*d):
+                    failures.append(('mul',v,d,x))
+                if div is not None and run(div,regs)['%eax'] != idivl(v,d):
+                    failures.append(('div',v,d,x))
+    return failures
+
+if __name__ == '__main__':
+    failures = check()
+    for f in failures[:20]:
+        print '%s %d by %d from %s: wrong' % f
+    print '%d failures' % len(failures)